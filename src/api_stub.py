@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+This file implements a local stand-in for the '/v1/metrictimeseries'
+endpoint of the API server. It pages synthetic metric time series with
+'offset' and 'limit', keeps the connections alive and can fail requests on
+purpose, so the metadata fetcher can be measured and tested without a real
+server.
+"""
+import json
+import threading
+import time
+import urlparse
+from src.http_util import KeepAliveHandler
+from src.http_util import start_server
+
+METRIC_TYPES = ['GAUGE', 'COUNTER', 'CUMULATIVE_COUNTER']
+
+
+def generate_metric_time_series(query, count, first_id=0):
+    """
+    Generate the synthetic metric time series of a query
+
+    :param query: query sentence
+    :param count: number of metric time series
+    :param first_id: sf_id of the first metric time series
+    :return: list of metric time series like the API result
+    """
+    return [{'sf_id': str(first_id + number),
+             'sf_metric': 'stub.{0}'.format(query),
+             'sf_metricType': METRIC_TYPES[number % len(METRIC_TYPES)],
+             'sf_isActive': True,
+             'host': 'host-{0}'.format(number)}
+            for number in xrange(count)]
+
+
+class StubApiServer(object):
+    """
+    Stand-in API server, listening on a free local port from a daemon
+    thread. Use 'url' as the api_server of the record configuration.
+
+    :param results: dictionary of query sentence to list of metric time
+     series
+    :param latency: seconds spent by each request
+    :param fail_every: answer HTTP 503 to every 'fail_every'-th request, 0
+     to never fail
+    :param max_limit: largest page size answered, like the real server
+    :param send_count: answer the number of results of the query with each
+     page
+    """
+
+    def __init__(self, results, latency=0.0, fail_every=0, max_limit=1000,
+                 send_count=True):
+        self.results = results
+        self.latency = latency
+        self.fail_every = fail_every
+        self.max_limit = max_limit
+        self.send_count = send_count
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.failed_requests = 0
+        stub = self
+
+        class StubApiHandler(KeepAliveHandler):
+            def setup(self):
+                KeepAliveHandler.setup(self)
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                status, result = stub.answer(self.path)
+                self.send_body(status, json.dumps(result))
+
+        self.server, self.url = start_server(StubApiHandler)
+
+    def answer(self, path):
+        """
+        Answer one request
+
+        :param path: request path with query string
+        :return: (HTTP status, json result)
+        """
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if self.fail_every and self.requests % self.fail_every == 0:
+                self.failed_requests += 1
+                return 503, {'message': 'stub failure'}
+        url = urlparse.urlparse(path)
+        if url.path != '/v1/metrictimeseries':
+            return 404, {'message': 'not found'}
+        params = urlparse.parse_qs(url.query)
+        query = params.get('query', [''])[0]
+        offset = int(params.get('offset', ['0'])[0])
+        limit = min(int(params.get('limit', [self.max_limit])[0]),
+                    self.max_limit)
+        results = self.results.get(query, [])
+        result = {'rs': results[offset:offset + limit]}
+        if self.send_count:
+            result['count'] = len(results)
+        return 200, result
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+This file implements the recording archive 'replay-data.tar.gz'. Each tar
+entry of the archive is compressed as its own gzip member: the archive is
+still a valid tar.gz file, the members are compressed in parallel while the
+recording is converted, and one member can be read without decompressing
+the others.
+
+A sidecar index 'replay-data.tar.gz.idx' gives the position of each member,
+so the publish tool reads the slot files straight from the archive.
+
+      {"size": archive size,
+       "members": {name: [offset, compressed length, header length, size]}}
+"""
+import json
+import os
+import tarfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+from src.util import Error
+from src.util import CONFIG_FILE
+from src.util import METADATA_FILE
+from src.util import SLOT_INDEX_SUFFIX
+from src.util import SLOT_SUFFIX
+from src.util import TS_DATA_DIR
+from src.slot_format import open_slot
+
+ARCHIVE_ROOT = 'data'
+INDEX_SUFFIX = '.idx'
+COMPRESS_LEVEL = 6
+READ_SIZE = 1024 * 1024
+# gzip wrapper of the deflate streams
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def is_archive(path):
+    return os.path.isfile(path) and path.endswith('.tar.gz')
+
+
+def pad_block(size):
+    """
+    Get the padding of a tar entry to a whole number of blocks
+
+    :param size: size of the entry data
+    :return: string of null bytes
+    """
+    return '\0' * (-size % tarfile.BLOCKSIZE)
+
+
+class ArchiveWriter(object):
+    """
+    Write the files of a data directory into an archive. The files are
+    compressed by a pool of 'workers' threads as they are added, and written
+    in the order they are done.
+
+    :param archive_path: archive file path
+    :param data_directory: data directory, stored as ARCHIVE_ROOT
+    :param workers: number of compression threads
+    """
+
+    def __init__(self, archive_path, data_directory, workers=1):
+        self.archive_path = archive_path
+        self.data_directory = data_directory.rstrip('/')
+        self.archive_file = open(archive_path + '.tmp', 'wb')
+        self.lock = threading.Lock()
+        self.members = {}
+        self.added = set()
+        self.results = []
+        self.pool = ThreadPool(workers)
+
+    def get_name(self, file_path):
+        """
+        Get the member name of a file of the data directory
+
+        :param file_path: file path
+        :return: member name
+        """
+        relative_path = os.path.relpath(file_path, self.data_directory)
+        if relative_path == '.':
+            return ARCHIVE_ROOT
+        return ARCHIVE_ROOT + '/' + relative_path
+
+    def add(self, file_path):
+        """
+        Add a file or a directory of the data directory to the archive, once
+
+        :param file_path: file path
+        """
+        name = self.get_name(file_path)
+        if name in self.added:
+            return
+        self.added.add(name)
+        self.results.append(self.pool.apply_async(self.write_member,
+                                                  (file_path, name)))
+
+    def write_member(self, file_path, name):
+        """
+        Compress one tar entry into a gzip member and append it to the
+        archive
+
+        :param file_path: file path
+        :param name: member name
+        """
+        info = tarfile.TarInfo(name)
+        info.mtime = int(os.path.getmtime(file_path))
+        if os.path.isdir(file_path):
+            info.type = tarfile.DIRTYPE
+            info.mode = 0755
+        else:
+            info.size = os.path.getsize(file_path)
+            info.mode = 0644
+        header = info.tobuf()
+
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                      GZIP_WBITS)
+        chunks = [compressor.compress(header)]
+        if info.isfile():
+            with open(file_path, 'rb') as input_file:
+                size = 0
+                for block in iter(lambda: input_file.read(READ_SIZE), ''):
+                    chunks.append(compressor.compress(block))
+                    size += len(block)
+            if size != info.size:
+                raise Error('{0} changed while it was archived'.format(
+                    file_path))
+            chunks.append(compressor.compress(pad_block(size)))
+        chunks.append(compressor.flush())
+
+        with self.lock:
+            offset = self.archive_file.tell()
+            self.archive_file.writelines(chunks)
+            self.members[name] = [offset, self.archive_file.tell() - offset,
+                                  len(header), info.size]
+
+    def close(self):
+        """
+        Wait for all members, end the archive and write its index
+        """
+        self.pool.close()
+        try:
+            for result in self.results:
+                result.get()
+        finally:
+            self.pool.join()
+        # End of the tar archive: two null blocks
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                      GZIP_WBITS)
+        self.archive_file.write(
+            compressor.compress('\0' * 2 * tarfile.BLOCKSIZE) +
+            compressor.flush())
+        size = self.archive_file.tell()
+        self.archive_file.close()
+        with open(self.archive_path + INDEX_SUFFIX + '.tmp', 'w') as outfile:
+            json.dump({'size': size, 'members': self.members}, outfile)
+        os.rename(self.archive_path + '.tmp', self.archive_path)
+        os.rename(self.archive_path + INDEX_SUFFIX + '.tmp',
+                  self.archive_path + INDEX_SUFFIX)
+
+    def abort(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.archive_file.close()
+        os.remove(self.archive_path + '.tmp')
+
+
+class ArchiveReader(object):
+    """
+    Read the members of an archive lazily, through its index. It has the
+    same 'exists' and 'open_slot' methods as a DirectorySource, for the
+    member names.
+
+    :param archive_path: archive file path
+    """
+
+    def __init__(self, archive_path):
+        index_path = archive_path + INDEX_SUFFIX
+        if not os.path.isfile(index_path):
+            raise Error('Archive {0} has no index {1}, extract it and '
+                        'publish the data directory'.format(archive_path,
+                                                            index_path))
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index['size'] != os.path.getsize(archive_path):
+            raise Error('Index {0} does not match the archive'.format(
+                index_path))
+        self.members = index['members']
+        self.archive_file = open(archive_path, 'rb')
+        self.lock = threading.Lock()
+
+    def exists(self, name):
+        return name in self.members
+
+    def read(self, name):
+        """
+        Read the data of a member
+
+        :param name: member name
+        :return: string of the member data
+        """
+        if name not in self.members:
+            raise Error('Archive has no member {0}'.format(name))
+        offset, length, header_length, size = self.members[name]
+        with self.lock:
+            self.archive_file.seek(offset)
+            raw = self.archive_file.read(length)
+        data = zlib.decompress(raw, GZIP_WBITS)
+        return data[header_length:header_length + size]
+
+    def open_slot(self, name, metric_index):
+        index_data = None
+        if self.exists(name + SLOT_INDEX_SUFFIX):
+            index_data = self.read(name + SLOT_INDEX_SUFFIX)
+        return open_slot(name, metric_index, self.read(name), index_data)
+
+    def check_data(self):
+        """
+        Check if the archive holds a complete recording.
+
+        :return: slot format of the time series data files
+        """
+        for name in [CONFIG_FILE, METADATA_FILE, TS_DATA_DIR]:
+            if not self.exists(ARCHIVE_ROOT + '/' + name):
+                raise Error('Archive is not complete!')
+        binary_suffix = '.' + SLOT_SUFFIX['binary']
+        ts_prefix = ARCHIVE_ROOT + '/' + TS_DATA_DIR + '/'
+        for name in self.members:
+            if name.startswith(ts_prefix) and name.endswith(binary_suffix):
+                return 'binary'
+        return 'json'
+
+    def read_json(self, name):
+        """
+        Read a json member
+
+        :param name: member name
+        :return: decoded json content
+        """
+        try:
+            return json.loads(self.read(name))
+        except ValueError:
+            raise Error('Archive member {0} is not a valid json file'.format(
+                name))
+
+
+class DirectorySource(object):
+    """
+    Slot files of a data directory.
+    """
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def open_slot(self, path, metric_index):
+        return open_slot(path, metric_index)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""
+This file implements the benchmark of the replay tool. It measures the hot
+paths offline, against local stand-in services:
+
+- 'generate' : write a synthetic recording of raw time series data files
+- 'convert' : convert the raw files of the synthetic recording
+- 'record' : record through the stand-in API server and time series data
+  server, which needs the dtools library
+- 'publish' : publish the synthetic recording at max rate to the stand-in
+  ingest endpoint
+
+Each stage runs in its own process, so its peak memory is its own. The
+stages report their seconds, datapoints, datapoints per second and peak
+resident memory.
+"""
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+from src.util import Error
+from src.util import TIME_INFOR
+from src.util import TIME_PATTERN
+from src.util import check_record_config
+from src.util import create_folder_path
+from src.util import get_second_shift
+from src.util import get_time_series_file_path
+from src.util import set_metric_indexes
+from src.api_stub import StubApiServer
+from src.api_stub import generate_metric_time_series
+
+STAGES = ['generate', 'convert', 'record', 'publish']
+BENCH_QUERY = 'bench'
+BENCH_TOKEN = 'bench'
+# Seconds without new ingested data after which the publish stage is done
+INGEST_SETTLE_SECONDS = 1.0
+INGEST_TIMEOUT_SECONDS = 30.0
+
+
+def get_bench_config(data_directory, time_range, data_file_interval,
+                     slot_format, api_server='http://127.0.0.1'):
+    """
+    Get a record configuration ending one minute ago
+
+    :param data_directory: data directory of the recording
+    :param time_range: time range
+    :param data_file_interval: hour interval of each data file
+    :param slot_format: slot format
+    :param api_server: API server url
+    :return: record configuration dictionary
+    """
+    second_range = TIME_INFOR[time_range]['second_range']
+    start = int(time.time()) - second_range - 60
+    return {
+        'api_server': api_server,
+        'record_token': BENCH_TOKEN,
+        'ts_server': 'localhost',
+        'query': [BENCH_QUERY],
+        'data_directory': data_directory,
+        'start_time': time.strftime(TIME_PATTERN, time.localtime(start)),
+        'time_range': time_range,
+        'data_file_interval': data_file_interval,
+        'slot_format': slot_format
+    }
+
+
+def write_config(config):
+    """
+    Write a record configuration next to its data directory
+
+    :param config: record configuration dictionary
+    :return: configuration file path
+    """
+    config_file = config['data_directory'] + '.json'
+    with open(config_file, 'w') as outfile:
+        json.dump(config, outfile, indent=4)
+    return config_file
+
+
+def generate_recording(config, metric_count, resolution):
+    """
+    Write the metadata and the raw time series data files of a synthetic
+    recording, 'metric_count' metrics with one datapoint every 'resolution'
+    seconds.
+
+    :param config: record configuration dictionary
+    :param metric_count: number of metric time series
+    :param resolution: seconds between two datapoints of a metric
+    :return: number of datapoints
+    """
+    record_dict = check_record_config(config)
+    create_folder_path(record_dict['data_directory'])
+    create_folder_path(record_dict['ts_directory'])
+    shutil.copy(write_config(config), record_dict['record_config'])
+
+    metadata = {}
+    for raw_metadata in generate_metric_time_series(BENCH_QUERY,
+                                                    metric_count):
+        metadata[raw_metadata['sf_id']] = {
+            'sf_metricType': raw_metadata['sf_metricType'],
+            'sf_metric': raw_metadata['sf_metric'],
+            'dimensions': {'host': raw_metadata['host']}
+        }
+    set_metric_indexes(metadata)
+    with open(record_dict['metadata_path'], 'w') as outfile:
+        json.dump(metadata, outfile, indent=4)
+
+    metric_ids = sorted(metadata.keys())
+    datapoints = 0
+    file_path = None
+    raw_file = None
+    try:
+        for time_stamp in xrange(record_dict['start'], record_dict['end'],
+                                 resolution):
+            new_file_path = get_time_series_file_path(
+                time_stamp, record_dict['interval'],
+                record_dict['time_range'], record_dict['ts_directory'],
+                'data')
+            if new_file_path != file_path:
+                if raw_file is not None:
+                    raw_file.close()
+                file_path = new_file_path
+                raw_file = open(file_path, 'a')
+            raw_file.writelines(
+                '{0},{1},{2!r}\n'.format(time_stamp, metric_id,
+                                         math.sin(time_stamp / 60.0 + number))
+                for number, metric_id in enumerate(metric_ids))
+            datapoints += len(metric_ids)
+    finally:
+        if raw_file is not None:
+            raw_file.close()
+    return {'datapoints': datapoints}
+
+
+def convert_recording(config):
+    """
+    Convert the raw time series data files of a generated recording
+
+    :param config: record configuration dictionary
+    :return: stage result dictionary
+    """
+    from src.convert_data import convert_all_time_series_data
+    record_dict = check_record_config(config)
+    with open(record_dict['metadata_path']) as metadata_file:
+        metadata = json.load(metadata_file)
+    datapoints = 0
+    for file_path in os.listdir(record_dict['ts_directory']):
+        with open(os.path.join(record_dict['ts_directory'],
+                               file_path)) as raw_file:
+            datapoints += sum(1 for _ in raw_file)
+    convert_all_time_series_data(record_dict, metadata)
+    return {'datapoints': datapoints}
+
+
+def record_recording(config, metric_count, resolution):
+    """
+    Record through the stand-in API server and time series data server.
+    The tarball is written into the parent directory of the recording.
+
+    :param config: record configuration dictionary
+    :param metric_count: number of metric time series
+    :param resolution: seconds between two datapoints of a metric
+    :return: stage result dictionary
+    """
+    try:
+        from sf.timeseries.ttypes import TsdbException
+        from src import record_data
+    except ImportError as err:
+        raise Error('The record stage needs the dtools library: {0}'.format(
+            err))
+    from src.tsdb_stub import StubTsdbServer
+
+    api_server = StubApiServer({BENCH_QUERY: generate_metric_time_series(
+        BENCH_QUERY, metric_count)})
+    tsdb_server = StubTsdbServer(connect_latency=0, request_latency=0,
+                                 resolution_ms=resolution * 1000,
+                                 exception_type=TsdbException)
+    record_data.TSDB_POOL.factory = tsdb_server.client
+    config = dict(config, api_server=api_server.url)
+    config_file = write_config(config)
+    os.chdir(os.path.dirname(os.path.abspath(config['data_directory'])))
+    try:
+        record_data.record_by_config(check_record_config(config),
+                                     config_file)
+    finally:
+        api_server.shutdown()
+    second_range = TIME_INFOR[config['time_range']]['second_range']
+    return {'datapoints': metric_count * (second_range / resolution),
+            'requests': tsdb_server.requests + api_server.requests}
+
+
+def publish_recording(config, metric_count, resolution, options):
+    """
+    Publish each slot file of a converted recording once, at max rate, to
+    the stand-in ingest endpoint. The replay starts at the start of the first
+    slot, and the time stamp of its first second is still due, so every
+    generated datapoint is published.
+
+    :param config: record configuration dictionary
+    :param metric_count: number of metric time series
+    :param resolution: seconds between two datapoints of a metric
+    :param options: publish options
+    :return: stage result dictionary
+    """
+    from src.ingest_stub import StubIngestServer
+    from src.publish_data import publish_data
+
+    record_dict = check_record_config(config)
+    ingest_server = StubIngestServer()
+    slot_count = int(math.ceil(
+        TIME_INFOR[record_dict['time_range']]['second_range'] /
+        record_dict['interval']))
+    options = dict(options, max_rate='true', max_slots=slot_count)
+    # A second time whose second shift is 0, the start of the first slot
+    replay_start = record_dict['start'] - get_second_shift(
+        record_dict['start'], record_dict['time_range'])
+    try:
+        start = time.time()
+        stats = publish_data(record_dict['data_directory'], [BENCH_TOKEN],
+                             [ingest_server.url], None, False, replay_start,
+                             **options)
+        seconds = time.time() - start
+        # The signalfx client may still be sending
+        deadline = time.time() + INGEST_TIMEOUT_SECONDS
+        ingested = ingest_server.get_stats()
+        while time.time() < deadline:
+            time.sleep(INGEST_SETTLE_SECONDS)
+            last_ingested, ingested = ingested, ingest_server.get_stats()
+            if ingested == last_ingested:
+                break
+    finally:
+        ingest_server.shutdown()
+    return {'seconds': seconds,
+            'datapoints': stats['datapoints'],
+            'generated': metric_count * len(xrange(
+                record_dict['start'], record_dict['end'], resolution)),
+            'requests': stats['requests'],
+            'send_errors': sum(stats['errors'].values())
+            if stats['errors'] is not None else None,
+            'ingested': ingested}
+
+
+def measure_stage(queue, function, args):
+    """
+    Run a stage in this process and put its measures into the queue. A stage
+    waiting for stand-in services gives its own 'seconds'.
+
+    :param queue: multiprocessing queue of the result
+    :param function: stage function
+    :param args: arguments of the stage function
+    """
+    start = time.time()
+    try:
+        result = function(*args)
+    except Error as err:
+        result = {'error': err.message}
+    except Exception as err:
+        result = {'error': '{0}: {1}'.format(type(err).__name__, err)}
+    result.setdefault('seconds', time.time() - start)
+    result['peak_rss_bytes'] = 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if 'datapoints' in result and result['seconds'] > 0:
+        result['datapoints_per_second'] = \
+            result['datapoints'] / result['seconds']
+    queue.put(result)
+
+
+def run_stage(function, *args):
+    """
+    Run a stage in a new process
+
+    :param function: stage function
+    :param args: arguments of the stage function
+    :return: stage result dictionary
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure_stage,
+                                      args=(queue, function, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def print_report(results):
+    """
+    Print a table of the stage results
+
+    :param results: list of (stage, result dictionary)
+    """
+    print '{0:<10} {1:>10} {2:>12} {3:>14} {4:>10}'.format(
+        'stage', 'seconds', 'datapoints', 'datapoints/s', 'peak MB')
+    for stage, result in results:
+        if 'error' in result:
+            print '{0:<10} failed: {1}'.format(stage, result['error'])
+            continue
+        print '{0:<10} {1:>10.2f} {2:>12} {3:>14.0f} {4:>10.1f}'.format(
+            stage, result['seconds'], result.get('datapoints', 0),
+            result.get('datapoints_per_second', 0),
+            result['peak_rss_bytes'] / 1048576.0)
+        if 'generated' in result:
+            print '{0:<10} published {1} of {2} generated datapoints'.format(
+                '', result['datapoints'], result['generated'])
+
+
+def run_benchmark(bench_directory, metric_count, resolution, time_range,
+                  data_file_interval, slot_format='json', stages=None,
+                  publish_options=None, output_file=None):
+    """
+    Run the benchmark stages in order and report them
+
+    :param bench_directory: directory of the synthetic recordings
+    :param metric_count: number of metric time series
+    :param resolution: seconds between two datapoints of a metric
+    :param time_range: time range
+    :param data_file_interval: hour interval of each data file
+    :param slot_format: slot format
+    :param stages: list of stages to run, all STAGES when None
+    :param publish_options: publish options of the publish stage
+    :param output_file: json file of the results
+    :return: list of (stage, result dictionary)
+    """
+    stages = stages or STAGES
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise Error('Unknown stages {0}, the stages are {1}'.format(
+            sorted(unknown), STAGES))
+    if time_range not in TIME_INFOR:
+        raise Error('Time range is not {0}'.format(TIME_INFOR.keys()))
+    if metric_count < 1 or resolution < 1:
+        raise Error('The metric count and resolution should be at least 1!')
+    if not os.path.isdir(bench_directory):
+        os.makedirs(bench_directory)
+
+    config = get_bench_config(os.path.join(bench_directory, 'generated'),
+                              time_range, data_file_interval, slot_format)
+    record_config = get_bench_config(os.path.join(bench_directory, 'recorded'),
+                                     time_range, data_file_interval,
+                                     slot_format)
+    stage_runs = {
+        'generate': (generate_recording, config, metric_count, resolution),
+        'convert': (convert_recording, config),
+        'record': (record_recording, record_config, metric_count,
+                   resolution),
+        'publish': (publish_recording, config, metric_count, resolution,
+                    publish_options or {})
+    }
+    results = []
+    for stage in STAGES:
+        if stage in stages:
+            print 'Benchmark {0} ...'.format(stage)
+            results.append((stage, run_stage(*stage_runs[stage])))
+
+    print_report(results)
+    if output_file is not None:
+        with open(output_file, 'w') as outfile:
+            json.dump({'metrics': metric_count, 'resolution': resolution,
+                       'time_range': time_range,
+                       'data_file_interval': data_file_interval,
+                       'slot_format': slot_format,
+                       'stages': dict(results)}, outfile, indent=4)
+    return results
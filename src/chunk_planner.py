@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+This file implements the adaptive time chunk planner of the record tool.
+It remembers the time window which works for each kind of request, so the
+download of a new metric starts from a window the server can answer instead
+of asking for the whole time range again.
+"""
+import threading
+
+# Smallest time window in seconds of a request
+MIN_WINDOW = 60
+# Growth factor of the window when it probes a larger window
+GROWTH_FACTOR = 1.25
+# Number of successes in a row before the window probes a larger window
+PROBE_SUCCESSES = 4
+
+
+class ChunkPlanner(object):
+    """
+    Plan the time window of the time series data requests by key, like the
+    rollup. The planner learns the span of a key, its window times its number
+    of metrics, so a batch of any size starts from what the other batches of
+    the key learned: the window of a batch is the span divided by its number
+    of metrics.
+    The span of a key is halved after each failed request until a request
+    succeeds. Once a span works, it only grows by GROWTH_FACTOR after
+    PROBE_SUCCESSES successes in a row. A failed probe falls back to the last
+    working span and doubles the successes needed before the next probe, so
+    the span stays just above the largest span the server answers.
+
+    :param max_window: largest second window, the whole time range
+    :param min_window: smallest second window
+    """
+
+    def __init__(self, max_window=0, min_window=MIN_WINDOW):
+        self.lock = threading.Lock()
+        self.reset(max_window, min_window)
+
+    def reset(self, max_window, min_window=MIN_WINDOW):
+        """
+        Forget all spans and counters
+
+        :param max_window: largest second window, the whole time range
+        :param min_window: smallest second window
+        """
+        with self.lock:
+            self.max_window = max_window
+            self.min_window = min(min_window, max_window)
+            self.spans = {}
+            # Last working span, successes in a row and successes needed
+            #  before the next probe of each key
+            self.working_spans = {}
+            self.streaks = {}
+            self.probe_successes = {}
+            self.largest_success = {}
+            self.succeeded = 0
+            self.failed = 0
+
+    def plan_window(self, key, metric_count):
+        """
+        Get the planned window of a key, with the lock held
+
+        :param key: request key
+        :param metric_count: number of metrics of the request
+        :return: second window
+        """
+        span = self.spans.get(key)
+        if span is None:
+            return self.max_window
+        return max(self.min_window,
+                   min(self.max_window, int(span / metric_count)))
+
+    def get_window(self, key, metric_count=1):
+        """
+        Get the planned second window of the next request of a key
+
+        :param key: request key, like the rollup
+        :param metric_count: number of metrics of the request
+        :return: second window
+        """
+        with self.lock:
+            return self.plan_window(key, metric_count)
+
+    def success(self, key, window, metric_count=1):
+        """
+        Report a successful request, the span of its key grows after enough
+        successes in a row
+
+        :param key: request key
+        :param window: second window of the request
+        :param metric_count: number of metrics of the request
+        """
+        span = window * metric_count
+        with self.lock:
+            self.succeeded += 1
+            if span > self.largest_success.get(key, 0):
+                self.largest_success[key] = span
+            if window < self.plan_window(key, metric_count):
+                # A shorter request, at the end of the range, tells nothing
+                #  about the planned window
+                return
+            self.working_spans[key] = span
+            streak = self.streaks.get(key, 0) + 1
+            if streak >= self.probe_successes.get(key, PROBE_SUCCESSES):
+                self.spans[key] = min(self.max_window * metric_count,
+                                      int(span * GROWTH_FACTOR))
+                streak = 0
+            self.streaks[key] = streak
+
+    def failure(self, key, window, metric_count=1):
+        """
+        Report a failed request: a failed probe falls back to the last
+        working span, otherwise the span is halved
+
+        :param key: request key
+        :param window: second window of the request
+        :param metric_count: number of metrics of the request
+        """
+        span = window * metric_count
+        with self.lock:
+            self.failed += 1
+            self.streaks[key] = 0
+            current = self.spans.get(key, span)
+            working_span = self.working_spans.get(key, 0)
+            if 0 < working_span < span:
+                self.spans[key] = min(current, working_span)
+                self.probe_successes[key] = 2 * self.probe_successes.get(
+                    key, PROBE_SUCCESSES)
+                return
+            self.spans[key] = max(self.min_window,
+                                  min(current, int(span / 2)))
+            # The data got denser, the working span failed too
+            self.working_spans.pop(key, None)
+
+    def get_stats(self):
+        """
+        Get the request counters and the largest successful spans, window
+        times number of metrics
+
+        :return: stats dictionary
+        """
+        with self.lock:
+            return {
+                'succeeded_requests': self.succeeded,
+                'failed_requests': self.failed,
+                'largest_success': dict(self.largest_success)
+            }
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""
+This file implements all functions about converting raw time series data
+files to json or binary time series data files.
+The raw data file is streamed line by line and grouped by second shift. When
+the group map holds more than a buffer size of data, it is spilled into a
+sorted run file, and all runs are merged when the raw file is done.
+"""
+import glob
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+from src.util import Error
+from src.util import CONVERT_BUFFER_SIZE
+from src.util import CONFIG_FILE
+from src.util import METADATA_FILE
+from src.util import SLOT_INDEX_SUFFIX
+from src.util import SLOT_SUFFIX
+from src.util import TS_DATA_DIR
+from src.util import check_data_dir
+from src.util import create_path
+from src.util import get_second_shift
+from src.util import read_record_config
+from src.util import set_metric_indexes
+from src.slot_format import JsonSlot
+from src.slot_format import open_slot
+from src.slot_format import write_binary_groups
+from src.vectorized import group_interned_lines
+from src.vectorized import group_raw_lines
+
+# Metric id -> metric index of the recording, set in each conversion process.
+#  The slot files reference the metrics by metric index.
+METRIC_INDEX = {}
+METRIC_IDS = {}
+
+
+def init_convert_worker(metric_index):
+    """
+    Set the metric indexes used by the conversion in this process
+
+    :param metric_index: map of metric id to metric index
+    """
+    METRIC_INDEX.clear()
+    METRIC_INDEX.update(metric_index)
+    METRIC_IDS.clear()
+    METRIC_IDS.update((index, metric_id)
+                      for metric_id, index in metric_index.items())
+
+
+def spill_sorted_run(tsdata, run_file):
+    """
+    Write the grouped time series data into a run file sorted by second shift
+
+    :param tsdata: map of second shift to old time and data
+    :param run_file: The run file path
+    """
+    with open(run_file, 'w') as outfile:
+        for second_shift in sorted(tsdata.keys()):
+            old_time = tsdata[second_shift]['old_time']
+            outfile.writelines(
+                '{0},{1},{2},{3!r}\n'.format(second_shift, old_time,
+                                             item['id'], item['value'])
+                for item in tsdata[second_shift]['data'])
+
+
+def read_sorted_run(run_file, run_number):
+    """
+    Read a run file back, group by group
+
+    :param run_file: The run file path
+    :param run_number: The number of the run, to keep the file order
+    :return: generator of (second shift, run number, old time, data)
+    """
+    group = None
+    with open(run_file) as infile:
+        for line in infile:
+            array = line.rstrip('\n').split(',')
+            second_shift = int(array[0])
+            new_value = {'id': array[2], 'value': float(array[3])}
+            if group is not None and group[0] == second_shift:
+                group[3].append(new_value)
+                continue
+            if group is not None:
+                yield group
+            group = (second_shift, run_number, array[1], [new_value])
+    if group is not None:
+        yield group
+
+
+def read_memory_run(tsdata, run_number):
+    """
+    Read the grouped time series data held in memory as the last run
+
+    :param tsdata: map of second shift to old time and data
+    :param run_number: The number of the run, to keep the file order
+    :return: generator of (second shift, run number, old time, data)
+    """
+    for second_shift in sorted(tsdata.keys()):
+        yield (second_shift, run_number, tsdata[second_shift]['old_time'],
+               tsdata[second_shift]['data'])
+
+
+def read_slot_run(slot_file, run_number):
+    """
+    Read an existing slot file as a run, group by group
+
+    :param slot_file: The slot file path
+    :param run_number: The number of the run, to keep the file order
+    :return: generator of (second shift, run number, old time, data)
+    """
+    slot = open_slot(slot_file, METRIC_INDEX)
+    for position, second_shift in enumerate(slot.time_series):
+        yield (second_shift, run_number, str(slot.get_old_time(position)),
+               [{'id': METRIC_IDS[index], 'value': value}
+                for index, value in slot.get_data(position)])
+
+
+def merge_sorted_runs(runs):
+    """
+    Merge the runs into one sequence of groups sorted by second shift.
+    The old time of a second shift is the one of the first run having it.
+
+    :param runs: list of group generators
+    :return: generator of (second shift, old time, data)
+    """
+    current = None
+    for second_shift, _, old_time, data in heapq.merge(*runs):
+        if current is not None and current[0] == second_shift:
+            current[2].extend(data)
+            continue
+        if current is not None:
+            yield current
+        current = (second_shift, old_time, list(data))
+    if current is not None:
+        yield current
+
+
+def dedupe_groups(groups):
+    """
+    Keep the first value of each metric in each group. A resumed recording
+    may append the data of a chunk twice.
+
+    :param groups: generator of (second shift, old time, data), data items
+     are {'id': metric id, 'value': value}
+    :return: generator of (second shift, old time, data)
+    """
+    for second_shift, old_time, data in groups:
+        seen = set()
+        unique = []
+        for item in data:
+            if item['id'] not in seen:
+                seen.add(item['id'])
+                unique.append(item)
+        yield second_shift, old_time, unique
+
+
+def intern_groups(groups, metric_index):
+    """
+    Replace the metric ids of the groups by metric indexes
+
+    :param groups: generator of (second shift, old time, data), data items
+     are {'id': metric id, 'value': value}
+    :param metric_index: map of metric id to metric index
+    :return: generator of (second shift, old time, data), data items are
+     (metric index, value) pairs
+    """
+    for second_shift, old_time, data in groups:
+        yield (second_shift, old_time,
+               [(metric_index[item['id']], item['value']) for item in data])
+
+
+def write_json_groups(output_file, groups, index_file=None):
+    """
+    Write the sorted groups into a compact json file, one group by line,
+    and the position of each group into its sidecar index
+
+    :param output_file: The output json file
+    :param groups: generator of (second shift, old time, data), data items
+     are (metric index, value) pairs
+    :param index_file: The output index file, no index when None
+    """
+    index = []
+    with open(output_file, 'wb') as outfile:
+        outfile.write('{\n')
+        separator = ''
+        for second_shift, old_time, data in groups:
+            key = '{0}"{1}":'.format(separator, second_shift)
+            value = json.dumps({'old_time': old_time, 'data': data},
+                               separators=(',', ':'))
+            index.append([second_shift, int(old_time),
+                          outfile.tell() + len(key), len(value)])
+            outfile.write(key + value)
+            separator = ',\n'
+        outfile.write('\n}')
+        size = outfile.tell()
+    if index_file is not None:
+        with open(index_file, 'w') as outfile:
+            json.dump({'size': size, 'shifts': index}, outfile,
+                      separators=(',', ':'))
+
+
+def convert_time_series_data(input_file, output_file, time_range,
+                             buffer_size=CONVERT_BUFFER_SIZE,
+                             slot_format='json', merge_file=None,
+                             index_file=None, vectorize=False):
+    """
+    Convert the time series data file into a json or binary file grouped by
+    timestamp.
+
+    :param input_file: The input data file with time series data
+    :param output_file: The output slot file
+    :param time_range: The time range
+    :param buffer_size: Number of data held in memory before spilling
+    :param slot_format: format of the output slot file
+    :param merge_file: existing slot file merged into the output, its data
+     are kept over the data of the input file
+    :param index_file: sidecar index of a json output slot file
+    :param vectorize: group each buffer of lines at once with NumPy
+    """
+    tsdata = {}
+    run_files = []
+    size = 0
+    lines = None
+
+    def spill(tsdata):
+        run_file = '{0}.{1}.run'.format(output_file, len(run_files))
+        spill_sorted_run(tsdata, run_file)
+        run_files.append(run_file)
+
+    with open(input_file) as raw_file:
+        if vectorize:
+            # Handle the raw time series data by buffer of lines, the last
+            #  buffer is kept as lines
+            for next_lines in iter(lambda: list(itertools.islice(
+                    raw_file, buffer_size)), []):
+                if lines is not None:
+                    spill(group_raw_lines(lines, time_range))
+                lines = next_lines
+        else:
+            # Handle all raw time series data by line
+            for line in raw_file:
+                array = line.rstrip('\n').split(',')
+                if len(array) != 3:
+                    continue
+                second_shift = get_second_shift(int(array[0]), time_range)
+                new_value = {'id': array[1], 'value': float(array[2])}
+                if second_shift in tsdata:
+                    tsdata[second_shift]['data'].append(new_value)
+                else:
+                    tsdata[second_shift] = {'old_time': array[0],
+                                            'data': [new_value]}
+                size += 1
+
+                # Spill the map into a sorted run when the buffer is full
+                if size >= buffer_size:
+                    spill(tsdata)
+                    tsdata = {}
+                    size = 0
+
+    # Merge all runs and write them into a slot file
+    try:
+        if lines is not None and not run_files and merge_file is None:
+            # The whole file fits in the buffer: group it by columns
+            groups = group_interned_lines(lines, time_range, METRIC_INDEX)
+        else:
+            if lines is not None:
+                tsdata = group_raw_lines(lines, time_range)
+            runs = [read_sorted_run(run_path, run_number)
+                    for run_number, run_path in enumerate(run_files)]
+            runs.append(read_memory_run(tsdata, len(run_files)))
+            if merge_file is not None:
+                runs.insert(0, read_slot_run(merge_file, -1))
+            groups = intern_groups(dedupe_groups(merge_sorted_runs(runs)),
+                                   METRIC_INDEX)
+        if slot_format == 'binary':
+            write_binary_groups(output_file, groups)
+        else:
+            write_json_groups(output_file, groups, index_file)
+    finally:
+        for run_file in run_files:
+            os.remove(run_file)
+
+
+def convert_slot_file(task):
+    """
+    Convert one raw time series data file into its slot file. The slot file
+    is written under a temporary name and renamed when complete, then the
+    raw file is removed. A slot file which already exists, from an
+    incremental recording or a conversion interrupted before the raw file
+    was removed, is merged with the raw file. A json slot file gets its
+    sidecar index, renamed after the slot file.
+
+    :param task: (raw file path, time range, buffer size, slot format,
+     vectorize)
+    :return: list of the slot file path and its index path
+    """
+    file_path, time_range, buffer_size, slot_format, vectorize = task
+    new_file_path = file_path[:-5] + "." + SLOT_SUFFIX[slot_format]
+    merge_file = new_file_path if os.path.exists(new_file_path) else None
+    temp_file_path = new_file_path + ".tmp"
+    index_path = None
+    if slot_format == 'json':
+        index_path = new_file_path + SLOT_INDEX_SUFFIX
+    convert_time_series_data(file_path, temp_file_path, time_range,
+                             buffer_size, slot_format, merge_file,
+                             index_path and index_path + ".tmp", vectorize)
+    if index_path is None:
+        os.rename(temp_file_path, new_file_path)
+        os.remove(file_path)
+        return [new_file_path]
+    # The old index never describes the new slot file
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    os.rename(temp_file_path, new_file_path)
+    os.rename(index_path + ".tmp", index_path)
+    os.remove(file_path)
+    return [new_file_path, index_path]
+
+
+def convert_all_time_series_data(ts_dict, metadata, on_converted=None):
+    """
+    Convert all raw time series data to slot files in 'slot_format', with a
+    pool of 'convert_workers' processes. The conversion can be run again
+    after a crash: converted files are merged again, without duplicates.
+
+    :param ts_dict: Time series information from configuration file.
+    :param metadata: Metadata of all metrics, with metric indexes
+    :param on_converted: function called with each slot file path and
+     slot index path as soon as they are converted
+    """
+    on_converted = on_converted or (lambda slot_file: None)
+    # Remove the partial outputs of an interrupted conversion
+    for file_path in glob.glob(ts_dict['ts_directory'] + "/*.tmp") + \
+            glob.glob(ts_dict['ts_directory'] + "/*.run"):
+        os.remove(file_path)
+
+    # Get all raw time series data file
+    files = glob.glob(ts_dict['ts_directory'] + "/*.data")
+    tasks = [(file_path, ts_dict['time_range'],
+              ts_dict['convert_buffer_size'], ts_dict['slot_format'],
+              ts_dict['vectorize'])
+             for file_path in files]
+    metric_index = dict((metric_id, value['index'])
+                        for metric_id, value in metadata.items())
+
+    if ts_dict['convert_workers'] == 1:
+        init_convert_worker(metric_index)
+        for task in tasks:
+            for path in convert_slot_file(task):
+                on_converted(path)
+        return
+
+    pool = multiprocessing.Pool(ts_dict['convert_workers'],
+                                init_convert_worker, (metric_index,))
+    try:
+        for paths in pool.imap_unordered(convert_slot_file, tasks):
+            for path in paths:
+                on_converted(path)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def convert_recording_to_binary(data_dir):
+    """
+    Convert an existing recording with json slot files to binary slot files.
+    The metric ids are interned into metadata.json and the slot format of
+    the recording configuration is set to 'binary'.
+
+    :param data_dir: record data directory
+    """
+    if check_data_dir(data_dir) == 'binary':
+        raise Error('Data directory {0} is already binary!'.format(data_dir))
+
+    metadata_path = create_path(data_dir, METADATA_FILE)
+    with open(metadata_path) as metadata_file:
+        metadata = json.load(metadata_file)
+    set_metric_indexes(metadata)
+    metric_index = dict((metric_id, value['index'])
+                        for metric_id, value in metadata.items())
+    with open(metadata_path + '.tmp', 'w') as outfile:
+        json.dump(metadata, outfile, indent=4)
+    os.rename(metadata_path + '.tmp', metadata_path)
+
+    ts_directory = create_path(data_dir, TS_DATA_DIR)
+    for file_path in glob.glob(ts_directory + "/*.json"):
+        slot = JsonSlot(file_path, metric_index)
+        groups = ((second_shift, slot.get_old_time(position),
+                   slot.get_data(position))
+                  for position, second_shift in enumerate(slot.time_series))
+        new_file_path = file_path[:-5] + "." + SLOT_SUFFIX['binary']
+        write_binary_groups(new_file_path + ".tmp", groups)
+        os.rename(new_file_path + ".tmp", new_file_path)
+        os.remove(file_path)
+        if os.path.exists(file_path + SLOT_INDEX_SUFFIX):
+            os.remove(file_path + SLOT_INDEX_SUFFIX)
+
+    config_path = create_path(data_dir, CONFIG_FILE)
+    config = read_record_config(config_path)
+    config['slot_format'] = 'binary'
+    with open(config_path + '.tmp', 'w') as outfile:
+        json.dump(config, outfile, indent=4)
+    os.rename(config_path + '.tmp', config_path)
@@ -8,8 +8,10 @@ This file is used by docker-based publish tool.
 import os
 from src.publish_data import publish_data
 from src.util import Error
+from src.util import PUBLISH_OPTION_PATTERN
 
 DOCKER_DATA_DIR = '/opt/data'
+DOCKER_ARCHIVE = '/opt/replay-data.tar.gz'
 
 
 def get_environ_variable(key):
@@ -21,12 +23,19 @@ def get_environ_variable(key):
 if __name__ == '__main__':
     # open configuration file
     try:
-        api_token = get_environ_variable('api_token')
-        ingest_endpoint = get_environ_variable('ingest_endpoint')
+        # Several targets are separated by commas
+        api_token = get_environ_variable('api_token').split(',')
+        ingest_endpoint = get_environ_variable('ingest_endpoint').split(',')
         logfile = os.environ.get('log_file', None)
         verbose = 'verbose' in os.environ.keys() and \
                   os.environ['verbose'] == 'true'
-        publish_data(DOCKER_DATA_DIR, api_token, ingest_endpoint, logfile,
-                     verbose)
+        # Publish options are optional environment variables of same name
+        options = dict((key, os.environ.get(key))
+                       for key in PUBLISH_OPTION_PATTERN.keys())
+        # Publish from the archive when it is there, without extracting it
+        data_dir = DOCKER_ARCHIVE if os.path.isfile(DOCKER_ARCHIVE) \
+            else DOCKER_DATA_DIR
+        publish_data(data_dir, api_token, ingest_endpoint, logfile,
+                     verbose, **options)
     except Error as e:
         print e.message
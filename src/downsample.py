@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+This file implements the downsampling of the record tool. The points of a
+metric time series are rolled up into windows of 'resolution' seconds from
+the start of the recording, with the rollup of its metric type: the average
+of a gauge, the sum of a counter and the max of a cumulative counter. The
+point of a window is stamped at the start of the window, so no point is
+stamped before the start of the recording.
+
+The record tool aligns the ends of its requests on the windows, so each
+window is rolled up from all its points at once.
+"""
+
+# Metric type -> rollup of the points of a window
+ROLLUP_FUNCTIONS = {
+    'GAUGE': lambda values: sum(values) / len(values),
+    'COUNTER': sum,
+    'CUMULATIVE_COUNTER': max
+}
+
+
+class Datum(object):
+    __slots__ = ('doubleValue',)
+
+    def __init__(self, double_value):
+        self.doubleValue = double_value
+
+
+class TimeValue(object):
+    """
+    Rolled up point, with the fields of the time values of the time series
+    data server.
+    """
+    __slots__ = ('timestampMs', 'value')
+
+    def __init__(self, timestamp_ms, double_value):
+        self.timestampMs = timestamp_ms
+        self.value = Datum(double_value)
+
+
+def get_window_start(time_stamp, resolution, origin):
+    """
+    Get the start of the window of a time stamp
+
+    :param time_stamp: time stamp
+    :param resolution: resolution, in the unit of the time stamp
+    :param origin: start of the first window, in the unit of the time stamp
+    :return: start time stamp of the window
+    """
+    return time_stamp - (time_stamp - origin) % resolution
+
+
+def align_chunk_end(start, chunk_end, end, resolution, origin):
+    """
+    Align the end of a request on the windows, so no window is split
+    across two requests
+
+    :param start: start second time of the request
+    :param chunk_end: planned end second time of the request
+    :param end: end second time of the recording
+    :param resolution: second resolution, 0 for the native resolution
+    :param origin: start second time of the recording
+    :return: aligned end second time, at most 'end'
+    """
+    if resolution == 0 or chunk_end >= end:
+        return min(chunk_end, end)
+    aligned = get_window_start(chunk_end, resolution, origin)
+    if aligned <= start:
+        aligned = get_window_start(start, resolution, origin) + resolution
+    return min(aligned, end)
+
+
+def downsample_time_values(time_values, resolution_ms, metric_type,
+                           origin_ms):
+    """
+    Roll up the points of one metric time series into windows
+
+    :param time_values: time values sorted by timestamp
+    :param resolution_ms: millisecond resolution
+    :param metric_type: metric type of the metric time series
+    :param origin_ms: start millisecond time of the recording
+    :return: list of TimeValue, one by window with points
+    """
+    rollup = ROLLUP_FUNCTIONS[metric_type]
+    result = []
+    window = None
+    values = []
+    for single_data in time_values:
+        start = get_window_start(single_data.timestampMs, resolution_ms,
+                                 origin_ms)
+        if start != window:
+            if values:
+                result.append(TimeValue(window, rollup(values)))
+            window = start
+            values = []
+        values.append(single_data.value.doubleValue)
+    if values:
+        result.append(TimeValue(window, rollup(values)))
+    return result
+
+
+def downsample_time_series(time_series_data, resolution, metric_type,
+                           origin):
+    """
+    Roll up the points of the metric time series of one request
+
+    :param time_series_data: map of metric id to time values
+    :param resolution: second resolution
+    :param metric_type: metric type of all metric time series
+    :param origin: start second time of the recording
+    :return: map of metric id to list of TimeValue
+    """
+    return dict((metric_id, downsample_time_values(
+        time_values, resolution * 1000, metric_type, origin * 1000))
+        for metric_id, time_values in time_series_data.items())
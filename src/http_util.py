@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+This file implements the HTTP helpers shared by the clients and the
+stand-in servers: keep-alive connections kept by each thread, retries with
+an exponential backoff, and a threading HTTP server with keep-alive
+handlers.
+"""
+import BaseHTTPServer
+import SocketServer
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+# Errors of a broken connection
+CONNECTION_ERRORS = (httplib.HTTPException, socket.error)
+
+
+class KeepAliveConnections(object):
+    """
+    Keep-alive connections to one HTTP server, one by thread. A request
+    failing on a broken connection closes it, so the next request of the
+    thread opens a new one.
+
+    :param base_url: http or https url of the server, with an optional base
+     path
+    :param timeout: second timeout of the connections
+    """
+
+    def __init__(self, base_url, timeout):
+        url = urlparse.urlparse(base_url)
+        if url.scheme not in ['http', 'https'] or not url.hostname:
+            raise ValueError("'{0}' is not a http or https url".format(
+                base_url))
+        self.connection_type = httplib.HTTPSConnection \
+            if url.scheme == 'https' else httplib.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def get_connection(self):
+        """
+        Get the keep-alive connection of this thread
+        """
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connection_type(
+                self.host, self.port, timeout=self.timeout)
+            with self.lock:
+                self.connections.append(self.local.connection)
+        return self.local.connection
+
+    def close_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def close_all(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send one request on the connection of this thread
+
+        :param method: HTTP method
+        :param path: path after the base path, with its query string
+        :param body: request body
+        :param headers: dictionary of request headers
+        :return: (HTTP status, response body)
+        :raise: one of CONNECTION_ERRORS when the connection is broken
+        """
+        connection = self.get_connection()
+        try:
+            connection.request(method, self.base_path + path, body,
+                               headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except CONNECTION_ERRORS:
+            self.close_connection()
+            raise
+
+
+def call_with_retries(function, retries, retry_delay, errors=(Exception,),
+                      on_error=None):
+    """
+    Call a function, retrying its failures with an exponential backoff:
+    wait 'retry_delay' seconds before the first retry and twice longer
+    before each next one.
+
+    :param function: function without arguments
+    :param retries: number of retries
+    :param retry_delay: second delay before the first retry
+    :param errors: exception types worth a retry
+    :param on_error: function called with the exception and the attempt
+     number, counted from 0, of each failure
+    :return: result of the function
+    :raise: the error of the last attempt
+    """
+    delay = retry_delay
+    for attempt in xrange(retries + 1):
+        if attempt > 0:
+            time.sleep(delay)
+            delay *= 2
+        try:
+            return function()
+        except errors as err:
+            if on_error is not None:
+                on_error(err, attempt)
+            if attempt == retries:
+                raise
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler keeping the connections alive, without logs.
+    """
+    # HTTP/1.1 keeps the connections alive
+    protocol_version = 'HTTP/1.1'
+    # The answer is written in several sends, without waiting for the
+    #  delayed acknowledgements
+    disable_nagle_algorithm = True
+
+    def send_body(self, status, body, content_type='application/json'):
+        """
+        Answer the request with a body
+
+        :param status: HTTP status
+        :param body: response body
+        :param content_type: content type of the body
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler_class, host='127.0.0.1', port=0):
+    """
+    Serve the requests from a daemon thread
+
+    :param handler_class: request handler class
+    :param host: listening address
+    :param port: listening port, 0 for a free port
+    :return: (the HTTP server, its url)
+    """
+    server = ThreadingHTTPServer((host, port), handler_class)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://{0}:{1}'.format(host, server.server_port)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+This file implements the raw ingest client of the publish tool. The static
+part of each metric time series, its metric type, metric name and
+dimensions, is encoded once into a template in the wire format of
+'/v2/datapoint'. Publishing a datapoint only splices its value and its
+timestamp into the template, and a request body is the concatenation of the
+encoded datapoints.
+
+- 'json' : {"gauge": [{"metric": ..., "dimensions": {...}, "value": ...,
+  "timestamp": ...}, ...], "counter": [...], "cumulative_counter": [...]}
+- 'protobuf' : DataPointUploadMessage of the signalfx protocol buffers,
+  encoded without the protobuf library
+"""
+import json
+import struct
+from src.http_util import CONNECTION_ERRORS
+from src.http_util import KeepAliveConnections
+
+INGEST_PATH = '/v2/datapoint'
+# Bucket of the send request -> wire name of the metric type
+BUCKET_NAMES = ['gauge', 'counter', 'cumulative_counter']
+# Bucket of the send request -> MetricType of the protocol buffers
+BUCKET_METRIC_TYPES = [0, 1, 3]
+# Repr of the floats without a json number
+NON_FINITE_FLOATS = frozenset(['nan', 'inf', '-inf'])
+DOUBLE = struct.Struct('<d')
+
+
+class IngestError(Exception):
+    pass
+
+
+def encode_varint(value):
+    """
+    Encode a non negative integer as a protocol buffers varint
+
+    :param value: integer
+    :return: string of bytes
+    """
+    result = []
+    while value > 0x7f:
+        result.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    result.append(chr(value))
+    return ''.join(result)
+
+
+def encode_field(number, data):
+    """
+    Encode a length-delimited protocol buffers field
+
+    :param number: field number
+    :param data: string of bytes
+    :return: string of bytes
+    """
+    return chr(number << 3 | 2) + encode_varint(len(data)) + data
+
+
+def to_utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class JsonEncoder(object):
+    """
+    Encode the datapoints into the json body of '/v2/datapoint'.
+    """
+    content_type = 'application/json'
+
+    def encode_template(self, bucket, metric, dimensions):
+        """
+        Encode the static part of a metric time series
+
+        :param bucket: bucket of the metric type
+        :param metric: metric name
+        :param dimensions: dimensions dictionary
+        :return: template of its datapoints
+        """
+        return '{{"metric": {0}, "dimensions": {1}, "value": '.format(
+            json.dumps(metric), json.dumps(dimensions, sort_keys=True))
+
+    def encode_timestamp(self, timestamp):
+        """
+        Encode the timestamp of the datapoints of a tick
+
+        :param timestamp: millisecond timestamp
+        :return: encoded timestamp
+        """
+        return ', "timestamp": {0}}}'.format(int(timestamp))
+
+    def encode_datapoint(self, template, value, timestamp):
+        """
+        Encode a datapoint
+
+        :param template: template of its metric time series
+        :param value: value
+        :param timestamp: encoded timestamp
+        :return: encoded datapoint, None for a NaN or infinite value
+        """
+        value = repr(float(value))
+        if value in NON_FINITE_FLOATS:
+            return None
+        return template + value + timestamp
+
+    def encode_body(self, buckets):
+        """
+        Encode the body of a request
+
+        :param buckets: lists of encoded datapoints by bucket
+        :return: request body
+        """
+        return '{' + ', '.join(
+            '"{0}": [{1}]'.format(BUCKET_NAMES[bucket], ', '.join(datapoints))
+            for bucket, datapoints in enumerate(buckets) if datapoints) + '}'
+
+
+class ProtobufEncoder(object):
+    """
+    Encode the datapoints into the protocol buffers body of '/v2/datapoint'.
+    The fields of a DataPoint message may come in any order, so the template
+    holds the metric, metric type and dimension fields, and each datapoint
+    appends its timestamp and value fields.
+    """
+    content_type = 'application/x-protobuf'
+
+    def encode_template(self, bucket, metric, dimensions):
+        """
+        Encode the static part of a metric time series
+
+        :param bucket: bucket of the metric type
+        :param metric: metric name
+        :param dimensions: dimensions dictionary
+        :return: template of its datapoints
+        """
+        template = encode_field(2, to_utf8(metric)) + \
+            chr(5 << 3) + encode_varint(BUCKET_METRIC_TYPES[bucket])
+        for key, value in sorted(dimensions.items()):
+            template += encode_field(6, encode_field(1, to_utf8(key)) +
+                                     encode_field(2, to_utf8(value)))
+        return template
+
+    def encode_timestamp(self, timestamp):
+        """
+        Encode the timestamp of the datapoints of a tick
+
+        :param timestamp: millisecond timestamp
+        :return: encoded timestamp
+        """
+        return chr(3 << 3) + encode_varint(int(timestamp))
+
+    def encode_datapoint(self, template, value, timestamp):
+        """
+        Encode a datapoint, as a field of the DataPointUploadMessage
+
+        :param template: template of its metric time series
+        :param value: value
+        :param timestamp: encoded timestamp
+        :return: encoded datapoint
+        """
+        # value: Datum with the double value field
+        return encode_field(1, template + timestamp + '\x22\x09\x11' +
+                            DOUBLE.pack(value))
+
+    def encode_body(self, buckets):
+        """
+        Encode the body of a request
+
+        :param buckets: lists of encoded datapoints by bucket
+        :return: request body
+        """
+        return ''.join(''.join(datapoints) for datapoints in buckets)
+
+
+ENCODERS = {
+    'json': JsonEncoder,
+    'protobuf': ProtobufEncoder
+}
+
+
+class RawIngestClient(object):
+    """
+    Ingest client posting the datapoints encoded by 'encoder'. It has the
+    same 'send' method as the signalfx client, taking lists of encoded
+    datapoints. Each request is posted at once on a keep-alive connection of
+    the calling thread, and a failed request raises an IngestError.
+
+    :param api_token: api_token for publishing data
+    :param ingest_endpoint: ingest url
+    :param encoder: JsonEncoder or ProtobufEncoder
+    :param timeout: second timeout of the connections
+    """
+
+    def __init__(self, api_token, ingest_endpoint, encoder, timeout=10):
+        try:
+            self.connections = KeepAliveConnections(ingest_endpoint, timeout)
+        except ValueError:
+            raise IngestError("ingest_endpoint '{0}' is not a http or https "
+                              "url".format(ingest_endpoint))
+        self.headers = {'X-SF-Token': api_token,
+                        'Content-Type': encoder.content_type,
+                        'User-Agent': 'replay'}
+        self.encoder = encoder
+
+    def send(self, gauges=None, counters=None, cumulative_counters=None):
+        buckets = (gauges or [], counters or [], cumulative_counters or [])
+        if not any(buckets):
+            return
+        body = self.encoder.encode_body(buckets)
+        try:
+            status, answer = self.connections.request('POST', INGEST_PATH,
+                                                      body, self.headers)
+        except CONNECTION_ERRORS as err:
+            raise IngestError(str(err))
+        if status != 200:
+            raise IngestError('HTTP {0}: {1}'.format(status, answer[:200]))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+This file implements a local stand-in for the ingest endpoint. It accepts
+the '/v2/datapoint' requests of the signalfx client, in json or protocol
+buffers, and counts the requests, bytes and datapoints, so the publish tool
+can be measured without sending data to a real organization.
+"""
+import json
+import threading
+import time
+import zlib
+from src.http_util import KeepAliveHandler
+from src.http_util import start_server
+
+try:
+    from signalfx.generated_protocol_buffers import \
+        signal_fx_protocol_buffers_pb2 as protocol_buffers
+except ImportError:
+    protocol_buffers = None
+
+
+def count_datapoints(body, content_type):
+    """
+    Count the datapoints of a request body
+
+    :param body: request body
+    :param content_type: content type of the body
+    :return: number of datapoints, None if the body cannot be decoded
+    """
+    if 'json' in content_type:
+        try:
+            return sum(len(datapoints)
+                       for datapoints in json.loads(body).values())
+        except (ValueError, AttributeError, TypeError):
+            return None
+    if protocol_buffers is not None:
+        message = protocol_buffers.DataPointUploadMessage()
+        try:
+            message.ParseFromString(body)
+        except Exception:
+            return None
+        return len(message.datapoints)
+    return None
+
+
+class StubIngestServer(object):
+    """
+    Stand-in ingest endpoint, listening on a free local port from a daemon
+    thread. Use 'url' as the ingest endpoint of the publish tool.
+
+    :param latency: seconds spent by each request
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.datapoints = 0
+        self.undecoded_requests = 0
+        stub = self
+
+        class StubIngestHandler(KeepAliveHandler):
+            def do_POST(self):
+                body = self.rfile.read(
+                    int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                stub.receive(body, self.headers.get('Content-Type', ''))
+                self.send_body(200, '"OK"')
+
+        self.server, self.url = start_server(StubIngestHandler)
+
+    def receive(self, body, content_type):
+        """
+        Count one request
+
+        :param body: request body
+        :param content_type: content type of the body
+        """
+        time.sleep(self.latency)
+        datapoints = count_datapoints(body, content_type)
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(body)
+            if datapoints is None:
+                self.undecoded_requests += 1
+            else:
+                self.datapoints += datapoints
+
+    def get_stats(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'bytes': self.bytes,
+                    'datapoints': self.datapoints,
+                    'undecoded_requests': self.undecoded_requests}
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+This file implements the metadata fetcher of the record tool. The metric
+time series of each query are paged through '/v1/metrictimeseries' with
+'offset' and 'limit'. The queries and their pages are fetched by a pool of
+threads, each one keeping its own keep-alive connection to the API server.
+The transient failures are retried with an exponential backoff, and a
+metric time series matched by several queries is kept once.
+"""
+import json
+import threading
+import urllib
+from multiprocessing.pool import ThreadPool
+from src.http_util import CONNECTION_ERRORS
+from src.http_util import KeepAliveConnections
+from src.http_util import call_with_retries
+from src.util import Error
+
+METADATA_PATH = '/v1/metrictimeseries'
+# HTTP status of the failures worth a retry
+TRANSIENT_STATUS = [429, 500, 502, 503, 504]
+
+
+class TransientError(Exception):
+    pass
+
+
+def filter_sf(raw_metadata):
+    """
+    Get the dimensions of a metric time series, without the sf properties
+
+    :param raw_metadata: metric time series of the API result
+    :return: dimensions dictionary
+    """
+    result = {}
+    for key, value in raw_metadata.items():
+        if not key.startswith('sf') and not key.startswith('_sf'):
+            result[key] = value
+    return result
+
+
+class MetadataFetcher(object):
+    """
+    Fetch the metadata of the metric time series matched by queries.
+
+    :param api_server: API server url
+    :param record_token: access token of the API server
+    :param workers: number of threads fetching pages
+    :param page_size: number of metric time series in one page
+    :param retries: number of retries of a failed page
+    :param retry_delay: second delay before the first retry
+    :param timeout: second timeout of the connections
+    """
+
+    def __init__(self, api_server, record_token, workers=1, page_size=1000,
+                 retries=3, retry_delay=0.5, timeout=60):
+        try:
+            self.connections = KeepAliveConnections(api_server, timeout)
+        except ValueError:
+            raise Error("api_server '{0}' is not a http or https url".format(
+                api_server))
+        self.record_token = record_token
+        self.workers = workers
+        self.page_size = page_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried_requests = 0
+
+    def request_page(self, query, offset):
+        """
+        Request one page of a query once
+
+        :param query: query sentence
+        :param offset: offset of the page
+        :return: decoded json result
+        """
+        path = '{0}?{1}'.format(METADATA_PATH,
+                                urllib.urlencode([('query', query),
+                                                  ('offset', offset),
+                                                  ('limit', self.page_size)]))
+        with self.lock:
+            self.requests += 1
+        try:
+            status, body = self.connections.request(
+                'GET', path, headers={'X-SF-TOKEN': self.record_token})
+        except CONNECTION_ERRORS as err:
+            raise TransientError(str(err))
+        if status in TRANSIENT_STATUS:
+            raise TransientError('HTTP {0}'.format(status))
+        if status != 200:
+            raise Error("Query '{0}' failed with HTTP {1}, please check your "
+                        "record token and query sentences".format(
+                            query, status))
+        try:
+            result = json.loads(body)
+        except ValueError:
+            raise TransientError('invalid json result')
+        if not isinstance(result, dict) or 'rs' not in result:
+            raise Error("Query '{0}' result has no 'rs' list".format(query))
+        return result
+
+    def fetch_page(self, task):
+        """
+        Fetch one page of a query, retrying the transient failures
+
+        :param task: (query, offset)
+        :return: decoded json result
+        """
+        query, offset = task
+
+        def count_retry(err, attempt):
+            if attempt < self.retries:
+                with self.lock:
+                    self.retried_requests += 1
+
+        try:
+            return call_with_retries(
+                lambda: self.request_page(query, offset), self.retries,
+                self.retry_delay, TransientError, count_retry)
+        except TransientError as err:
+            raise Error("Cannot get metadata of query '{0}' at offset {1}: "
+                        "{2}".format(query, offset, err))
+
+    def fetch_pages(self, pool, tasks):
+        """
+        Fetch pages in the order of the tasks
+
+        :param pool: pool of threads, None to fetch in this thread
+        :param tasks: list of (query, offset)
+        :return: list of decoded json results
+        """
+        if pool is None:
+            return map(self.fetch_page, tasks)
+        return pool.map(self.fetch_page, tasks, chunksize=1)
+
+    def fetch(self, query_list):
+        """
+        Fetch the metadata of all queries. The first page of each query gives
+        its number of results and page size, then all next pages are fetched
+        at once. A query answered without its number of results is paged
+        until a page is shorter than the first one.
+
+        :param query_list: list of query sentences
+        :return: Dictionary of metric id to metadata
+        """
+        pool = ThreadPool(self.workers) if self.workers > 1 else None
+        try:
+            first_pages = self.fetch_pages(pool, [(query, 0)
+                                                  for query in query_list])
+            tasks = []
+            steps = {}
+            for query, page in zip(query_list, first_pages):
+                # The server may answer smaller pages than asked
+                step = min(self.page_size, len(page['rs'])) or self.page_size
+                if 'count' in page:
+                    tasks += [(query, offset) for offset
+                              in xrange(step, page['count'], step)]
+                elif len(page['rs']) >= step:
+                    steps[query] = step
+            pages = {}
+            for task, page in zip(tasks, self.fetch_pages(pool, tasks)):
+                pages.setdefault(task[0], []).append(page)
+            # Without a count, fetch the next page of each unfinished query
+            #  at once until its pages run out
+            offsets = steps.copy()
+            while offsets:
+                tasks = sorted(offsets.items())
+                for (query, offset), page in zip(
+                        tasks, self.fetch_pages(pool, tasks)):
+                    pages.setdefault(query, []).append(page)
+                    if len(page['rs']) < steps[query]:
+                        del offsets[query]
+                    else:
+                        offsets[query] = offset + steps[query]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self.connections.close_all()
+
+        metadata_dict = {}
+        for query, first_page in zip(query_list, first_pages):
+            for page in [first_page] + pages.get(query, []):
+                for raw_metadata in page['rs']:
+                    metric_id = str(raw_metadata['sf_id'])
+                    if metric_id in metadata_dict:
+                        continue
+                    metadata_dict[metric_id] = {
+                        'sf_metricType': raw_metadata['sf_metricType'],
+                        'sf_metric': raw_metadata['sf_metric'],
+                        'dimensions': filter_sf(raw_metadata)
+                    }
+        return metadata_dict
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+This file implements the metric table of the publish tool. The metadata is
+compiled once into dense columns by metric index, so that publishing a
+datapoint only costs array lookups.
+"""
+from src.util import get_metric_ids
+from src.util import get_metric_shard
+from src.util import set_metric_indexes
+
+# Metric type -> bucket of the datapoint in the send request
+METRIC_TYPE_BUCKET = {
+    'GAUGE': 0,
+    'COUNTER': 1,
+    'CUMULATIVE_COUNTER': 2
+}
+BUCKET_NUMBER = 3
+
+
+class FrozenDict(dict):
+    """
+    Read-only dictionary, shared by all datapoints of a metric.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('FrozenDict is read-only')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+class MetricTable(object):
+    """
+    Metadata compiled into columns by metric index.
+
+    - metric_ids : metric id
+    - buckets : bucket of the metric type, None for unknown types and for
+      metrics of other shards
+    - metric_names : metric name
+    - dimensions : FrozenDict of dimensions
+    - templates : pre-encoded static part of the datapoints, None until
+      'encode_templates' is called
+
+    :param metadata: metadata dictionary loaded from metadata.json
+    :param shard: (shard index, shard count), only the metrics of this
+     shard are published
+    """
+
+    def __init__(self, metadata, shard=(0, 1)):
+        set_metric_indexes(metadata)
+        self.metric_ids = get_metric_ids(metadata)
+        self.metric_index = dict((metric_id, index) for index, metric_id
+                                 in enumerate(self.metric_ids))
+        self.buckets = []
+        self.metric_names = []
+        self.dimensions = []
+        self.templates = None
+        self.encoder = None
+        self.shard_size = 0
+        shard_index, shard_count = shard
+        for metric_id in self.metric_ids:
+            if metric_id is None or \
+                    get_metric_shard(metric_id, shard_count) != shard_index:
+                self.buckets.append(None)
+                self.metric_names.append(None)
+                self.dimensions.append(None)
+                continue
+            value = metadata[metric_id]
+            self.shard_size += 1
+            self.buckets.append(METRIC_TYPE_BUCKET.get(value['sf_metricType']))
+            self.metric_names.append(str(value['sf_metric']))
+            self.dimensions.append(FrozenDict(value['dimensions']))
+
+    def encode_templates(self, encoder):
+        """
+        Encode the static part of the datapoints of each published metric
+
+        :param encoder: JsonEncoder or ProtobufEncoder of the ingest client
+        """
+        self.encoder = encoder
+        self.templates = [
+            None if bucket is None else
+            encoder.encode_template(bucket, metric_name, dimensions)
+            for bucket, metric_name, dimensions in zip(
+                self.buckets, self.metric_names, self.dimensions)]
+
+    def __len__(self):
+        return len(self.metric_ids)
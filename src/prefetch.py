@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+This file implements the slot file prefetcher of the publish tool. A
+background thread opens, parses and sorts the next slot files while the
+current one is replaying, so a slot transition costs no parse time.
+"""
+import threading
+import time
+import Queue
+from src.util import get_next_time_series_file_path
+from src.archive import DirectorySource
+
+
+class SlotPrefetcher(object):
+    """
+    Open the slot files in replay order, up to 'depth' files ahead of the
+    publish loop. A depth of 0 opens each slot file when it is asked for.
+
+    :param first_path: path of the first slot file
+    :param metric_index: map of metric id to metric index
+    :param interval: second interval of each file
+    :param time_range: time range
+    :param depth: number of slot files loaded ahead
+    :param parse_histogram: Histogram observing the open time of each file
+    :param source: DirectorySource or ArchiveReader holding the slot files
+    """
+
+    def __init__(self, first_path, metric_index, interval, time_range,
+                 depth, parse_histogram=None, source=None):
+        self.path = first_path
+        self.source = source or DirectorySource()
+        self.parse_histogram = parse_histogram
+        self.metric_index = metric_index
+        self.interval = interval
+        self.time_range = time_range
+        self.depth = depth
+        if depth > 0:
+            # The bounded queue blocks the loader when it is 'depth' files
+            #  ahead, which bounds the memory of the prefetched slots.
+            self.queue = Queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def load_next(self):
+        """
+        Open the next slot file in replay order
+
+        :return: (path, slot or None if the file does not exist, error)
+        """
+        path = self.path
+        self.path = get_next_time_series_file_path(path, self.interval,
+                                                   self.time_range)
+        if not self.source.exists(path):
+            return path, None, None
+        start = time.time()
+        try:
+            slot = self.source.open_slot(path, self.metric_index)
+        except Exception as err:
+            return path, None, err
+        if self.parse_histogram is not None:
+            self.parse_histogram.observe(time.time() - start)
+        return path, slot, None
+
+    def run(self):
+        while True:
+            self.queue.put(self.load_next())
+
+    def next_slot(self):
+        """
+        Get the next slot file in replay order. An error raised while
+        loading the file is raised here.
+
+        :return: (path, slot or None if the file does not exist)
+        """
+        if self.depth > 0:
+            # Wait with a timeout, so the main thread stays interruptible
+            while True:
+                try:
+                    path, slot, err = self.queue.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    continue
+        else:
+            path, slot, err = self.load_next()
+        if err is not None:
+            raise err
+        return path, slot
@@ -5,59 +5,50 @@ This file implements all functions about publishing data.
 import signalfx
 import json
 import logging
-import os
 import time
 
-from time import sleep
+from src.util import Error
 from src.util import TS_DATA_DIR
 from src.util import METADATA_FILE
 from src.util import CONFIG_FILE
 from src.util import TIME_INFOR
+from src.util import SLOT_SUFFIX
 from src.util import get_new_interval_information
-from src.util import get_second_shift
-from src.util import get_next_time_series_file_path
 from src.util import check_data_dir
 from src.util import read_record_config
 from src.util import check_record_config
+from src.util import check_publish_options
+from src.util import get_publish_targets
 from src.util import get_time_series_file_path
+from src.prefetch import SlotPrefetcher
+from src.sender import AsyncSender
+from src.sender import FanoutSender
+from src.replay_clock import ReplayClock
+from src.scheduler import TickScheduler
+from src.metric_table import MetricTable
+from src.archive import ARCHIVE_ROOT
+from src.archive import ArchiveReader
+from src.archive import DirectorySource
+from src.archive import is_archive
+from src.stats import PublisherStats
+from src.stats import InstrumentedClient
+from src.stats import start_stats_server
+from src.stats import start_self_reporter
+from src.ingest_client import ENCODERS
+from src.ingest_client import IngestError
+from src.ingest_client import RawIngestClient
 
 
-def send_signal_time_data(data, metadata, client, verbose):
+def send_metrics(client, bucket_metrics, verbose):
     """
-    Send data in one timestamp
+    Send one request of data items
 
-    :param data: Time seies data need to publish
-    :param metadata: Metadata need to construct the new time series data
     :param client: Signalfx client to publish data
+    :param bucket_metrics: (gauges, counters, cumulative counters) lists
+    :param verbose: verbose log
     """
-
-    gauges_metrics = []
-    counter_metrics = []
-    cumulative_counter_metrics = []
-
-    def construct_single_data(single_data):
-        """
-        Construct a data item to with time series data value and meta data
-
-        :param single_data: raw time series data
-        """
-        metric_id = str(single_data['id'])
-        time_stamp = time.time() * 1000
-        metric = {
-            'metric': str(metadata[metric_id]['sf_metric']),
-            'value': single_data['value'],
-            'timestamp': time_stamp,
-            'dimensions': metadata[metric_id]['dimensions']
-        }
-        if metadata[metric_id]['sf_metricType'] == 'GAUGE':
-            gauges_metrics.append(metric)
-        elif metadata[metric_id]['sf_metricType'] == 'COUNTER':
-            counter_metrics.append(metric)
-        elif metadata[metric_id]['sf_metricType'] == 'CUMULATIVE_COUNTER':
-            cumulative_counter_metrics.append(metric)
-
-    # Construct all data items
-    map(construct_single_data, data)
+    gauges_metrics, counter_metrics, cumulative_counter_metrics = \
+        bucket_metrics
     if verbose:
         logging.info('gauges_metrics: {0}'.format(len(gauges_metrics)))
         logging.info('counter_metrics: {0}'.format(len(counter_metrics)))
@@ -76,98 +67,320 @@ def send_signal_time_data(data, metadata, client, verbose):
         logging.error({"Send Data Error": err.message})
 
 
-def publish_one_file_data(client, metadata, tsdata_file, publish_dict):
+def send_signal_time_data(ticks, metric_table, client, verbose,
+                          max_batch_size=0):
+    """
+    Send data of one or several timestamps. The data of all timestamps are
+    merged into one request, split every 'max_batch_size' data items. No
+    request is sent without data items.
+
+    :param ticks: list of (data, millisecond timestamp of the data), data
+     are (metric index, value) pairs
+    :param metric_table: MetricTable to construct the new time series data,
+     the datapoints are pre-encoded when it has templates
+    :param client: Signalfx client or raw ingest client to publish data
+    :param verbose: verbose log
+    :param max_batch_size: maximum number of data items in one request,
+     0 for no limit
     """
-    Publish all data from one file
+    buckets = metric_table.buckets
+    metric_names = metric_table.metric_names
+    dimensions = metric_table.dimensions
+    templates = metric_table.templates
+    encoder = metric_table.encoder
+    bucket_metrics = ([], [], [])
+    size = 0
+
+    # Construct all data items
+    for data, time_stamp in ticks:
+        if templates is not None:
+            # Splice the value and the timestamp into the templates
+            encoded_time_stamp = encoder.encode_timestamp(time_stamp)
+        for index, value in data:
+            bucket = buckets[index]
+            if bucket is None:
+                continue
+            if templates is None:
+                bucket_metrics[bucket].append({
+                    'metric': metric_names[index],
+                    'value': value,
+                    'timestamp': time_stamp,
+                    'dimensions': dimensions[index]
+                })
+            else:
+                datapoint = encoder.encode_datapoint(
+                    templates[index], value, encoded_time_stamp)
+                if datapoint is None:
+                    # The value cannot be encoded
+                    continue
+                bucket_metrics[bucket].append(datapoint)
+            size += 1
+            if size == max_batch_size:
+                send_metrics(client, bucket_metrics, verbose)
+                bucket_metrics = ([], [], [])
+                size = 0
+    if size > 0:
+        send_metrics(client, bucket_metrics, verbose)
+
+
+def get_batch_ticks(tsdata, next_index, publish_dict):
+    """
+    Get the data of the timestamps sent in one batch: the timestamp at
+    'next_index', the next ones within 'batch_window' seconds and, with the
+    'merge' late policy, the next ones which are already late, while the
+    batch is smaller than 'max_batch_size'. With the 'skip' late policy, the
+    next late ones are dropped. Each timestamp is stamped on the real time it
+    is due.
+
+    :param tsdata: opened time series data file
+    :param next_index: index of the first timestamp of the batch
+    :param publish_dict: publish dictionary
+    :return: (list of (data, millisecond timestamp), index after the batch)
+    """
+    clock = publish_dict['clock']
+    scheduler = publish_dict['scheduler']
+    time_series = tsdata.time_series
+    first_second_shift = time_series[next_index]
+    ticks = []
+    size = 0
+    while next_index < len(time_series):
+        second_shift = time_series[next_index]
+        lateness = scheduler.get_lateness(second_shift)
+        merged = False
+        if ticks:
+            if size >= publish_dict['max_batch_size'] > 0:
+                break
+            merged = scheduler.late_policy == 'merge' and \
+                scheduler.is_late(lateness)
+            if not merged and \
+                    second_shift - first_second_shift >= \
+                    publish_dict['batch_window']:
+                break
+            if scheduler.late_policy == 'skip' and \
+                    scheduler.is_late(lateness):
+                # Drop the late time stamp
+                scheduler.report_tick(lateness, skipped=True)
+                logging.warning("Skip time stamp {0:.3f} seconds "
+                                "late".format(lateness))
+                next_index += 1
+                continue
+        scheduler.report_tick(lateness, merged=merged)
+        data = tsdata.get_data(next_index)
+        ticks.append((data, clock.timestamp_ms(-lateness)))
+        size += len(data)
+        next_index += 1
+    return ticks, next_index
+
+
+def publish_one_file_data(client, metric_table, tsdata, publish_dict):
+    """
+    Publish all data from one file. Each timestamp is due at an absolute
+    replay time anchored when the file is opened.
 
     :param client: signalfx client
-    :param metadata: metadata information
+    :param metric_table: MetricTable of the metadata
+    :param tsdata: opened time series data file
     :param publish_dict: publish dictionary
-    :param tsdata_file: time series data file
     """
-    # Open the time series data file and load ts data
-    with open(tsdata_file) as tsdata_file:
-        tsdata = json.load(tsdata_file)
-
-        # Sort the time stamp
-        time_series = map(int, tsdata.keys())
-        time_series.sort()
-        # Get new Information
-        current_second_shift, next_index = get_new_interval_information(
-            time_series, publish_dict['interval'], publish_dict['time_range'])
-
-    while next_index < len(tsdata):
-        sleep(time_series[next_index] - current_second_shift)
+    clock = publish_dict['clock']
+    scheduler = publish_dict['scheduler']
+
+    # Time stamps are sorted
+    time_series = tsdata.time_series
+    # Get new Information
+    current_time = clock.time()
+    current_second_shift, next_index = get_new_interval_information(
+        time_series, publish_dict['interval'], publish_dict['time_range'],
+        current_time)
+    scheduler.start_slot(current_time, current_second_shift)
+
+    while next_index < len(time_series):
+        lateness = scheduler.wait(time_series[next_index])
+        if scheduler.late_policy == 'skip' and scheduler.is_late(lateness):
+            # Drop the late time stamp
+            scheduler.report_tick(lateness, skipped=True)
+            logging.warning("Skip time stamp {0:.3f} seconds late".format(
+                lateness))
+            next_index += 1
+            continue
         logging.info("{current_time} ==> Current time.".format(
-            current_time=time.ctime(time.time())))
+            current_time=time.ctime(clock.time())))
         if publish_dict['verbose']:
             logging.info("{old_time} ==> Old time.".format(old_time=time.ctime(
-                int(tsdata[str(time_series[next_index])]['old_time']))))
-        # Send all data at this time stamp
-        send_signal_time_data(tsdata[str(time_series[next_index])]['data'],
-                              metadata, client, publish_dict['verbose'])
-        next_index += 1
-        current_second_shift = get_second_shift(time.time(),
-                                                publish_dict['time_range'])
+                tsdata.get_old_time(next_index))))
+            logging.info("{lateness:.3f} ==> Lateness.".format(
+                lateness=lateness))
+        # Send all data at this time stamp and the next ones of the batch
+        ticks, next_index = get_batch_ticks(tsdata, next_index, publish_dict)
+        send_signal_time_data(ticks, metric_table, client,
+                              publish_dict['verbose'],
+                              publish_dict['max_batch_size'])
 
 
 def publish_tsdata(publish_dict):
     """
     Publish the new time series data based on the old time series data
-     and meta data.
+     and meta data. It publishes forever, or 'max_slots' time series files.
 
     :param publish_dict: Publish information dictionary
+    :return: stats dictionary of the publisher, after 'max_slots' files
     """
 
-    # Load the meta data
-    with open(publish_dict['metadata_path']) as metadata_file:
-        metadata = json.load(metadata_file)
-    # print(metadata)
+    # Load the meta data and compile it by metric index
+    metric_table = MetricTable(publish_dict['metadata'],
+                               publish_dict['shard'])
+    logging.info('Shard {0}/{1}: publish {2} of {3} metrics'.format(
+        publish_dict['shard'][0], publish_dict['shard'][1],
+        metric_table.shard_size, len(metric_table)))
+
+    # Statistics of the publisher. The signalfx client batches and sends
+    #  from its own thread, so only the raw client sends are measured
+    stats = PublisherStats(publish_dict['ingest_format'] != 'client')
+
+    # Encode the static part of the datapoints once for the raw client
+    if publish_dict['ingest_format'] != 'client':
+        metric_table.encode_templates(
+            ENCODERS[publish_dict['ingest_format']]())
 
-    # Launch a client to send data to SignalFx
-    client = signalfx.SignalFx(publish_dict['api_token'],
-                               ingest_endpoint=publish_dict['ingest_endpoint'])
+    # Launch a client for each target to send data to SignalFx
+    senders = []
+    for number, (api_token, ingest_endpoint) in \
+            enumerate(publish_dict['targets']):
+        if metric_table.encoder is None:
+            # The signalfx client splits its queue into its own requests
+            client_options = {'ingest_endpoint': ingest_endpoint}
+            if publish_dict['max_batch_size'] > 0:
+                client_options['batch_size'] = publish_dict['max_batch_size']
+            client = signalfx.SignalFx(api_token, **client_options)
+        else:
+            try:
+                client = RawIngestClient(api_token, ingest_endpoint,
+                                         metric_table.encoder)
+            except IngestError as err:
+                raise Error(err.message)
+        client = InstrumentedClient(client, stats)
+        if metric_table.encoder is not None and publish_dict['senders'] > 0:
+            # Send from a pool of threads, off the replay loop
+            client = AsyncSender(client, publish_dict['senders'],
+                                 publish_dict['max_in_flight'],
+                                 publish_dict['backpressure'],
+                                 publish_dict['retries'],
+                                 name='{0}#{1}'.format(ingest_endpoint,
+                                                       number))
+        senders.append(client)
+    client = senders[0] if len(senders) == 1 else FanoutSender(senders)
+    if metric_table.encoder is not None and publish_dict['senders'] > 0:
+        stats.add_gauge('queue_depth', lambda: sum(
+            sender.get_queue_depth() for sender in senders))
+
+    # Replay time, faster than real time in accelerated replay
+    clock = ReplayClock(publish_dict['speed'], publish_dict['max_rate'],
+                        publish_dict['replay_start'])
+    publish_dict['clock'] = clock
+    # Deadlines of the time stamps
+    scheduler = TickScheduler(clock, publish_dict['late_policy'],
+                              publish_dict['late_tolerance'],
+                              stats.schedule_lag)
+    publish_dict['scheduler'] = scheduler
+    stats.add_gauge('schedule', scheduler.get_stats)
+
+    if publish_dict['stats_port'] > 0:
+        start_stats_server(stats, publish_dict['stats_host'],
+                           publish_dict['stats_port'])
+        logging.info('Serve stats on {0}:{1}'.format(
+            publish_dict['stats_host'], publish_dict['stats_port']))
+    if publish_dict['self_report'] > 0:
+        # Report with a separate client to the first target, so the
+        #  reports are not counted in the stats
+        api_token, ingest_endpoint = publish_dict['targets'][0]
+        start_self_reporter(
+            stats,
+            signalfx.SignalFx(api_token, ingest_endpoint=ingest_endpoint),
+            publish_dict['self_report'],
+            {'replay_shard': '{0}/{1}'.format(*publish_dict['shard'])})
 
     # Get specific time series file
-    tsdata_file = get_time_series_file_path(time.time(),
+    tsdata_file = get_time_series_file_path(clock.time(),
                                             publish_dict['interval'],
                                             publish_dict['time_range'],
                                             publish_dict['ts_directory'],
-                                            'json')
+                                            SLOT_SUFFIX[
+                                                publish_dict['slot_format']])
+
+    # Open, parse and sort the next time series files ahead of time
+    slots = SlotPrefetcher(tsdata_file, metric_table.metric_index,
+                           publish_dict['interval'],
+                           publish_dict['time_range'],
+                           publish_dict['prefetch'],
+                           stats.slot_parse_time,
+                           publish_dict['source'])
 
-    while True:
-        if os.path.exists(tsdata_file):
+    slot_number = 0
+    while publish_dict['max_slots'] == 0 or \
+            slot_number < publish_dict['max_slots']:
+        slot_number += 1
+        # Get the next time series file
+        tsdata_file, tsdata = slots.next_slot()
+        if slot_number == 1 and publish_dict['replay_start'] is not None:
+            # Start the replay once the first file is loaded
+            clock.restart(publish_dict['replay_start'])
+        if tsdata is not None:
             # Publish time series data of one file
-            publish_one_file_data(client, metadata, tsdata_file, publish_dict)
+            publish_one_file_data(client, metric_table, tsdata, publish_dict)
         else:
             # If this file cannot exist, it is means no any data in this
             #  time slot, so sleep a time interval.
-            sleep(TIME_INFOR[publish_dict['time_range']]['second_range'])
+            clock.sleep(
+                TIME_INFOR[publish_dict['time_range']]['second_range'])
 
-        # Get the next time series file
-        tsdata_file = get_next_time_series_file_path(tsdata_file,
-                                                     publish_dict['interval'],
-                                                     publish_dict['time_range']
-                                                     )
+    # Wait for the queued requests
+    for sender in senders:
+        if isinstance(sender, AsyncSender):
+            sender.flush()
+    return stats.get_stats()
 
 
-def publish_data(data_dir, api_token, ingest_endpoint, logfile, verbose):
+def publish_data(data_dir, api_token, ingest_endpoint, logfile, verbose,
+                 replay_start=None, **options):
     """
     Send the metric from json configuration file
 
-    :param config_file: The configuration json file
+    :param data_dir: record data directory, or indexed record archive
+    :param api_token: api_token or list of api_tokens for publishing data
+    :param ingest_endpoint: ingest url or list of ingest urls for publishing
+     data, paired with the api_tokens
+    :param logfile: log file path
+    :param verbose: verbose log file
+    :param replay_start: replay second time the publisher starts at once
+     its first time series data file is loaded, default is now
+    :param options: publish options of PUBLISH_OPTION_PATTERN
+    :return: stats dictionary of the publisher, after 'max_slots' files
     """
-    # Open the json configuration file
-    check_data_dir(data_dir)
-    config = read_record_config(data_dir + '/' + CONFIG_FILE)
+    if is_archive(data_dir):
+        # Read the members of the archive lazily, without extracting it
+        source = ArchiveReader(data_dir)
+        slot_format = source.check_data()
+        config = source.read_json(ARCHIVE_ROOT + '/' + CONFIG_FILE)
+        metadata = source.read_json(ARCHIVE_ROOT + '/' + METADATA_FILE)
+        data_dir = ARCHIVE_ROOT
+    else:
+        source = DirectorySource()
+        # Open the json configuration file
+        slot_format = check_data_dir(data_dir)
+        config = read_record_config(data_dir + '/' + CONFIG_FILE)
+        with open(data_dir + '/' + METADATA_FILE) as metadata_file:
+            metadata = json.load(metadata_file)
     publish_dict = check_record_config(config)
-    publish_dict['api_token'] = api_token
-    publish_dict['ingest_endpoint'] = ingest_endpoint
+    publish_dict['slot_format'] = slot_format
+    publish_dict['source'] = source
+    publish_dict['metadata'] = metadata
+    publish_dict['targets'] = get_publish_targets(api_token, ingest_endpoint)
     publish_dict['ts_directory'] = data_dir + '/' + TS_DATA_DIR
-    publish_dict['metadata_path'] = data_dir + '/' + METADATA_FILE
     publish_dict['verbose'] = verbose
+    publish_dict['replay_start'] = replay_start
+    publish_dict.update(check_publish_options(options))
     if logfile is not None:
         logging.basicConfig(filename=str(logfile), level=logging.INFO)
 
     print("Start sending data ...")
-    publish_tsdata(publish_dict)
+    return publish_tsdata(publish_dict)
@@ -2,14 +2,14 @@
 """
 This file implements all funcitons about download time series data and
 convert raw time series data file to json time series data file.
+The conversion itself lives in convert_data.py.
 """
+import glob
 import json
 import os
-import glob
-import tarfile
-import urllib2
-import urllib
 import shutil
+import threading
+from multiprocessing.pool import ThreadPool
 from tsdb import TsdbWrapper
 from sf.timeseries.ttypes import MetricTimeSeriesRollup
 from sf.id.ttypes import ID
@@ -19,11 +19,27 @@ import struct
 from sf.datamodel.ttypes import RollupType
 from src.util import Error
 from src.util import TAR_NAME
-from src.util import get_second_shift
 from src.util import read_record_config
 from src.util import check_record_config
 from src.util import create_folder_path
 from src.util import get_time_series_file_path
+from src.util import set_metric_indexes
+from src.util import SLOT_INDEX_SUFFIX
+from src.util import SLOT_SUFFIX
+from src.util import check_data_dir
+from src.record_journal import RecordJournal
+from src.record_journal import get_config_fingerprint
+from src.record_journal import read_journal_fingerprint
+from src.record_journal import truncate_partial_lines
+from src.metadata import MetadataFetcher
+from src.archive import ArchiveWriter
+from src.tsdb_pool import TsdbConnectionPool
+from src.chunk_planner import ChunkPlanner
+from src.convert_data import convert_all_time_series_data
+from src.vectorized import check_numpy
+from src.downsample import align_chunk_end
+from src.downsample import downsample_time_series
+from src.vectorized import group_time_values
 
 
 # WEEK_SECONDS = 7 * 24 * 60 * 60
@@ -34,6 +50,43 @@ ROLLUP = {
     "CUMULATIVE_COUNTER": RollupType.MAX_ROLLUP
 }
 
+# Clients of the time series data servers, recycled across requests
+TSDB_POOL = TsdbConnectionPool(
+    lambda server: TsdbWrapper.TsdbWrapper(host=server))
+
+# Time windows of the time series data requests
+CHUNK_PLANNER = ChunkPlanner()
+
+# One lock per raw time series data file, so that the parallel download
+#  workers never interleave their appends into the same slot file.
+SLOT_FILE_LOCKS = {}
+SLOT_FILE_LOCKS_GUARD = threading.Lock()
+
+
+def get_slot_file_lock(file_path):
+    """
+    Get the lock protecting the appends into one raw time series data file
+
+    :param file_path: raw time series data file path
+    :return: lock of this file
+    """
+    with SLOT_FILE_LOCKS_GUARD:
+        if file_path not in SLOT_FILE_LOCKS:
+            SLOT_FILE_LOCKS[file_path] = threading.Lock()
+        return SLOT_FILE_LOCKS[file_path]
+
+
+def append_ts_data_file(file_path, lines):
+    """
+    Append lines into a raw time series data file under its lock
+
+    :param file_path: raw time series data file path
+    :param lines: lines of raw time series data
+    """
+    with get_slot_file_lock(file_path):
+        with open(file_path, 'a') as time_series_file:
+            time_series_file.writelines(lines)
+
 
 def base642long(base64str):
     """
@@ -63,88 +116,168 @@ def to_id(value):
         return ID(base642long(value))
 
 
-def get_metadata(api_server, query_list, record_token):
+def get_metadata(record_dict):
+    """
+    Get the metadata of the metric time series matched by the queries
 
-    def filter_sf(raw_metadata):
-        result = {}
-        for key, value in raw_metadata.items():
-            if not key.startswith('sf') and not key.startswith('_sf'):
-                result[key] = value
-        return result
+    :param record_dict: Record information from configuration file.
+    :return: Dictionary of metric id to metadata
+    """
+    fetcher = MetadataFetcher(record_dict['api_server'],
+                              record_dict['record_token'],
+                              record_dict['metadata_workers'],
+                              record_dict['metadata_page_size'])
+    metadata = fetcher.fetch(record_dict['query'])
+    print "Metadata: {number} metrics in {requests} requests".format(
+        number=len(metadata), requests=fetcher.requests)
+    return metadata
 
-    try:
-        url_pattern = '{api_server}/v1/metrictimeseries?query={query}'
-        raw_metadata_list = []
-        metadata_dict = {}
-        for query in query_list:
-            query = urllib.quote(query)
-            api_url = url_pattern.format(api_server=api_server, query=query)
-            print api_url
-            data = urllib2.Request(api_url,
-                                   headers={'X-SF-TOKEN': record_token})
-            metadata = json.loads(urllib2.urlopen(data).read())
-            raw_metadata_list += metadata['rs']
-
-        for raw_metadata in raw_metadata_list:
-            metric_id = str(raw_metadata['sf_id'])
-            metadata_dict[metric_id] = {
-                'sf_metricType': raw_metadata['sf_metricType'],
-                'sf_metric': raw_metadata['sf_metric'],
-                'dimensions': filter_sf(raw_metadata)
-            }
-        return metadata_dict
-    except Exception:
-        raise Error("Cannot get metadata please check your api_server,"
-                    " record token and query sentences")
-
-
-def pull_ts_data_from_server(server, metric_id, start_time, end_time, rollup):
-    """
-    Get time series data by time and metric id
+
+def get_id_key(value):
+    """
+    Get a hashable key of an ID, or of the ID held by a Thrift struct like
+    MetricTimeSeriesRollup.
+
+    :param value: ID or Thrift struct
+    :return: hashable key
+    """
+    if not isinstance(value, ID):
+        for field in vars(value).values():
+            if isinstance(field, ID):
+                value = field
+                break
+    return tuple(sorted(vars(value).items()))
+
+
+def pull_ts_data_from_server(server, metric_ids, start_time, end_time,
+                             rollup):
+    """
+    Get time series data by time and metric ids. All metric ids are sent in
+    one request and the result is demultiplexed by metric id.
 
     :param server: Server Ip address of time series data server.
-    :param metric_id: Metric id
+    :param metric_ids: List of metric ids with the same rollup
     :param start_time: Start millisecond time
     :param end_time: End millisecond time
-    :return: Time series data
+    :param rollup: metric type of all metric ids
+    :return: Dictionary of metric id to time values
     """
-    tsdb = TsdbWrapper.TsdbWrapper(host=server)
-    mtslds = [MetricTimeSeriesRollup(to_id(metric_id), ROLLUP[rollup])]
-    return tsdb.getTimeSeriesByIds(mtslds,
-                                   None,
-                                   1000,
-                                   start_time,
-                                   end_time)
+    mtslds = [MetricTimeSeriesRollup(to_id(metric_id), ROLLUP[rollup])
+              for metric_id in metric_ids]
+    with TSDB_POOL.connection(server, (TsdbException,)) as tsdb:
+        time_series_data = tsdb.getTimeSeriesByIds(mtslds,
+                                                   None,
+                                                   1000,
+                                                   start_time,
+                                                   end_time)
+
+    if len(metric_ids) == 1:
+        return dict((metric_ids[0], time_series.timeValues)
+                    for time_series in time_series_data.data.values()[:1])
+
+    metric_id_of_key = dict((get_id_key(mts), metric_id)
+                            for mts, metric_id in zip(mtslds, metric_ids))
+    result = {}
+    for key, time_series in time_series_data.data.items():
+        metric_id = metric_id_of_key.get(get_id_key(key))
+        if metric_id is not None:
+            result[metric_id] = time_series.timeValues
+    return result
+
 
+def pull_window_data(ts_dict, metric_ids, start_time, end_time,
+                     metric_rollup):
+    """
+    Get the time series data of one window of 'resolution' in several
+    requests, with the time windows planned by CHUNK_PLANNER. The time values
+    of the requests are joined, so the window is downsampled at once.
 
-def write_ts_data_file(ts_dict, metric_id, start_time, end_time,
-                       metric_rollup):
+    :param ts_dict: Time series information from configuration file.
+    :param metric_ids: List of metric IDs with the same rollup
+    :param start_time: Start second time
+    :param end_time: End second time
+    :param metric_rollup: rollup
+    :return: Dictionary of metric id to time values
+    """
+    time_series_data = {}
+    while start_time < end_time:
+        chunk_end = min(end_time, start_time + CHUNK_PLANNER.get_window(
+            metric_rollup, len(metric_ids)))
+        try:
+            chunk_data = pull_ts_data_from_server(ts_dict['ts_server'],
+                                                  metric_ids,
+                                                  start_time * 1000,
+                                                  chunk_end * 1000,
+                                                  metric_rollup)
+        except TsdbException:
+            CHUNK_PLANNER.failure(metric_rollup, chunk_end - start_time,
+                                  len(metric_ids))
+            if chunk_end - start_time <= CHUNK_PLANNER.min_window:
+                raise
+            continue
+        CHUNK_PLANNER.success(metric_rollup, chunk_end - start_time,
+                              len(metric_ids))
+        for metric_id, time_values in chunk_data.items():
+            time_series_data.setdefault(metric_id, []).extend(time_values)
+        start_time = chunk_end
+    return time_series_data
+
+
+def write_ts_data_file(ts_dict, metric_ids, start_time, end_time,
+                       metric_rollup, split_window=False):
     """
     Write the time series data into specific files
 
     :param ts_dict: Time series information from configuration file.
-    :param metric_id: Metric ID
+    :param metric_ids: List of metric IDs with the same rollup
     :param start_time: Start second time
     :param end_time: End second time
     :param metric_rollup: rollup
+    :param split_window: pull the window of 'resolution' in several requests
     """
 
     # Get the time series data from server
-    time_series_data = pull_ts_data_from_server(ts_dict['ts_server'],
-                                                metric_id,
-                                                start_time * 1000,
-                                                end_time * 1000,
-                                                metric_rollup)
-
-    # write each time series data into specific file
-    if len(time_series_data.data.values()) > 0:
-        time_series_file_name = ''
-        time_series_file = None
-        for single_data in time_series_data.data.values()[0].timeValues:
+    if split_window:
+        time_series_data = pull_window_data(ts_dict, metric_ids, start_time,
+                                            end_time, metric_rollup)
+    else:
+        time_series_data = pull_ts_data_from_server(ts_dict['ts_server'],
+                                                    metric_ids,
+                                                    start_time * 1000,
+                                                    end_time * 1000,
+                                                    metric_rollup)
+    if ts_dict['resolution']:
+        time_series_data = downsample_time_series(time_series_data,
+                                                  ts_dict['resolution'],
+                                                  metric_rollup,
+                                                  ts_dict['start'])
+
+    # Group the time series data of all metrics by specific file, then
+    #  append each group into its file at once.
+    if ts_dict['vectorize']:
+        file_lines = group_time_values(time_series_data, ts_dict['interval'],
+                                       ts_dict['time_range'],
+                                       ts_dict['ts_directory'])
+    else:
+        file_lines = get_file_lines(ts_dict, time_series_data)
+
+    for file_path, lines in file_lines.items():
+        append_ts_data_file(file_path, lines)
+
+
+def get_file_lines(ts_dict, time_series_data):
+    """
+    Get the raw lines of the pulled time series data by raw data file
+
+    :param ts_dict: Time series information from configuration file.
+    :param time_series_data: map of metric id to list of time values
+    :return: map of raw data file path to list of lines
+    """
+    file_lines = {}
+    for metric_id, time_values in time_series_data.items():
+        for single_data in time_values:
             # Get second time from millisecond time
             time_stamp = single_data.timestampMs / 1000
-            # Set metric Id for each data
-            single_data.metric_id = metric_id
 
             # Get specific time series file
             new_file = get_time_series_file_path(int(time_stamp),
@@ -152,11 +285,6 @@ def write_ts_data_file(ts_dict, metric_id, start_time, end_time,
                                                  ts_dict['time_range'],
                                                  ts_dict['ts_directory'],
                                                  'data')
-            if new_file != time_series_file_name:
-                if time_series_file is not None:
-                    time_series_file.close()
-                time_series_file_name = new_file
-                time_series_file = open(time_series_file_name, 'a')
 
             # Append data into file
             value = single_data.value.doubleValue
@@ -165,139 +293,333 @@ def write_ts_data_file(ts_dict, metric_id, start_time, end_time,
                 metric_id=metric_id,
                 value=str(value)
             )
-            time_series_file.write(line)
-        time_series_file.close()
+            file_lines.setdefault(new_file, []).append(line)
+    return file_lines
 
 
-def download_single_ts_data(ts_dict, metric_id, start, end, metric_rollup):
+def download_single_ts_data(ts_dict, metric_ids, start, end, metric_rollup):
     """
-    Assign write data task. Pull the data from the whole time range first. If
-    the time series data is huge, the ts server will raise an exception. This
-    system will split this task into 2 small tasks and do them recursively.
-
+    Assign write data task. Pull the data of all metrics chunk by chunk, with
+    the time window planned by CHUNK_PLANNER for this rollup and number of
+    metrics, so a split batch starts from the window learned by the larger
+    batch. If the time series data is huge, the ts server will raise an
+    exception: the planner shrinks the window and the batch is split into 2
+    smaller batches while there are several metrics, otherwise the chunk is
+    pulled again with the smaller window. Any other failure of a batch splits
+    it too, so the metrics of the batch are downloaded apart from a failing
+    one. Each written chunk is journaled.
+    With a 'resolution', the chunks end on its windows, so each window is
+    downsampled from all its points. A window of 'resolution' larger than
+    the planned window is pulled in several requests.
 
     :param ts_dict: Time series information from configuration file.
-    :param metric_id: Metric ID
+    :param metric_ids: List of metric IDs with the same rollup
     :param start: Start second time
     :param end: End second time
+    :return: list of the metric IDs which failed in the split batches, a
+     failure of a single metric is raised
     """
-    try:
-        write_ts_data_file(ts_dict, metric_id, start, end, metric_rollup)
-    except TsdbException:
-        download_single_ts_data(ts_dict,
-                                metric_id,
-                                start,
-                                int((start + end) / 2),
-                                metric_rollup)
-        download_single_ts_data(ts_dict,
-                                metric_id,
-                                int((start + end) / 2),
-                                end,
-                                metric_rollup)
-
-
-def convert_time_series_data(input_file, output_file, time_range):
-    """
-    Convert the time series data file into a json file grouped by timestamp.
-
-    :param input_file: The input data file with time series data
-    :param output_file: The output json file
-    :param time_range: The time range
-    """
-    # Open the raw time series data file
-    with open(input_file) as raw_file:
-        raw_data = raw_file.read()
-    tsdata = {}
-
-    def emit(line):
-        """
-        Put all time series data into a map
-
-        :param line: raw ts data
-        """
-        array = line.split(',')
-        second_shift = get_second_shift(int(array[0]), time_range)
-        new_value = {'id': array[1], 'value': float(array[2])}
-        if second_shift in tsdata:
-            tsdata[second_shift]['data'].append(new_value)
-        else:
-            tsdata[second_shift] = {'old_time': array[0], 'data': []}
-            tsdata[second_shift]['data'] = [new_value]
-
-    # Handle all raw time series data by line
-    result_array = raw_data.split('\n')
-    map(emit, result_array[:len(result_array) - 1])
+    metric_count = len(metric_ids)
+    while start < end:
+        window = CHUNK_PLANNER.get_window(metric_rollup, metric_count)
+        chunk_end = align_chunk_end(start, start + window, end,
+                                    ts_dict['resolution'], ts_dict['start'])
+        # The chunk is a window of 'resolution' larger than the planned
+        #  window, its requests are planned by pull_window_data
+        split_window = chunk_end - start > window
+        try:
+            write_ts_data_file(ts_dict, metric_ids, start, chunk_end,
+                               metric_rollup, split_window)
+        except Exception as err:
+            if isinstance(err, TsdbException) and not split_window:
+                CHUNK_PLANNER.failure(metric_rollup, chunk_end - start,
+                                      metric_count)
+            if metric_count > 1:
+                return download_split_batch(ts_dict, metric_ids, start, end,
+                                            metric_rollup)
+            if not isinstance(err, TsdbException) or split_window or \
+                    chunk_end - start <= CHUNK_PLANNER.min_window:
+                raise
+            continue
+        if not split_window:
+            CHUNK_PLANNER.success(metric_rollup, chunk_end - start,
+                                  metric_count)
+        if ts_dict.get('journal') is not None:
+            ts_dict['journal'].record_chunk(metric_ids, start, chunk_end)
+        start = chunk_end
+    return []
+
+
+def download_split_batch(ts_dict, metric_ids, start, end, metric_rollup):
+    """
+    Download the two halves of a failed batch one after the other. A failing
+    half does not stop the other one, so a failing metric ends up alone in
+    its batch and only this metric is dropped.
 
-    # Write this map into a json file
-    with open(output_file, 'w') as outfile:
-        json.dump(tsdata, outfile, indent=4)
+    :param ts_dict: Time series information from configuration file.
+    :param metric_ids: List of metric IDs with the same rollup
+    :param start: Start second time
+    :param end: End second time
+    :return: list of the metric IDs which failed
+    """
+    half = len(metric_ids) / 2
+    failed_ids = []
+    for batch_ids in [metric_ids[:half], metric_ids[half:]]:
+        try:
+            failed_ids += download_single_ts_data(ts_dict, batch_ids, start,
+                                                  end, metric_rollup)
+        except Exception as err:
+            report_failed_metrics(batch_ids, err)
+            failed_ids += batch_ids
+    return failed_ids
 
 
-def convert_all_time_series_data(ts_dict):
+def report_failed_metrics(metric_ids, err):
     """
-    Convert all raw time series data to json data
+    Report the metrics whose download failed. They are downloaded again when
+    the recording is resumed.
 
-    :param folder_path: The folder path of all time series data
-    :param time_range: The time range
+    :param metric_ids: List of metric IDs
+    :param err: exception of the failure
     """
-    # Get all raw time series data file
-    files = glob.glob(ts_dict['ts_directory'] + "/*.data")
-    for file_path in files:
-        new_file_path = file_path[:-5] + ".json"
-        # Convert into json file
-        convert_time_series_data(file_path, new_file_path,
-                                 ts_dict['time_range'])
-        os.remove(file_path)
+    if isinstance(err, Error):
+        message = err.message
+    else:
+        message = '{0}: {1}'.format(type(err).__name__, err)
+    print "Record data from {metric_id} failed: {message}".format(
+        metric_id=','.join(metric_ids), message=message)
 
 
-def record_by_config(record_dict, config_file):
-    # Create data directory
-    create_folder_path(record_dict['data_directory'])
-    create_folder_path(record_dict['ts_directory'])
+def get_metric_batches(metadata, batch_size, start, end, resume_starts=None):
+    """
+    Group the metrics by rollup type and download start time into batches of
+    'batch_size' metrics. The metrics already downloaded until 'end' are
+    left out.
+
+    :param metadata: Metadata of all metrics
+    :param batch_size: maximum number of metrics in one batch
+    :param start: Start second time of the recording
+    :param end: End second time of the recording
+    :param resume_starts: dictionary of metric id to the second time its
+     download resumes from
+    :return: list of (rollup, start second time, metric ids) batches
+    """
+    resume_starts = resume_starts or {}
+    group_metrics = {}
+    for metric_id in sorted(metadata.keys()):
+        rollup = metadata[metric_id]['sf_metricType']
+        metric_start = resume_starts.get(metric_id, start)
+        if metric_start >= end:
+            continue
+        group_metrics.setdefault((rollup, metric_start), []).append(
+            str(metric_id))
+
+    batches = []
+    for (rollup, metric_start), metric_ids in sorted(group_metrics.items()):
+        for index in xrange(0, len(metric_ids), batch_size):
+            batches.append((rollup, metric_start,
+                            metric_ids[index:index + batch_size]))
+    return batches
+
+
+def download_all_ts_data(record_dict, metadata):
+    """
+    Download the time series data of all metrics. The metrics are grouped
+    into batches of 'batch_size' metrics with the same rollup, and the
+    batches are fanned out to a bounded pool of 'download_workers' threads.
+    With a journal, each metric resumes after its journaled chunks.
 
-    shutil.copy(config_file, record_dict['record_config'])
-    metadata = get_metadata(record_dict['api_server'],
-                            record_dict['query'],
-                            record_dict['record_token'])
+    :param record_dict: Record information from configuration file.
+    :param metadata: Metadata of all metrics
+    """
+    resume_starts = {}
+    if record_dict.get('journal') is not None:
+        resume_starts = record_dict['journal'].get_resume_starts(
+            record_dict['start'])
+    batches = get_metric_batches(metadata, record_dict['batch_size'],
+                                 record_dict['start'], record_dict['end'],
+                                 resume_starts)
+    total = sum(len(metric_ids) for _, _, metric_ids in batches)
+    if total < len(metadata):
+        print "Resume recording: {done} metrics already recorded".format(
+            done=len(metadata) - total)
+    progress = {'number': 0}
+    progress_lock = threading.Lock()
+
+    def download_batch(batch):
+        """
+        Download the time series data of one batch and report the progress
 
-    number = 0
-    for metric_id in metadata.keys():
-        number += 1
+        :param batch: (rollup, start second time, metric ids)
+        """
+        rollup, start, metric_ids = batch
+        with progress_lock:
+            progress['number'] += len(metric_ids)
+            number = progress['number']
         try:
-            download_single_ts_data(record_dict, str(metric_id),
-                                    record_dict['start'],
-                                    record_dict['end'],
-                                    metadata[metric_id]['sf_metricType'])
+            failed_ids = download_single_ts_data(record_dict, metric_ids,
+                                                 start, record_dict['end'],
+                                                 rollup)
+        except Exception as err:
+            report_failed_metrics(metric_ids, err)
+            return
+        recorded_ids = [metric_id for metric_id in metric_ids
+                        if metric_id not in failed_ids]
+        if not recorded_ids:
+            return
+        with progress_lock:
             print "Record data from {metric_id}, {number}/{total}".format(
-                metric_id=metric_id,
+                metric_id=','.join(recorded_ids),
                 number=number,
-                total=len(metadata.keys())
+                total=total
             )
-        except Exception:
-            pass
 
-    # Write metadata into file
-    with open(record_dict['metadata_path'], 'w') as outfile:
-        json.dump(metadata, outfile, indent=4)
-
-    # Convert raw time series data to json file
-    convert_all_time_series_data(record_dict)
+    CHUNK_PLANNER.reset(record_dict['end'] - record_dict['start'])
 
-    # Make tarball
-    if os.path.isfile(TAR_NAME):
-        os.remove(TAR_NAME)
+    # Keep one idle server connection for each worker
+    TSDB_POOL.max_idle = record_dict['download_workers']
+    try:
+        if record_dict['download_workers'] == 1:
+            map(download_batch, batches)
+            return
 
-    with tarfile.open(TAR_NAME, "w:gz") as tar:
-        tar.add(record_dict['data_directory'], arcname='data')
+        pool = ThreadPool(record_dict['download_workers'])
+        try:
+            pool.map(download_batch, batches, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        TSDB_POOL.close_all()
+        stats = CHUNK_PLANNER.get_stats()
+        print "Requests: {succeeded} succeeded, {failed} failed".format(
+            succeeded=stats['succeeded_requests'],
+            failed=stats['failed_requests'])
+
+
+def extend_recording(record_dict, config_file, fingerprint):
+    """
+    Prepare the incremental recording into an existing recording with the
+    same time layout: the metrics newly matched by the queries are added to
+    its metadata, with the next metric indexes. A recording without journal
+    was complete, so its metrics are journaled as recorded.
 
+    :param record_dict: Record information from configuration file.
+    :param config_file: Configuration file for record data.
+    :param fingerprint: fingerprint of the configuration
+    :return: metadata of the existing and new metrics
+    """
+    try:
+        check_data_dir(record_dict['data_directory'])
+    except Error:
+        raise Error("Cannot extend {0}, it is not a complete recording".format(
+            record_dict['data_directory']))
+    existing_dict = check_record_config(
+        read_record_config(record_dict['record_config']))
+    for item in ['start', 'time_range', 'interval', 'slot_format',
+                 'resolution']:
+        if existing_dict[item] != record_dict[item]:
+            raise Error("Cannot extend a recording with another '{0}'".format(
+                item))
+
+    with open(record_dict['metadata_path']) as metadata_file:
+        metadata = json.load(metadata_file)
+    has_journal = read_journal_fingerprint(
+        record_dict['journal_path']) is not None
+    new_metadata = get_metadata(record_dict)
+    new_ids = sorted(set(new_metadata.keys()) - set(metadata.keys()))
+    old_ids = sorted(set(metadata.keys()) - set(new_metadata.keys()))
+    print "Extend recording: {new} new metrics, {old} metrics no longer " \
+          "matched are kept".format(new=len(new_ids), old=len(old_ids))
+    recorded_ids = sorted(metadata.keys())
+    for metric_id in new_ids:
+        metadata[metric_id] = new_metadata[metric_id]
+    set_metric_indexes(metadata)
+
+    # Write metadata into file, before the journal is started
+    with open(record_dict['metadata_path'] + '.tmp', 'w') as outfile:
+        json.dump(metadata, outfile, indent=4)
+    os.rename(record_dict['metadata_path'] + '.tmp',
+              record_dict['metadata_path'])
+    shutil.copy(config_file, record_dict['record_config'])
 
-def record_data(config_file):
+    record_dict['journal'] = RecordJournal(record_dict['journal_path'],
+                                           fingerprint, keep_chunks=True)
+    if not has_journal and recorded_ids:
+        record_dict['journal'].record_chunk(recorded_ids,
+                                            record_dict['start'],
+                                            record_dict['end'])
+    truncate_partial_lines(record_dict['ts_directory'])
+    return metadata
+
+
+def record_by_config(record_dict, config_file, incremental=False):
+    if record_dict['vectorize']:
+        check_numpy()
+    fingerprint = get_config_fingerprint(read_record_config(config_file))
+    if incremental:
+        # Only download the new metrics and the missing time windows
+        metadata = extend_recording(record_dict, config_file, fingerprint)
+    elif read_journal_fingerprint(record_dict['journal_path']) == \
+            fingerprint:
+        # Resume the interrupted recording of the same configuration
+        print "Resume recording in {0}".format(record_dict['data_directory'])
+        with open(record_dict['metadata_path']) as metadata_file:
+            metadata = json.load(metadata_file)
+        truncate_partial_lines(record_dict['ts_directory'])
+    else:
+        # Create data directory
+        create_folder_path(record_dict['data_directory'])
+        create_folder_path(record_dict['ts_directory'])
+
+        shutil.copy(config_file, record_dict['record_config'])
+        metadata = get_metadata(record_dict)
+        set_metric_indexes(metadata)
+
+        # Write metadata into file, before the journal is started
+        with open(record_dict['metadata_path'], 'w') as outfile:
+            json.dump(metadata, outfile, indent=4)
+
+    if record_dict.get('journal') is None:
+        record_dict['journal'] = RecordJournal(record_dict['journal_path'],
+                                               fingerprint)
+    try:
+        download_all_ts_data(record_dict, metadata)
+    finally:
+        record_dict['journal'].close()
+
+    # Convert raw time series data to slot files, each one compressed into
+    #  the tarball as soon as it is converted
+    archive = ArchiveWriter(TAR_NAME, record_dict['data_directory'],
+                            record_dict['archive_workers'])
+    try:
+        for path in [record_dict['data_directory'],
+                     record_dict['record_config'],
+                     record_dict['metadata_path'],
+                     record_dict['ts_directory']]:
+            archive.add(path)
+        convert_all_time_series_data(record_dict, metadata, archive.add)
+        # Slot files left untouched by an incremental recording
+        for path in sorted(glob.glob('{0}/*.{1}'.format(
+                record_dict['ts_directory'],
+                SLOT_SUFFIX[record_dict['slot_format']]))):
+            archive.add(path)
+            if os.path.exists(path + SLOT_INDEX_SUFFIX):
+                archive.add(path + SLOT_INDEX_SUFFIX)
+        archive.close()
+    except BaseException:
+        archive.abort()
+        raise
+
+
+def record_data(config_file, incremental=False):
     """
     Record metadata and time series data into files
 
     :param config_file: Configuration file for record data.
+    :param incremental: extend the existing recording of the data directory
     """
     # Open the json configuration file
     config = read_record_config(config_file)
     record_dict = check_record_config(config)
-    record_by_config(record_dict, config_file)
+    record_by_config(record_dict, config_file, incremental)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+This file implements the journal of the record tool. Each downloaded chunk
+of time series data is journaled once its data are appended to the raw data
+files, so an interrupted recording resumes from the last journaled chunk of
+each metric instead of downloading everything again.
+
+The first line of the journal is the fingerprint of the record
+configuration, and each next line is a json list [start, end, metric ids]
+of one chunk in second time.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+
+# Configuration items which do not change the recorded data
+FINGERPRINT_IGNORED_ITEMS = ['download_workers', 'batch_size',
+                             'convert_buffer_size', 'convert_workers',
+                             'metadata_workers', 'metadata_page_size',
+                             'archive_workers', 'vectorize']
+
+
+def get_config_fingerprint(config):
+    """
+    Get the fingerprint of a record configuration
+
+    :param config: record configuration dictionary
+    :return: hexadecimal sha1 of the configuration
+    """
+    items = dict((key, value) for key, value in config.items()
+                 if key not in FINGERPRINT_IGNORED_ITEMS)
+    return hashlib.sha1(json.dumps(items, sort_keys=True)).hexdigest()
+
+
+def read_journal_fingerprint(journal_path):
+    """
+    Read the configuration fingerprint of a journal
+
+    :param journal_path: journal file path
+    :return: fingerprint, None if there is no journal
+    """
+    if not os.path.isfile(journal_path):
+        return None
+    with open(journal_path) as journal_file:
+        return journal_file.readline().rstrip('\n') or None
+
+
+def truncate_partial_lines(ts_directory):
+    """
+    Remove the partial last line of each raw time series data file, written
+    when the recording was interrupted in the middle of an append.
+
+    :param ts_directory: time series data directory
+    """
+    for file_path in glob.glob(ts_directory + "/*.data"):
+        with open(file_path, 'rb+') as data_file:
+            data_file.seek(0, os.SEEK_END)
+            size = data_file.tell()
+            if size == 0:
+                continue
+            data_file.seek(size - 1)
+            if data_file.read(1) == '\n':
+                continue
+            # Find the end of the last complete line
+            position = size
+            while position > 0:
+                block = min(position, 65536)
+                data_file.seek(position - block)
+                newline = data_file.read(block).rfind('\n')
+                if newline >= 0:
+                    position = position - block + newline + 1
+                    break
+                position -= block
+            data_file.truncate(position)
+
+
+def read_journal_chunks(journal_path):
+    """
+    Read the chunks of a journal
+
+    :param journal_path: journal file path
+    :return: (list of (start, end, metric ids), True if the last line is
+     complete)
+    """
+    chunks = []
+    line = ''
+    with open(journal_path) as journal_file:
+        journal_file.readline()
+        for line in journal_file:
+            try:
+                start, end, metric_ids = json.loads(line)
+            except ValueError:
+                # Partial last line of an interrupted write
+                continue
+            chunks.append((start, end, metric_ids))
+    return chunks, line.endswith('\n') or not line
+
+
+class RecordJournal(object):
+    """
+    Journal of the downloaded chunks of a recording. A journal with another
+    fingerprint is started again, or rewritten with the new fingerprint when
+    its chunks are kept by an incremental recording.
+
+    :param journal_path: journal file path
+    :param fingerprint: fingerprint of the record configuration
+    :param keep_chunks: keep the chunks of a journal with another
+     fingerprint
+    """
+
+    def __init__(self, journal_path, fingerprint, keep_chunks=False):
+        self.lock = threading.Lock()
+        self.chunks = []
+        old_fingerprint = read_journal_fingerprint(journal_path)
+        if old_fingerprint == fingerprint:
+            self.chunks, complete = read_journal_chunks(journal_path)
+            self.journal_file = open(journal_path, 'a')
+            if not complete:
+                # Start the next chunks after the partial last line
+                self.journal_file.write('\n')
+            return
+
+        if keep_chunks and old_fingerprint is not None:
+            self.chunks, _ = read_journal_chunks(journal_path)
+        with open(journal_path + '.tmp', 'w') as journal_file:
+            journal_file.write(fingerprint + '\n')
+            journal_file.writelines(json.dumps(list(chunk)) + '\n'
+                                    for chunk in self.chunks)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.rename(journal_path + '.tmp', journal_path)
+        self.journal_file = open(journal_path, 'a')
+
+    def sync(self):
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def record_chunk(self, metric_ids, start, end):
+        """
+        Journal a chunk whose data are written
+
+        :param metric_ids: metric ids of the chunk
+        :param start: start second time
+        :param end: end second time
+        """
+        line = json.dumps([start, end, metric_ids]) + '\n'
+        with self.lock:
+            self.chunks.append((start, end, metric_ids))
+            self.journal_file.write(line)
+            self.sync()
+
+    def get_resume_starts(self, start):
+        """
+        Get the time each metric should be downloaded from: the end of its
+        journaled chunks, contiguous from the start of the recording.
+
+        :param start: start second time of the recording
+        :return: dictionary of metric id to start second time
+        """
+        windows = {}
+        for chunk_start, chunk_end, metric_ids in self.chunks:
+            for metric_id in metric_ids:
+                windows.setdefault(metric_id, []).append(
+                    (chunk_start, chunk_end))
+        starts = {}
+        for metric_id, metric_windows in windows.items():
+            covered = start
+            for chunk_start, chunk_end in sorted(metric_windows):
+                if chunk_start > covered:
+                    break
+                covered = max(covered, chunk_end)
+            starts[metric_id] = covered
+        return starts
+
+    def close(self):
+        self.journal_file.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+This file implements the replay clock of the publish tool. The publisher
+reads the current time and sleeps through this clock, so a recording can be
+replayed faster than real time: the slot and second shift math of util.py
+runs on the replay time, while the datapoints are stamped on the real,
+compressed timeline.
+The replay time is measured on a monotonic clock from the start of the
+replay, so it does not jump with system time changes.
+"""
+import ctypes
+import ctypes.util
+import threading
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def get_monotonic_function():
+    """
+    Get a monotonic second clock function: time.monotonic when it exists,
+    clock_gettime(CLOCK_MONOTONIC) through ctypes, or time.time at last.
+
+    :return: function returning second time
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    except (OSError, AttributeError):
+        return time.time
+
+    def monotonic():
+        timespec = Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(timespec)) != 0:
+            return time.time()
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    return monotonic
+
+
+monotonic = get_monotonic_function()
+
+
+class ReplayClock(object):
+    """
+    Replay time, starting at the real time, or at 'start_time', and running
+    'speed' times faster. In max rate mode, sleeping skips the replay time
+    forward at once, so the replay goes as fast as the data can be sent.
+
+    :param speed: speed factor of the replay time
+    :param max_rate: replay as fast as possible
+    :param start_time: replay second time of the start, default is now
+    """
+
+    def __init__(self, speed=1.0, max_rate=False, start_time=None):
+        self.speed = speed
+        self.max_rate = max_rate
+        self.real_start = time.time() if start_time is None else start_time
+        self.monotonic_start = monotonic()
+        self.skipped = 0.0
+        self.last_timestamp = 0
+        self.lock = threading.Lock()
+
+    def restart(self, start_time):
+        """
+        Start the replay time again from a replay second time
+
+        :param start_time: replay second time
+        """
+        with self.lock:
+            self.real_start = start_time
+            self.monotonic_start = monotonic()
+            self.skipped = 0.0
+
+    def time(self):
+        """
+        Get the current replay time
+
+        :return: replay second time
+        """
+        return self.real_start + self.skipped + \
+            (monotonic() - self.monotonic_start) * self.speed
+
+    def sleep(self, seconds):
+        """
+        Sleep for a replay time duration
+
+        :param seconds: replay seconds
+        """
+        if seconds <= 0:
+            return
+        if self.max_rate:
+            with self.lock:
+                self.skipped += seconds
+            return
+        time.sleep(seconds / self.speed)
+
+    def sleep_until(self, deadline):
+        """
+        Sleep until a replay time. Nothing is done if it is already passed.
+
+        :param deadline: replay second time
+        """
+        remaining = deadline - self.time()
+        while remaining > 0:
+            self.sleep(remaining)
+            remaining = deadline - self.time()
+
+    def timestamp_ms(self, second_offset=0):
+        """
+        Get the timestamp of the datapoints due 'second_offset' replay
+        seconds from now: the real millisecond time they are due, strictly
+        increasing so that ticks sent in the same millisecond of a compressed
+        replay keep their order.
+
+        :param second_offset: replay seconds from now
+        :return: millisecond timestamp
+        """
+        real_offset = 0 if self.max_rate else second_offset / self.speed
+        with self.lock:
+            timestamp = max(int((time.time() + real_offset) * 1000),
+                            self.last_timestamp + 1)
+            self.last_timestamp = timestamp
+            return timestamp
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+This file implements the tick scheduler of the publish tool. Each timestamp
+of a slot file is due at an absolute replay time, computed once from the
+time the slot file is opened, so the waiting errors never accumulate. The
+scheduler measures how late each timestamp is sent and applies the late
+tick policy:
+
+- 'send' : send a late timestamp at once
+- 'skip' : drop a late timestamp
+- 'merge' : send all late timestamps together in one batch
+"""
+import threading
+
+
+class TickScheduler(object):
+    """
+    Schedule the timestamps of the slot files on a ReplayClock.
+
+    :param clock: ReplayClock
+    :param late_policy: late tick policy
+    :param late_tolerance: replay seconds after its deadline when a
+     timestamp is late
+    :param lateness_histogram: Histogram observing the lateness of each
+     timestamp
+    """
+
+    def __init__(self, clock, late_policy='send', late_tolerance=1.0,
+                 lateness_histogram=None):
+        self.clock = clock
+        self.lateness_histogram = lateness_histogram
+        self.late_policy = late_policy
+        self.late_tolerance = late_tolerance
+        self.anchor_time = 0.0
+        self.anchor_second_shift = 0.0
+        self.lock = threading.Lock()
+        self.ticks = 0
+        self.late_ticks = 0
+        self.skipped_ticks = 0
+        self.merged_ticks = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def start_slot(self, current_time, current_second_shift):
+        """
+        Anchor the deadlines of a new slot file
+
+        :param current_time: replay second time
+        :param current_second_shift: second shift of current_time
+        """
+        self.anchor_time = current_time
+        self.anchor_second_shift = current_second_shift
+
+    def get_deadline(self, second_shift):
+        """
+        Get the replay time when a timestamp is due
+
+        :param second_shift: second shift of the timestamp
+        :return: replay second time
+        """
+        return self.anchor_time + second_shift - self.anchor_second_shift
+
+    def get_lateness(self, second_shift):
+        """
+        Get how late a timestamp is now, negative if it is early
+
+        :param second_shift: second shift of the timestamp
+        :return: replay seconds
+        """
+        return self.clock.time() - self.get_deadline(second_shift)
+
+    def wait(self, second_shift):
+        """
+        Wait until a timestamp is due
+
+        :param second_shift: second shift of the timestamp
+        :return: lateness of the timestamp in replay seconds
+        """
+        self.clock.sleep_until(self.get_deadline(second_shift))
+        return self.get_lateness(second_shift)
+
+    def is_late(self, lateness):
+        return lateness > self.late_tolerance
+
+    def report_tick(self, lateness, skipped=False, merged=False):
+        """
+        Count one timestamp and its lateness
+
+        :param lateness: lateness of the timestamp in replay seconds
+        :param skipped: the timestamp was dropped
+        :param merged: the timestamp was merged into an earlier late one
+        """
+        lateness = max(lateness, 0.0)
+        if self.lateness_histogram is not None:
+            self.lateness_histogram.observe(lateness)
+        with self.lock:
+            self.ticks += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            if self.is_late(lateness):
+                self.late_ticks += 1
+            if skipped:
+                self.skipped_ticks += 1
+            if merged:
+                self.merged_ticks += 1
+
+    def get_stats(self):
+        """
+        Get the lateness counters
+
+        :return: stats dictionary
+        """
+        with self.lock:
+            return {
+                'ticks': self.ticks,
+                'late_ticks': self.late_ticks,
+                'skipped_ticks': self.skipped_ticks,
+                'merged_ticks': self.merged_ticks,
+                'mean_lateness': self.total_lateness / self.ticks
+                if self.ticks else 0.0,
+                'max_lateness': self.max_lateness
+            }
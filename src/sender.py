@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+This file implements the asynchronous sender of the publish tool. The send
+requests are queued and drained by a pool of sender threads, so that the
+replay loop never waits on the ingest endpoint.
+"""
+import collections
+import logging
+import threading
+from src.http_util import call_with_retries
+
+SEND_KEYS = ('gauges', 'counters', 'cumulative_counters')
+
+
+class AsyncSender(object):
+    """
+    Send requests of a signalfx client from a pool of threads. It has the
+    same 'send' method as the client, which returns once the request is
+    queued.
+
+    At most 'max_in_flight' requests are queued or being sent. When a new
+    request comes over this limit, the backpressure policy decides:
+
+    - 'block' : wait until a request is done
+    - 'drop-oldest' : drop the oldest queued request
+    - 'coalesce' : merge the new request into the newest queued request
+
+    A failed request is sent again up to 'retries' times, waiting
+    'retry_delay' seconds before the first retry and twice longer before
+    each next one.
+
+    :param client: signalfx client
+    :param workers: number of sender threads
+    :param max_in_flight: maximum number of queued or sending requests
+    :param policy: backpressure policy
+    :param retries: number of retries of a failed request
+    :param retry_delay: second delay before the first retry
+    :param name: name of the target in the logs
+    """
+
+    def __init__(self, client, workers=1, max_in_flight=8, policy='block',
+                 retries=0, retry_delay=0.5, name=None):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.name = name
+        self.pending = collections.deque()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.threads = []
+        for _ in xrange(workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def send(self, gauges=None, counters=None, cumulative_counters=None):
+        request = {'gauges': gauges or [],
+                   'counters': counters or [],
+                   'cumulative_counters': cumulative_counters or []}
+        with self.condition:
+            while self.in_flight >= self.max_in_flight:
+                if self.pending and self.policy == 'drop-oldest':
+                    self.pending.popleft()
+                    self.in_flight -= 1
+                    self.dropped += 1
+                elif self.pending and self.policy == 'coalesce':
+                    # Build new lists, the queued lists may be shared
+                    newest = self.pending[-1]
+                    for key in SEND_KEYS:
+                        newest[key] = newest[key] + request[key]
+                    self.coalesced += 1
+                    return
+                else:
+                    # Wait with a timeout, so the caller stays interruptible
+                    self.condition.wait(1)
+            self.pending.append(request)
+            self.in_flight += 1
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                request = self.pending.popleft()
+            succeeded = self.send_with_retries(request)
+            with self.condition:
+                self.in_flight -= 1
+                if succeeded:
+                    self.sent += 1
+                else:
+                    self.errors += 1
+                self.condition.notify_all()
+
+    def send_with_retries(self, request):
+        """
+        Send one request with the client, retrying on errors
+
+        :param request: keyword arguments of the client send method
+        :return: True if the request was sent
+        """
+        def log_error(err, attempt):
+            logging.error({"Send Data Error": err.message,
+                           "Target": self.name,
+                           "Attempt": attempt + 1})
+
+        try:
+            call_with_retries(lambda: self.client.send(**request),
+                              self.retries, self.retry_delay,
+                              on_error=log_error)
+        except Exception:
+            return False
+        return True
+
+    def flush(self):
+        """
+        Wait until all queued requests are sent
+        """
+        with self.condition:
+            while self.in_flight > 0:
+                self.condition.wait(1)
+
+    def get_queue_depth(self):
+        """
+        Get the number of queued or sending requests
+
+        :return: number of requests
+        """
+        with self.condition:
+            return self.in_flight
+
+
+class FanoutSender(object):
+    """
+    Send each request to several targets. The request lists are shared by
+    all targets, so the data are decoded once. Each target has its own
+    sender, with its own queue, retries and backpressure.
+
+    :param senders: list of senders, one by target
+    """
+
+    def __init__(self, senders):
+        self.senders = senders
+
+    def send(self, gauges=None, counters=None, cumulative_counters=None):
+        for sender in self.senders:
+            try:
+                sender.send(gauges=gauges, counters=counters,
+                            cumulative_counters=cumulative_counters)
+            except Exception as err:
+                logging.error({"Send Data Error": err.message})
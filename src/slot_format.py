@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+This file implements the on-disk formats of the time series data slot files.
+
+- 'json' : {"second shift": {"old_time": ..., "data": [[metric index,
+  value], ...]}}, older recordings hold {"id": ..., "value": ...} data.
+  The second shifts are written in time order, one per line, with a sidecar
+  index '<slot file>.idx' giving the position of each one, so a slot opened
+  in the middle is read from its current second shift only.
+
+      {"size": slot file size,
+       "shifts": [[second shift, old time, offset, length], ...]}
+- 'binary' : columnar arrays, little-endian, memory-mapped by the publisher
+
+      header     : magic, version, shift count M, data count N
+      shifts     : uint32[M]    second shifts, sorted
+      old_times  : uint32[M]    recorded second time of each shift
+      starts     : uint32[M+1]  first data of each shift, starts[M] = N
+      metrics    : uint32[N]    metric index in metadata.json
+      values     : float64[N]   data values
+
+Both formats are read through the same slot interface: 'time_series' is the
+sorted list of second shifts, 'get_old_time' and 'get_data' take the
+position of a second shift in 'time_series'. 'get_data' returns the
+(metric index, value) pairs of the second shift.
+"""
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+from src.util import SLOT_INDEX_SUFFIX
+
+BINARY_MAGIC = 'RPLYSLOT'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sIII')
+
+
+def to_little_endian(values):
+    """
+    Get the little-endian bytes of an array
+
+    :param values: array.array
+    :return: string of bytes
+    """
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def write_binary_groups(output_file, groups):
+    """
+    Write the sorted groups into a binary slot file
+
+    :param output_file: The output binary file
+    :param groups: generator of (second shift, old time, data), data items
+     are (metric index, value) pairs
+    """
+    shifts = array.array('I')
+    old_times = array.array('I')
+    starts = array.array('I', [0])
+    metrics = array.array('I')
+    values = array.array('d')
+    for second_shift, old_time, data in groups:
+        shifts.append(second_shift)
+        old_times.append(int(old_time))
+        for metric, value in data:
+            metrics.append(metric)
+            values.append(value)
+        starts.append(len(values))
+
+    with open(output_file, 'wb') as outfile:
+        outfile.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION,
+                                         len(shifts), len(values)))
+        for column in (shifts, old_times, starts, metrics, values):
+            outfile.write(to_little_endian(column))
+
+
+class JsonSlot(object):
+    """
+    Slot file in json format, parsed at once. The data of older recordings
+    referencing metric ids are interned when the file is opened.
+
+    :param path: slot file path
+    :param metric_index: map of metric id to metric index
+    :param data: content of the slot file, read from 'path' when None
+    """
+
+    def __init__(self, path, metric_index, data=None):
+        if data is None:
+            with open(path) as slot_file:
+                self.tsdata = json.load(slot_file)
+        else:
+            self.tsdata = json.loads(data)
+        self.time_series = sorted(map(int, self.tsdata.keys()))
+        for value in self.tsdata.values():
+            if value['data'] and isinstance(value['data'][0], dict):
+                value['data'] = [(metric_index[item['id']], item['value'])
+                                 for item in value['data']]
+
+    def get_old_time(self, position):
+        return int(self.tsdata[str(self.time_series[position])]['old_time'])
+
+    def get_data(self, position):
+        return self.tsdata[str(self.time_series[position])]['data']
+
+
+class IndexedJsonSlot(object):
+    """
+    Slot file in json format with its sidecar index. Only the index is
+    decoded when the file is opened, and the data of a second shift is
+    parsed when it is read, so the second shifts before the replay position
+    are never parsed.
+
+    :param path: slot file path
+    :param index: list of [second shift, old time, offset, length]
+    :param data: content of the slot file, memory-mapped from 'path' when
+     None
+    """
+
+    def __init__(self, path, index, data=None):
+        if data is not None:
+            self.buffer = data
+        else:
+            with open(path, 'rb') as slot_file:
+                self.buffer = mmap.mmap(slot_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+        self.index = index
+        self.time_series = [entry[0] for entry in index]
+
+    def get_old_time(self, position):
+        return self.index[position][1]
+
+    def get_data(self, position):
+        offset, length = self.index[position][2:]
+        return json.loads(self.buffer[offset:offset + length])['data']
+
+
+class BinarySlot(object):
+    """
+    Slot file in binary format. The file is memory-mapped, only the shifts
+    are unpacked when it is opened and the data of a shift is unpacked when
+    it is read.
+
+    :param path: slot file path
+    :param data: content of the slot file, memory-mapped from 'path' when
+     None
+    """
+
+    def __init__(self, path, data=None):
+        if data is not None:
+            self.buffer = data
+        else:
+            with open(path, 'rb') as slot_file:
+                self.buffer = mmap.mmap(slot_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+        magic, version, shift_count, data_count = \
+            BINARY_HEADER.unpack_from(self.buffer, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError('{0} is not a binary slot file'.format(path))
+
+        shifts_offset = BINARY_HEADER.size
+        old_times_offset = shifts_offset + 4 * shift_count
+        starts_offset = old_times_offset + 4 * shift_count
+        self.metrics_offset = starts_offset + 4 * (shift_count + 1)
+        self.values_offset = self.metrics_offset + 4 * data_count
+
+        self.time_series = list(struct.unpack_from(
+            '<{0}I'.format(shift_count), self.buffer, shifts_offset))
+        self.old_times = struct.unpack_from(
+            '<{0}I'.format(shift_count), self.buffer, old_times_offset)
+        self.starts = struct.unpack_from(
+            '<{0}I'.format(shift_count + 1), self.buffer, starts_offset)
+
+    def get_old_time(self, position):
+        return self.old_times[position]
+
+    def get_columns(self, position):
+        """
+        Get the metric indexes and the values of a second shift
+
+        :param position: position of the second shift in time_series
+        :return: (tuple of metric indexes, tuple of values)
+        """
+        start = self.starts[position]
+        count = self.starts[position + 1] - start
+        metrics = struct.unpack_from('<{0}I'.format(count), self.buffer,
+                                     self.metrics_offset + 4 * start)
+        values = struct.unpack_from('<{0}d'.format(count), self.buffer,
+                                    self.values_offset + 8 * start)
+        return metrics, values
+
+    def get_data(self, position):
+        return zip(*self.get_columns(position))
+
+
+def load_slot_index(index_data, slot_size):
+    """
+    Decode the sidecar index of a json slot file
+
+    :param index_data: content of the index file
+    :param slot_size: size of the slot file
+    :return: list of [second shift, old time, offset, length], None if the
+     index is not valid or was written for another slot file
+    """
+    try:
+        index = json.loads(index_data)
+    except ValueError:
+        return None
+    if not isinstance(index, dict) or index.get('size') != slot_size:
+        return None
+    return index['shifts']
+
+
+def open_slot(path, metric_index, data=None, index_data=None):
+    """
+    Open a slot file in the format given by its suffix. A json slot file is
+    opened through its sidecar index when it has a valid one.
+
+    :param path: slot file path
+    :param metric_index: map of metric id to metric index
+    :param data: content of the slot file, read from 'path' when None
+    :param index_data: content of the sidecar index, read from 'path' with
+     SLOT_INDEX_SUFFIX when None and 'data' is None
+    :return: JsonSlot, IndexedJsonSlot or BinarySlot
+    """
+    if not path.endswith('.json'):
+        return BinarySlot(path, data)
+    if data is None and index_data is None and \
+            os.path.isfile(path + SLOT_INDEX_SUFFIX):
+        with open(path + SLOT_INDEX_SUFFIX) as index_file:
+            index_data = index_file.read()
+    if index_data is not None:
+        slot_size = len(data) if data is not None else os.path.getsize(path)
+        index = load_slot_index(index_data, slot_size)
+        if index is not None:
+            return IndexedJsonSlot(path, index, data)
+    return JsonSlot(path, metric_index, data)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+This file implements the self-instrumentation of the publish tool: counters,
+histograms and gauges of the publisher, a local HTTP endpoint serving them
+as json, and a reporter sending them as SignalFx datapoints.
+"""
+import collections
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from src.http_util import KeepAliveHandler
+from src.http_util import start_server
+
+# Upper bounds in seconds of the histogram buckets
+HISTOGRAM_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                     2.5, 5.0, 10.0, 30.0, 60.0]
+# Second window of the current datapoint rate
+RATE_WINDOW = 10.0
+SELF_REPORT_PREFIX = 'replay.'
+
+
+class Histogram(object):
+    """
+    Histogram of second durations with fixed buckets.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            position = 0
+            while position < len(HISTOGRAM_BUCKETS) and \
+                    value > HISTOGRAM_BUCKETS[position]:
+                position += 1
+            self.counts[position] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def get_stats(self):
+        with self.lock:
+            buckets = dict((str(bound), count) for bound, count
+                           in zip(HISTOGRAM_BUCKETS, self.counts))
+            buckets['inf'] = self.counts[-1]
+            return {
+                'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'buckets': buckets
+            }
+
+
+def get_memory_stats():
+    """
+    Get the memory usage of this process
+
+    :return: dictionary of current and peak resident bytes
+    """
+    memory = {'peak_rss_bytes': resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss * 1024}
+    try:
+        with open('/proc/self/statm') as statm:
+            memory['rss_bytes'] = int(statm.read().split()[1]) * \
+                os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    return memory
+
+
+class PublisherStats(object):
+    """
+    Statistics of the publisher. The gauges are functions called when the
+    statistics are read.
+
+    :param send_instrumented: False when the client sends from its own
+     thread: its requests, send latencies and send errors are then unknown,
+     and only the datapoints handed to it are counted
+    """
+
+    def __init__(self, send_instrumented=True):
+        self.lock = threading.Lock()
+        self.send_instrumented = send_instrumented
+        self.start_time = time.time()
+        # (time, datapoints) samples taken when the statistics are read
+        self.samples = collections.deque([(self.start_time, 0)])
+        self.datapoints = 0
+        self.requests = 0
+        self.errors = {}
+        self.send_latency = Histogram()
+        self.schedule_lag = Histogram()
+        self.slot_parse_time = Histogram()
+        self.gauges = {}
+
+    def add_gauge(self, name, function):
+        self.gauges[name] = function
+
+    def report_send(self, datapoints, latency, error=None):
+        """
+        Count one send request
+
+        :param datapoints: number of datapoints of the request
+        :param latency: second duration of the request
+        :param error: exception raised by the request
+        """
+        if not self.send_instrumented:
+            if error is None:
+                with self.lock:
+                    self.datapoints += datapoints
+            return
+        self.send_latency.observe(latency)
+        with self.lock:
+            self.requests += 1
+            if error is None:
+                self.datapoints += datapoints
+            else:
+                name = type(error).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def get_stats(self):
+        """
+        Get all statistics. The datapoint rate is measured over the last
+        RATE_WINDOW seconds of reads, and since the start. The requests,
+        errors and send latency are None when the sends are not
+        instrumented.
+
+        :return: stats dictionary
+        """
+        now = time.time()
+        with self.lock:
+            while len(self.samples) > 1 and \
+                    now - self.samples[1][0] >= RATE_WINDOW:
+                self.samples.popleft()
+            sample_time, sample_datapoints = self.samples[0]
+            rate = (self.datapoints - sample_datapoints) / \
+                (now - sample_time) if now > sample_time else 0.0
+            self.samples.append((now, self.datapoints))
+            stats = {
+                'uptime_seconds': now - self.start_time,
+                'datapoints': self.datapoints,
+                'datapoints_per_second': rate,
+                'mean_datapoints_per_second':
+                    self.datapoints / (now - self.start_time),
+                'requests': self.requests,
+                'errors': dict(self.errors)
+            }
+        stats['send_latency'] = self.send_latency.get_stats()
+        if not self.send_instrumented:
+            stats.update(requests=None, errors=None, send_latency=None)
+        stats['schedule_lag'] = self.schedule_lag.get_stats()
+        stats['slot_parse_time'] = self.slot_parse_time.get_stats()
+        stats['memory'] = get_memory_stats()
+        for name, function in self.gauges.items():
+            stats[name] = function()
+        return stats
+
+
+class InstrumentedClient(object):
+    """
+    Signalfx client wrapper measuring each send request.
+
+    :param client: signalfx client
+    :param stats: PublisherStats
+    """
+
+    def __init__(self, client, stats):
+        self.client = client
+        self.stats = stats
+
+    def send(self, gauges=None, counters=None, cumulative_counters=None):
+        datapoints = len(gauges or []) + len(counters or []) + \
+            len(cumulative_counters or [])
+        start = time.time()
+        try:
+            self.client.send(gauges=gauges, counters=counters,
+                             cumulative_counters=cumulative_counters)
+        except Exception as err:
+            self.stats.report_send(datapoints, time.time() - start, err)
+            raise
+        self.stats.report_send(datapoints, time.time() - start)
+
+
+def start_stats_server(stats, host, port):
+    """
+    Serve the statistics as json on a local HTTP endpoint, from a daemon
+    thread.
+
+    :param stats: PublisherStats
+    :param host: listening address
+    :param port: listening port
+    :return: the HTTP server
+    """
+
+    class StatsHandler(KeepAliveHandler):
+        def do_GET(self):
+            self.send_body(200, json.dumps(stats.get_stats(), indent=4,
+                                           sort_keys=True))
+
+    return start_server(StatsHandler, host, port)[0]
+
+
+def get_report_datapoints(stats, dimensions):
+    """
+    Flatten the statistics into gauge datapoints
+
+    :param stats: stats dictionary
+    :param dimensions: dimensions of the datapoints
+    :return: list of datapoints, without the send statistics when they are
+     not instrumented
+    """
+    values = {
+        'datapoints_per_second': stats['datapoints_per_second'],
+        'schedule_lag.mean': stats['schedule_lag']['mean'],
+        'schedule_lag.max': stats['schedule_lag']['max'],
+        'slot_parse_time.max': stats['slot_parse_time']['max']
+    }
+    if stats['requests'] is not None:
+        values.update({
+            'requests': stats['requests'],
+            'send_errors': sum(stats['errors'].values()),
+            'send_latency.mean': stats['send_latency']['mean'],
+            'send_latency.max': stats['send_latency']['max']
+        })
+    for name, value in stats['memory'].items():
+        values['memory.' + name] = value
+    if 'queue_depth' in stats:
+        values['queue_depth'] = stats['queue_depth']
+    return [{'metric': SELF_REPORT_PREFIX + name, 'value': value,
+             'dimensions': dimensions}
+            for name, value in sorted(values.items())]
+
+
+def start_self_reporter(stats, client, interval, dimensions):
+    """
+    Send the statistics as SignalFx gauges every 'interval' seconds, from a
+    daemon thread.
+
+    :param stats: PublisherStats
+    :param client: signalfx client
+    :param interval: second interval
+    :param dimensions: dimensions of the datapoints
+    """
+    def report():
+        while True:
+            time.sleep(interval)
+            try:
+                client.send(gauges=get_report_datapoints(stats.get_stats(),
+                                                         dimensions))
+            except Exception as err:
+                logging.error({"Self Report Error": err.message})
+
+    thread = threading.Thread(target=report)
+    thread.daemon = True
+    thread.start()
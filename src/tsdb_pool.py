@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+This file implements a thread-safe pool of time series data server clients.
+The clients are handed out per server and recycled after each request, so
+that every request does not pay a new connection and handshake.
+"""
+import threading
+from contextlib import contextmanager
+
+
+def close_client(client):
+    """
+    Close a time series data server client if it can be closed
+
+    :param client: time series data server client
+    """
+    close = getattr(client, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+class TsdbConnectionPool(object):
+    """
+    Pool of time series data server clients keyed by server.
+
+    :param factory: function creating a new client from a server address
+    :param max_idle: maximum number of idle clients kept for each server
+    """
+
+    def __init__(self, factory, max_idle=1):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.idle_clients = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, server):
+        """
+        Hand out an idle client of the server, or create a new one
+
+        :param server: server address
+        :return: client
+        """
+        with self.lock:
+            clients = self.idle_clients.setdefault(server, [])
+            if clients:
+                self.reused += 1
+                return clients.pop()
+            self.created += 1
+        return self.factory(server)
+
+    def release(self, server, client):
+        """
+        Give a client back to the pool. The client is closed if the pool
+        already keeps enough idle clients for this server.
+
+        :param server: server address
+        :param client: client
+        """
+        with self.lock:
+            clients = self.idle_clients.setdefault(server, [])
+            if len(clients) < self.max_idle:
+                clients.append(client)
+                return
+        close_client(client)
+
+    @contextmanager
+    def connection(self, server, reusable_errors=()):
+        """
+        Borrow a client of the server for one request. The client is recycled
+        when the request succeeds or raises one of 'reusable_errors', which
+        are errors reported by the server and not by the connection itself.
+        Any other error drops the client.
+
+        :param server: server address
+        :param reusable_errors: tuple of exception types
+        """
+        client = self.acquire(server)
+        try:
+            yield client
+        except reusable_errors:
+            self.release(server, client)
+            raise
+        except Exception:
+            close_client(client)
+            raise
+        self.release(server, client)
+
+    def close_all(self):
+        """
+        Close all idle clients
+        """
+        with self.lock:
+            idle_clients = self.idle_clients
+            self.idle_clients = {}
+        for clients in idle_clients.values():
+            map(close_client, clients)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+This file implements a local stand-in for the time series data server.
+It answers 'getTimeSeriesByIds' with synthetic data shaped like the Thrift
+result, and simulates the connection handshake and request latency, so the
+record tool can be measured without a real server.
+"""
+import math
+import threading
+import time
+
+
+class StubValue(object):
+    def __init__(self, double_value):
+        self.doubleValue = double_value
+
+
+class StubTimeValue(object):
+    def __init__(self, timestamp_ms, double_value):
+        self.timestampMs = timestamp_ms
+        self.value = StubValue(double_value)
+
+
+class StubTimeSeries(object):
+    def __init__(self, time_values):
+        self.timeValues = time_values
+
+
+class StubTimeSeriesResult(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class StubTsdbException(Exception):
+    pass
+
+
+class StubTsdbServer(object):
+    """
+    Stand-in time series data server. Use 'client' as the client factory of
+    a TsdbConnectionPool.
+
+    :param connect_latency: seconds spent by each new connection handshake
+    :param request_latency: seconds spent by each request
+    :param resolution_ms: millisecond interval between two synthetic points
+    :param max_points: the request raises 'exception_type' when it would
+     return more points than this, like the real server does for huge data
+    :param exception_type: exception type raised for too many points
+    """
+
+    def __init__(self, connect_latency=0.05, request_latency=0.005,
+                 resolution_ms=10000, max_points=None,
+                 exception_type=StubTsdbException):
+        self.connect_latency = connect_latency
+        self.request_latency = request_latency
+        self.resolution_ms = resolution_ms
+        self.max_points = max_points
+        self.exception_type = exception_type
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.failed_requests = 0
+        self.connect_seconds = 0.0
+
+    def client(self, server):
+        """
+        Open a new connection to this server
+
+        :param server: server address, ignored by the stub
+        :return: StubTsdbClient
+        """
+        time.sleep(self.connect_latency)
+        with self.lock:
+            self.connections += 1
+            self.connect_seconds += self.connect_latency
+        return StubTsdbClient(self)
+
+    def generate_time_values(self, series_number, start_time, end_time):
+        """
+        Generate the synthetic points of one time series
+
+        :param series_number: number of the series in the request
+        :param start_time: Start millisecond time
+        :param end_time: End millisecond time
+        :return: list of StubTimeValue
+        """
+        first = start_time - start_time % self.resolution_ms
+        if first < start_time:
+            first += self.resolution_ms
+        return [StubTimeValue(timestamp_ms,
+                              math.sin(timestamp_ms / 60000.0 + series_number))
+                for timestamp_ms in xrange(first, end_time,
+                                           self.resolution_ms)]
+
+
+class StubTsdbClient(object):
+    """
+    Connection to a StubTsdbServer, with the TsdbWrapper request interface.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    def getTimeSeriesByIds(self, mtslds, time_filter, resolution, start_time,
+                           end_time):
+        server = self.server
+        time.sleep(server.request_latency)
+        points = len(mtslds) * (end_time - start_time) / server.resolution_ms
+        with server.lock:
+            server.requests += 1
+            if server.max_points is not None and points > server.max_points:
+                server.failed_requests += 1
+                raise server.exception_type()
+        return StubTimeSeriesResult(dict(
+            (mts, StubTimeSeries(server.generate_time_values(
+                number, start_time, end_time)))
+            for number, mts in enumerate(mtslds)))
+
+    def close(self):
+        self.closed = True
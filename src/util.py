@@ -6,6 +6,8 @@ import time
 import os
 import shutil
 import json
+import glob
+import zlib
 from bisect import bisect_left
 
 # time.ctime(0) is 'Wed Dec 31 16:00:00 1969'
@@ -28,6 +30,8 @@ TIME_INFOR = {
     }
 }
 TIME_PATTERN = '%m.%d.%Y %H:%M:%S'
+# Number of data held in memory before spilling a sorted run in conversion
+CONVERT_BUFFER_SIZE = 1000000
 RECORD_CONFIG_PATTERN = {
     'api_server': str,
     'record_token': str,
@@ -38,10 +42,56 @@ RECORD_CONFIG_PATTERN = {
     'time_range': str,
     'data_file_interval': float
 }
+# Optional record configuration items: name -> (type, default value)
+RECORD_CONFIG_OPTIONAL_PATTERN = {
+    'download_workers': (int, 1),
+    'batch_size': (int, 1),
+    'convert_buffer_size': (int, CONVERT_BUFFER_SIZE),
+    'convert_workers': (int, 1),
+    'slot_format': (str, 'json'),
+    'metadata_workers': (int, 4),
+    'metadata_page_size': (int, 1000),
+    'archive_workers': (int, 4),
+    'vectorize': (str, 'false'),
+    'resolution': (int, 0)
+}
+# Publish options: name -> (type, default value)
+PUBLISH_OPTION_PATTERN = {
+    'prefetch': (int, 1),
+    'senders': (int, 1),
+    'max_in_flight': (int, 8),
+    'backpressure': (str, 'block'),
+    'retries': (int, 0),
+    'shard': (str, '0/1'),
+    'speed': (float, 1.0),
+    'max_rate': (str, 'false'),
+    'batch_window': (float, 0.0),
+    'max_batch_size': (int, 0),
+    'late_policy': (str, 'send'),
+    'late_tolerance': (float, 1.0),
+    'stats_port': (int, 0),
+    'stats_host': (str, '127.0.0.1'),
+    'self_report': (float, 0.0),
+    'max_slots': (int, 0),
+    'ingest_format': (str, 'json')
+}
+LATE_POLICIES = ['send', 'skip', 'merge']
+BACKPRESSURE_POLICIES = ['block', 'drop-oldest', 'coalesce']
+# 'client' sends with the signalfx client, the other formats send
+#  pre-encoded datapoints with the raw ingest client
+INGEST_FORMATS = ['client', 'json', 'protobuf']
 METADATA_FILE = 'metadata.json'
 TS_DATA_DIR = 'ts_data'
 CONFIG_FILE = 'configuration.json'
+JOURNAL_FILE = 'record.journal'
 TAR_NAME = "replay-data.tar.gz"
+# Slot file format -> suffix of the slot files in this format
+SLOT_SUFFIX = {
+    'json': 'json',
+    'binary': 'slot'
+}
+# Suffix of the sidecar index of a json slot file
+SLOT_INDEX_SUFFIX = '.idx'
 
 
 class Error(Exception):
@@ -150,7 +200,8 @@ def get_next_time_series_file_path(current_path, interval, time_range):
                + '.' + basename_array[1])
 
 
-def get_new_interval_information(time_series, interval, time_range):
+def get_new_interval_information(time_series, interval, time_range,
+                                 current_time=None):
     """
     This function is to get the second time shift information and next index
     information when the new file appear.
@@ -158,11 +209,15 @@ def get_new_interval_information(time_series, interval, time_range):
     :param time_series: Sorted time points
     :param interval: second interval of each file
     :param time_range: second time range
+    :param current_time: current second time, default is now
     :return: current_second_shift: the second shift for the first time
     :return: next_index: index of next data
     """
+    if current_time is None:
+        current_time = time.time()
+
     # Get current time slot number
-    current_time_slot_number = get_time_slot_number(time.time(), interval,
+    current_time_slot_number = get_time_slot_number(current_time, interval,
                                                     time_range)
 
     # Get next time slot number
@@ -170,10 +225,10 @@ def get_new_interval_information(time_series, interval, time_range):
                                                  time_range)
 
     # Get second shift
-    current_second_shift = get_second_shift(time.time(), time_range)
+    current_second_shift = get_second_shift(current_time, time_range)
 
-    # Get next index
-    next_index = bisect_left(time_series, current_second_shift)
+    # Get next index, the time stamp of the current second is still due
+    next_index = bisect_left(time_series, int(current_second_shift))
 
     # If current time slot is the last one and next_time_slot_number
     #  is first one.
@@ -201,7 +256,8 @@ def create_folder_path(folder_path):
             shutil.rmtree(folder_path)
         os.makedirs(folder_path)
     except Exception:
-        raise Error('Create {folder_path} exception'.format(folder_path))
+        raise Error('Create {folder_path} exception'.format(
+            folder_path=folder_path))
 
 
 def remove_double_quotes(string):
@@ -250,12 +306,48 @@ def check_record_config(config):
         if record_dict['end'] > time.time():
             raise Error("Config start time + time interval > now")
 
+    def convert_optional_type(item, convert_func, default):
+        if item not in config.keys():
+            record_dict[item] = default
+        else:
+            convert_type(item, convert_func)
+
+    def check_slot_format():
+        if record_dict['slot_format'] not in SLOT_SUFFIX.keys():
+            raise Error("Slot format is not {0}".format(SLOT_SUFFIX.keys()))
+
+    def check_positive(item):
+        if record_dict[item] < 1:
+            raise Error("Config['{0}'] should be at least 1!".format(item))
+
+    def check_resolution():
+        if record_dict['resolution'] < 0:
+            raise Error("Config['resolution'] should not be negative!")
+        second_range = TIME_INFOR[record_dict['time_range']]['second_range']
+        if record_dict['resolution'] > second_range:
+            raise Error("Config['resolution'] should not be longer than the "
+                        "time range!")
+
     record_dict = {}
     for item_key, item_type in RECORD_CONFIG_PATTERN.items():
         convert_type(item_key, item_type)
+    for item_key, (item_type, item_default) in \
+            RECORD_CONFIG_OPTIONAL_PATTERN.items():
+        convert_optional_type(item_key, item_type, item_default)
     check_query()
+    check_positive('download_workers')
+    check_positive('batch_size')
+    check_positive('convert_buffer_size')
+    check_positive('convert_workers')
+    check_positive('metadata_workers')
+    check_positive('metadata_page_size')
+    check_positive('archive_workers')
+    check_slot_format()
     check_time_range()
     check_start_time()
+    check_resolution()
+    record_dict['vectorize'] = \
+        record_dict['vectorize'].lower() in ['true', '1', 'yes']
 
     record_dict['metadata_path'] = \
         create_path(record_dict['data_directory'], METADATA_FILE)
@@ -263,11 +355,111 @@ def check_record_config(config):
         create_path(record_dict['data_directory'], TS_DATA_DIR)
     record_dict['record_config'] = \
         create_path(record_dict['data_directory'], CONFIG_FILE)
+    record_dict['journal_path'] = \
+        create_path(record_dict['data_directory'], JOURNAL_FILE)
     record_dict['interval'] = record_dict['data_file_interval'] * 60 * 60
 
     return record_dict
 
 
+def check_publish_options(options):
+    """
+    This function is to check the publish options. Missing or None options
+    get their default value.
+    :param options: options dictionary
+    :return: checked options dictionary
+    """
+    publish_options = {}
+    for item, (item_type, item_default) in PUBLISH_OPTION_PATTERN.items():
+        if options.get(item) is None:
+            publish_options[item] = item_default
+            continue
+        try:
+            publish_options[item] = item_type(options[item])
+        except Exception:
+            raise Error("Option '{0}' is not correct!".format(item))
+    unknown = set(options.keys()) - set(PUBLISH_OPTION_PATTERN.keys())
+    if unknown:
+        raise Error("Unknown options {0}".format(sorted(unknown)))
+    for item in ['prefetch', 'senders', 'retries', 'batch_window',
+                 'max_batch_size', 'late_tolerance', 'stats_port',
+                 'self_report', 'max_slots']:
+        if publish_options[item] < 0:
+            raise Error("Option '{0}' should not be negative!".format(item))
+    if publish_options['max_in_flight'] < 1:
+        raise Error("Option 'max_in_flight' should be at least 1!")
+    if publish_options['backpressure'] not in BACKPRESSURE_POLICIES:
+        raise Error("Option 'backpressure' is not {0}".format(
+            BACKPRESSURE_POLICIES))
+    if publish_options['late_policy'] not in LATE_POLICIES:
+        raise Error("Option 'late_policy' is not {0}".format(LATE_POLICIES))
+    if publish_options['ingest_format'] not in INGEST_FORMATS:
+        raise Error("Option 'ingest_format' is not {0}".format(
+            INGEST_FORMATS))
+    # The signalfx client sends from its own thread: the sender pool only
+    #  runs the raw ingest client
+    if publish_options['ingest_format'] == 'client':
+        given = [item for item in ['senders', 'max_in_flight',
+                                   'backpressure', 'retries']
+                 if options.get(item) is not None]
+        if given:
+            raise Error("Options {0} need the raw ingest client, with "
+                        "'ingest_format' json or protobuf".format(given))
+    if publish_options['speed'] <= 0:
+        raise Error("Option 'speed' should be positive!")
+    publish_options['max_rate'] = \
+        publish_options['max_rate'].lower() in ['true', '1', 'yes']
+    try:
+        publish_options['shard'] = parse_shard(publish_options['shard'])
+    except Exception:
+        raise Error("Option 'shard' is not i/N with 0 <= i < N!")
+    return publish_options
+
+
+def parse_shard(shard):
+    """
+    Parse a shard description 'i/N': the i-th shard of N shards, counted
+    from 0.
+    :param shard: shard description
+    :return: (shard index, shard count)
+    """
+    shard_index, shard_count = [int(item) for item in shard.split('/')]
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(shard)
+    return shard_index, shard_count
+
+
+def get_metric_shard(metric_id, shard_count):
+    """
+    Get the shard of a metric id, by a hash stable across processes.
+    :param metric_id: metric id
+    :param shard_count: number of shards
+    :return: shard index
+    """
+    return (zlib.crc32(str(metric_id)) & 0xffffffff) % shard_count
+
+
+def get_publish_targets(api_tokens, ingest_endpoints):
+    """
+    Pair the api tokens with the ingest endpoints. A single ingest endpoint
+    is shared by all api tokens.
+    :param api_tokens: api token or list of api tokens
+    :param ingest_endpoints: ingest endpoint or list of ingest endpoints
+    :return: list of (api token, ingest endpoint)
+    """
+    if isinstance(api_tokens, basestring):
+        api_tokens = [api_tokens]
+    if isinstance(ingest_endpoints, basestring):
+        ingest_endpoints = [ingest_endpoints]
+    api_tokens = [str(api_token) for api_token in api_tokens]
+    ingest_endpoints = [str(endpoint) for endpoint in ingest_endpoints]
+    if len(ingest_endpoints) == 1:
+        ingest_endpoints = ingest_endpoints * len(api_tokens)
+    if not api_tokens or len(api_tokens) != len(ingest_endpoints):
+        raise Error("Every api token needs one ingest endpoint!")
+    return zip(api_tokens, ingest_endpoints)
+
+
 def read_record_config(config_file):
     """
     Check if record config file is a valid json file
@@ -290,6 +482,7 @@ def check_data_dir(data_dir):
     """
     Check if the data directory is complete.
     :param data_dir: record data directory
+    :return: slot format of the time series data files
     """
     if not os.path.exists(data_dir):
         raise Error('Data directory {0} dose not exist!'.format(data_dir))
@@ -299,3 +492,47 @@ def check_data_dir(data_dir):
     ts_not_file = not os.path.isfile(create_path(data_dir, TS_DATA_DIR))
     if not (config_file and meta_data_file and ts_data_dir and ts_not_file):
         raise Error('Data directory is not complete!')
+    return get_slot_format(create_path(data_dir, TS_DATA_DIR))
+
+
+def get_slot_format(ts_directory):
+    """
+    Recognise the format of the time series data files by their suffix.
+
+    :param ts_directory: time series data directory
+    :return: slot format
+    """
+    binary_pattern = '{0}/*.{1}'.format(ts_directory, SLOT_SUFFIX['binary'])
+    if glob.glob(binary_pattern):
+        return 'binary'
+    return 'json'
+
+
+def set_metric_indexes(metadata):
+    """
+    Intern the metric ids: give each metric of the metadata without an
+    'index' the next free metric index, in metric id order.
+
+    :param metadata: metadata dictionary
+    """
+    indexes = [value['index'] for value in metadata.values()
+               if 'index' in value]
+    next_index = max(indexes) + 1 if indexes else 0
+    for metric_id in sorted(metadata.keys()):
+        if 'index' not in metadata[metric_id]:
+            metadata[metric_id]['index'] = next_index
+            next_index += 1
+
+
+def get_metric_ids(metadata):
+    """
+    Get the list of metric ids by metric index.
+
+    :param metadata: metadata dictionary with metric indexes
+    :return: list of metric ids
+    """
+    size = max([value['index'] for value in metadata.values()] or [-1]) + 1
+    metric_ids = [None] * size
+    for metric_id, value in metadata.items():
+        metric_ids[value['index']] = metric_id
+    return metric_ids
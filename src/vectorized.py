@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+This file implements the vectorized partitioning of time series data, with
+NumPy. The time stamps of a pulled chunk or of a raw data file are turned
+into arrays, their second shifts and slot numbers are computed for the whole
+array at once and the data are grouped by a stable sort, instead of calling
+get_second_shift for each datapoint.
+
+The results are identical to the per datapoint functions: the stable sort
+keeps the data of each group in their original order.
+"""
+from src.util import Error
+from src.util import TIME_INFOR
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def check_numpy():
+    if numpy is None:
+        raise Error("Config['vectorize'] needs NumPy, please install it: "
+                    "pip install numpy")
+
+
+def get_second_shifts(time_stamps, time_range):
+    """
+    Get the second shifts of an array of second times, like
+    get_second_shift
+
+    :param time_stamps: int64 array of second times
+    :param time_range: time range
+    :return: int64 array of second shifts
+    """
+    second_shift = TIME_INFOR[time_range]['second_shift']
+    second_range = TIME_INFOR[time_range]['second_range']
+    return numpy.mod(time_stamps + second_shift, second_range)
+
+
+def get_slot_numbers(time_stamps, interval, time_range):
+    """
+    Get the time slot numbers of an array of second times, like
+    get_time_slot_number
+
+    :param time_stamps: int64 array of second times
+    :param interval: second interval of each file
+    :param time_range: time range
+    :return: int64 array of time slot numbers
+    """
+    second_shifts = get_second_shifts(time_stamps, time_range)
+    return (second_shifts / float(interval)).astype(numpy.int64)
+
+
+def group_by(keys):
+    """
+    Group the positions of an array by key, keeping their order in each
+    group
+
+    :param keys: int64 array of keys
+    :return: generator of (key, array of positions)
+    """
+    order = numpy.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    unique_keys, starts = numpy.unique(sorted_keys, return_index=True)
+    ends = numpy.append(starts[1:], len(sorted_keys))
+    for key, start, end in zip(unique_keys.tolist(), starts.tolist(),
+                               ends.tolist()):
+        yield key, order[start:end]
+
+
+def group_time_values(time_series_data, interval, time_range, folder_path):
+    """
+    Get the raw lines of the pulled time series data by raw data file, like
+    the per datapoint loop of write_ts_data_file
+
+    :param time_series_data: map of metric id to list of time values
+    :param interval: second interval of each file
+    :param time_range: time range
+    :param folder_path: raw time series data directory
+    :return: map of raw data file path to list of lines
+    """
+    metric_ids = []
+    time_values = []
+    for metric_id, values in time_series_data.items():
+        metric_ids.append(metric_id)
+        time_values.extend(values)
+    if not time_values:
+        return {}
+    counts = [len(values) for values in time_series_data.values()]
+    metric_positions = numpy.repeat(numpy.arange(len(metric_ids)), counts)
+    time_stamps = numpy.fromiter(
+        (single_data.timestampMs for single_data in time_values),
+        numpy.int64, len(time_values)) // 1000
+
+    file_lines = {}
+    for slot_number, positions in group_by(
+            get_slot_numbers(time_stamps, interval, time_range)):
+        file_path = '{0}/{1}.data'.format(folder_path,
+                                          str(slot_number).zfill(5))
+        file_lines[file_path] = [
+            '{0},{1},{2}\n'.format(time_stamp, metric_ids[metric_position],
+                                   str(time_values[position].value.
+                                       doubleValue))
+            for position, time_stamp, metric_position in zip(
+                positions.tolist(), time_stamps[positions].tolist(),
+                metric_positions[positions].tolist())]
+    return file_lines
+
+
+def read_raw_columns(lines, time_range):
+    """
+    Parse raw time series data lines into columns. The malformed lines are
+    skipped, like in the per line loop of convert_time_series_data.
+
+    :param lines: list of raw lines 'time stamp,metric id,value'
+    :param time_range: time range
+    :return: (int64 array of second shifts, list of old times, list of
+     metric ids, list of values), None if no line is well formed
+    """
+    # A well formed line has exactly 3 fields: the buffer is split at once
+    #  into a flat list of fields, instead of a list of fields by line
+    lines = [line for line in lines if line.count(',') == 2]
+    if not lines:
+        return None
+    text = ''.join(lines)
+    if not text.endswith('\n'):
+        text += '\n'
+    fields = text.replace('\n', ',').split(',')
+    old_times = fields[0:-1:3]
+    second_shifts = get_second_shifts(numpy.array(old_times, numpy.int64),
+                                      time_range)
+    return second_shifts, old_times, fields[1::3], map(float, fields[2::3])
+
+
+def group_raw_lines(lines, time_range):
+    """
+    Group raw time series data lines by second shift, like the per line
+    loop of convert_time_series_data
+
+    :param lines: list of raw lines 'time stamp,metric id,value'
+    :param time_range: time range
+    :return: map of second shift to old time and data
+    """
+    columns = read_raw_columns(lines, time_range)
+    if columns is None:
+        return {}
+    second_shifts, old_times, metric_ids, values = columns
+    tsdata = {}
+    for second_shift, positions in group_by(second_shifts):
+        positions = positions.tolist()
+        tsdata[second_shift] = {
+            'old_time': old_times[positions[0]],
+            'data': [{'id': metric_ids[position], 'value': values[position]}
+                     for position in positions]
+        }
+    return tsdata
+
+
+def group_interned_lines(lines, time_range, metric_index):
+    """
+    Group raw time series data lines by second shift into the groups of a
+    slot file, like dedupe_groups and intern_groups of the grouped lines:
+    the first value of each metric is kept in each group.
+
+    :param lines: list of raw lines 'time stamp,metric id,value'
+    :param time_range: time range
+    :param metric_index: map of metric id to metric index
+    :return: generator of (second shift, old time, data), data items are
+     (metric index, value) pairs
+    """
+    columns = read_raw_columns(lines, time_range)
+    if columns is None:
+        return
+    second_shifts, old_times, metric_ids, values = columns
+    # Intern each distinct metric id once
+    unique_ids, id_positions = numpy.unique(numpy.array(metric_ids),
+                                            return_inverse=True)
+    metrics = numpy.array([metric_index[metric_id]
+                           for metric_id in unique_ids.tolist()],
+                          numpy.int64)[id_positions]
+    values = numpy.array(values, numpy.float64)
+    for second_shift, positions in group_by(second_shifts):
+        group_metrics = metrics[positions]
+        unique_metrics, firsts = numpy.unique(group_metrics,
+                                              return_index=True)
+        if len(unique_metrics) != len(group_metrics):
+            positions = positions[numpy.sort(firsts)]
+            group_metrics = metrics[positions]
+        yield (second_shift, old_times[positions[0]],
+               zip(group_metrics.tolist(), values[positions].tolist()))
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+Tests of the conversion of raw time series data files into slot files. The
+tests of the vectorized paths need NumPy, they are skipped without it.
+
+    python -m unittest discover -s tests -t .
+"""
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from src import convert_data
+from src import slot_format
+from src import vectorized
+from src.archive import ArchiveReader
+from src.archive import ArchiveWriter
+from src.downsample import TimeValue
+from src.util import Error
+
+try:
+    from src import record_data
+except ImportError:
+    record_data = None
+
+# Start of an hour, the first second of the first slot
+HOUR_START = 1500000000 - 1500000000 % 3600
+
+
+def write_raw_file(path, lines):
+    with open(path, 'w') as outfile:
+        outfile.writelines(lines)
+    return path
+
+
+def get_raw_lines():
+    """
+    Get raw lines of 3 metrics over an hour: a duplicated chunk and a
+    malformed line, like a resumed recording may leave
+    """
+    lines = ['{0},{1},{2!r}\n'.format(HOUR_START + shift, metric_id,
+                                      shift * 0.5 + number)
+             for shift in xrange(0, 3600, 7)
+             for number, metric_id in enumerate(['a', 'b', 'c'])]
+    return lines + lines[30:60] + ['broken line\n'] + lines[:3]
+
+
+@unittest.skipIf(vectorized.numpy is None, 'NumPy is not installed')
+class VectorizedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        convert_data.init_convert_worker({'a': 0, 'b': 1, 'c': 2})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def convert(self, lines, name, slot_format, buffer_size, vectorize):
+        raw_path = write_raw_file(os.path.join(self.directory, name + '.data'),
+                                  lines)
+        output_path = os.path.join(self.directory, name + '.slot')
+        convert_data.convert_time_series_data(
+            raw_path, output_path, 'hour', buffer_size, slot_format,
+            index_file=output_path + '.idx' if slot_format == 'json'
+            else None, vectorize=vectorize)
+        outputs = [output_path] + ([output_path + '.idx']
+                                   if slot_format == 'json' else [])
+        return [open(path, 'rb').read() for path in outputs]
+
+    def assert_same_conversion(self, slot_format, buffer_size):
+        lines = get_raw_lines()
+        self.assertEqual(
+            self.convert(lines, 'scalar', slot_format, buffer_size, False),
+            self.convert(lines, 'vector', slot_format, buffer_size, True))
+
+    def test_json_conversion(self):
+        self.assert_same_conversion('json', 100000)
+
+    def test_binary_conversion(self):
+        self.assert_same_conversion('binary', 100000)
+
+    def test_conversion_of_spilled_runs(self):
+        self.assert_same_conversion('json', 100)
+        self.assert_same_conversion('binary', 100)
+
+    def test_grouped_raw_lines(self):
+        lines = get_raw_lines()
+        tsdata = {}
+        for line in lines:
+            array = line.rstrip('\n').split(',')
+            if len(array) != 3:
+                continue
+            group = tsdata.setdefault(int(array[0]) - HOUR_START, {
+                'old_time': array[0], 'data': []})
+            group['data'].append({'id': array[1], 'value': float(array[2])})
+        self.assertEqual(vectorized.group_raw_lines(lines, 'hour'), tsdata)
+
+    @unittest.skipIf(record_data is None,
+                     'the dtools library is not installed')
+    def test_record_lines(self):
+        time_series_data = dict(
+            (metric_id, [TimeValue((HOUR_START + shift) * 1000 + 250,
+                                   shift * 0.1 + number)
+                         for shift in xrange(0, 3600, 13)])
+            for number, metric_id in enumerate(['a', 'b', 'c']))
+        ts_dict = {'interval': 0.25, 'time_range': 'hour',
+                   'ts_directory': self.directory}
+        self.assertEqual(
+            vectorized.group_time_values(time_series_data, 0.25, 'hour',
+                                         self.directory),
+            record_data.get_file_lines(ts_dict, time_series_data))
+
+
+class ConvertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        convert_data.init_convert_worker({'a': 0, 'b': 1, 'c': 2})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_merged_runs_keep_the_first_value(self):
+        runs = [iter([(5, 0, '105', [{'id': 'a', 'value': 1.0}]),
+                      (9, 0, '109', [{'id': 'b', 'value': 2.0}])]),
+                iter([(5, 1, '3605', [{'id': 'a', 'value': 3.0},
+                                      {'id': 'c', 'value': 4.0}]),
+                      (7, 1, '107', [{'id': 'c', 'value': 5.0}])])]
+        self.assertEqual(
+            list(convert_data.intern_groups(convert_data.dedupe_groups(
+                convert_data.merge_sorted_runs(runs)),
+                convert_data.METRIC_INDEX)),
+            [(5, '105', [(0, 1.0), (2, 4.0)]),
+             (7, '107', [(2, 5.0)]),
+             (9, '109', [(1, 2.0)])])
+
+    def test_spilled_runs(self):
+        lines = get_raw_lines()
+        raw_path = write_raw_file(os.path.join(self.directory, 'raw.data'),
+                                  lines)
+        expected = {}
+        for line in lines:
+            array = line.rstrip('\n').split(',')
+            if len(array) != 3:
+                continue
+            group = expected.setdefault(str(int(array[0]) - HOUR_START), {
+                'old_time': array[0], 'data': []})
+            metric_index = convert_data.METRIC_INDEX[array[1]]
+            if metric_index not in [item[0] for item in group['data']]:
+                group['data'].append([metric_index, float(array[2])])
+        for buffer_size in [100000, 100, 1]:
+            output_path = os.path.join(self.directory,
+                                       'spilled{0}.json'.format(buffer_size))
+            convert_data.convert_time_series_data(raw_path, output_path,
+                                                  'hour', buffer_size)
+            with open(output_path) as infile:
+                self.assertEqual(json.load(infile), expected)
+            # The run files are removed
+            self.assertFalse([name for name in os.listdir(self.directory)
+                              if name.endswith('.run')])
+
+
+def get_groups():
+    """
+    Get sorted slot groups, the data items are (metric index, value) pairs
+    """
+    return [(shift, str(HOUR_START + shift),
+             [(metric, shift + metric * 0.25) for metric in xrange(shift % 4)])
+            for shift in xrange(0, 900, 5)]
+
+
+def read_groups(slot):
+    return [(second_shift, str(slot.get_old_time(position)),
+             map(tuple, slot.get_data(position)))
+            for position, second_shift in enumerate(slot.time_series)]
+
+
+class SlotFormatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_json_slot(self):
+        path = os.path.join(self.directory, '00000.json')
+        convert_data.write_json_groups(path, iter(get_groups()))
+        slot = slot_format.open_slot(path, {})
+        self.assertTrue(isinstance(slot, slot_format.JsonSlot))
+        self.assertEqual(read_groups(slot), get_groups())
+
+    def test_json_slot_of_metric_ids(self):
+        path = os.path.join(self.directory, '00000.json')
+        with open(path, 'w') as outfile:
+            json.dump({'10': {'old_time': str(HOUR_START + 10),
+                              'data': [{'id': 'b', 'value': 1.5},
+                                       {'id': 'a', 'value': 2.5}]}},
+                      outfile)
+        slot = slot_format.open_slot(path, {'a': 0, 'b': 1})
+        self.assertEqual(read_groups(slot),
+                         [(10, str(HOUR_START + 10), [(1, 1.5), (0, 2.5)])])
+
+    def test_binary_slot(self):
+        path = os.path.join(self.directory, '00000.slot')
+        slot_format.write_binary_groups(path, iter(get_groups()))
+        slot = slot_format.open_slot(path, {})
+        self.assertTrue(isinstance(slot, slot_format.BinarySlot))
+        self.assertEqual(read_groups(slot), get_groups())
+        # The same slot read from its content
+        with open(path, 'rb') as infile:
+            slot = slot_format.open_slot(path, {}, infile.read())
+        self.assertEqual(read_groups(slot), get_groups())
+
+    def test_binary_slot_of_another_format(self):
+        path = os.path.join(self.directory, '00000.slot')
+        with open(path, 'wb') as outfile:
+            outfile.write('{"0": {"old_time": "0", "data": []}}')
+        self.assertRaises(ValueError, slot_format.open_slot, path, {})
+
+
+class SlotIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, '00000.json')
+        convert_data.init_convert_worker({'a': 0, 'b': 1, 'c': 2})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_indexed_slot(self):
+        convert_data.write_json_groups(self.path, iter(get_groups()),
+                                       self.path + '.idx')
+        slot = slot_format.open_slot(self.path, {})
+        self.assertTrue(isinstance(slot, slot_format.IndexedJsonSlot))
+        self.assertEqual(read_groups(slot), get_groups())
+        # The same slot read from its content and the content of its index
+        with open(self.path) as infile, \
+                open(self.path + '.idx') as index_file:
+            slot = slot_format.open_slot(self.path, {}, infile.read(),
+                                         index_file.read())
+        self.assertTrue(isinstance(slot, slot_format.IndexedJsonSlot))
+        self.assertEqual(read_groups(slot), get_groups())
+
+    def test_stale_index(self):
+        convert_data.write_json_groups(self.path, iter(get_groups()),
+                                       self.path + '.idx')
+        convert_data.write_json_groups(self.path, iter(get_groups()[1:]))
+        slot = slot_format.open_slot(self.path, {})
+        self.assertTrue(isinstance(slot, slot_format.JsonSlot))
+        self.assertEqual(read_groups(slot), get_groups()[1:])
+
+    def test_index_of_a_merged_slot(self):
+        raw_path = os.path.join(self.directory, '00000.data')
+        lines = get_raw_lines()
+        write_raw_file(raw_path, lines[:900])
+        self.assertEqual(convert_data.convert_slot_file(
+            (raw_path, 'hour', 100, 'json', False)),
+            [self.path, self.path + '.idx'])
+        # A next conversion merges the slot file and writes a new index
+        write_raw_file(raw_path, lines[900:])
+        convert_data.convert_slot_file((raw_path, 'hour', 100, 'json',
+                                        False))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['00000.json', '00000.json.idx'])
+        slot = slot_format.open_slot(self.path, {})
+        self.assertTrue(isinstance(slot, slot_format.IndexedJsonSlot))
+        with open(self.path) as infile:
+            tsdata = json.load(infile)
+        self.assertEqual(
+            read_groups(slot),
+            [(shift, tsdata[str(shift)]['old_time'],
+              map(tuple, tsdata[str(shift)]['data']))
+             for shift in sorted(map(int, tsdata))])
+        self.assertEqual(len(tsdata), len(xrange(0, 3600, 7)))
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data_directory = os.path.join(self.directory, 'record')
+        self.archive_path = os.path.join(self.directory, 'replay-data.tar.gz')
+        ts_directory = os.path.join(self.data_directory, 'ts_data')
+        os.makedirs(ts_directory)
+        with open(os.path.join(self.data_directory,
+                               'configuration.json'), 'w') as outfile:
+            json.dump({'slot_format': 'json'}, outfile)
+        with open(os.path.join(self.data_directory,
+                               'metadata.json'), 'w') as outfile:
+            json.dump({'a': {'index': 0}}, outfile)
+        slot_path = os.path.join(ts_directory, '00000.json')
+        convert_data.write_json_groups(slot_path, iter(get_groups()),
+                                       slot_path + '.idx')
+        # A member larger than a read block, and an empty one
+        write_raw_file(os.path.join(ts_directory, '00001.data'),
+                       get_raw_lines() * 100)
+        write_raw_file(os.path.join(ts_directory, '00002.data'), [])
+        self.paths = [self.data_directory, ts_directory] + [
+            os.path.join(root, name)
+            for root, _, names in os.walk(self.data_directory)
+            for name in names]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_archive(self):
+        writer = ArchiveWriter(self.archive_path, self.data_directory, 3)
+        for path in self.paths + self.paths[:2]:
+            writer.add(path)
+        writer.close()
+
+    def get_name(self, path):
+        return 'data' + path[len(self.data_directory):]
+
+    def test_archive_round_trip(self):
+        self.write_archive()
+        # The archive is a valid tar.gz file
+        archive = tarfile.open(self.archive_path)
+        self.assertEqual(sorted(archive.getnames()),
+                         sorted(self.get_name(path) for path in self.paths))
+        reader = ArchiveReader(self.archive_path)
+        for path in self.paths:
+            if os.path.isdir(path):
+                continue
+            with open(path, 'rb') as infile:
+                data = infile.read()
+            self.assertEqual(reader.read(self.get_name(path)), data)
+            self.assertEqual(
+                archive.extractfile(self.get_name(path)).read(), data)
+        self.assertEqual(reader.check_data(), 'json')
+        self.assertEqual(reader.read_json('data/metadata.json'),
+                         {'a': {'index': 0}})
+        slot = reader.open_slot('data/ts_data/00000.json', {})
+        self.assertTrue(isinstance(slot, slot_format.IndexedJsonSlot))
+        self.assertEqual(read_groups(slot), get_groups())
+
+    def test_archive_without_its_index(self):
+        self.write_archive()
+        with open(self.archive_path, 'ab') as outfile:
+            outfile.write('\0')
+        self.assertRaises(Error, ArchiveReader, self.archive_path)
+        os.remove(self.archive_path + '.idx')
+        self.assertRaises(Error, ArchiveReader, self.archive_path)
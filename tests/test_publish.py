@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+"""
+Tests of the publish tool against the local stand-in ingest endpoint. The
+tests sending datapoints need the signalfx library, they are skipped
+without it.
+
+    python -m unittest discover -s tests -t .
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from src import benchmark
+from src.ingest_client import JsonEncoder
+from src.ingest_client import ProtobufEncoder
+from src.convert_data import write_json_groups
+from src.metric_table import MetricTable
+from src.prefetch import SlotPrefetcher
+from src.publish_data import get_batch_ticks
+from src.replay_clock import ReplayClock
+from src.scheduler import TickScheduler
+from src.stats import Histogram
+from src.util import Error
+from src.util import TIME_PATTERN
+from src.util import check_publish_options
+
+try:
+    import signalfx
+except ImportError:
+    signalfx = None
+
+try:
+    from signalfx.generated_protocol_buffers import \
+        signal_fx_protocol_buffers_pb2 as protocol_buffers
+except ImportError:
+    protocol_buffers = None
+
+
+def encode_body(encoder):
+    """
+    Encode a request of a gauge, a counter and a cumulative counter, and the
+    datapoints of non finite values
+
+    :param encoder: JsonEncoder or ProtobufEncoder
+    :return: (request body, encoded non finite datapoints)
+    """
+    dimensions = {'host': 'host-1', 'region': u'\xe9t\xe9'}
+    templates = [encoder.encode_template(bucket, 'metric.{0}'.format(bucket),
+                                         dimensions)
+                 for bucket in xrange(3)]
+    timestamp = encoder.encode_timestamp(1500000000250)
+    buckets = ([encoder.encode_datapoint(templates[0], 1.5, timestamp)],
+               [encoder.encode_datapoint(templates[1], 2, timestamp)],
+               [encoder.encode_datapoint(templates[2], -0.1, timestamp)])
+    non_finite = [encoder.encode_datapoint(templates[0], value, timestamp)
+                  for value in [float('nan'), float('inf'), float('-inf')]]
+    return encoder.encode_body(buckets), non_finite
+
+
+def get_metadata(count):
+    """
+    Get the metadata of 'count' metrics of each metric type and of an
+    unknown metric type
+    """
+    metric_types = ['GAUGE', 'COUNTER', 'CUMULATIVE_COUNTER', 'ENUM']
+    return dict(('id{0}'.format(number), {
+        'sf_metricType': metric_types[number % 4],
+        'sf_metric': u'metric.{0}'.format(number),
+        'dimensions': {'host': 'host-{0}'.format(number)}})
+        for number in xrange(4 * count))
+
+
+class MetricTableTest(unittest.TestCase):
+
+    def test_columns(self):
+        metadata = get_metadata(5)
+        table = MetricTable(metadata)
+        self.assertEqual(len(table), 20)
+        self.assertEqual(table.shard_size, 20)
+        for index, metric_id in enumerate(table.metric_ids):
+            self.assertEqual(table.metric_index[metric_id], index)
+            self.assertEqual(metadata[metric_id]['index'], index)
+        index = table.metric_index['id6']
+        self.assertEqual(table.buckets[index], 2)
+        self.assertEqual(table.metric_names[index], 'metric.6')
+        self.assertEqual(table.dimensions[index], {'host': 'host-6'})
+        self.assertRaises(TypeError, table.dimensions[index].update, {})
+        # The metrics of an unknown metric type are not published
+        self.assertEqual(table.buckets[table.metric_index['id7']], None)
+
+    def test_shards(self):
+        published = []
+        for shard_index in xrange(3):
+            table = MetricTable(get_metadata(50), (shard_index, 3))
+            self.assertEqual(len(table), 200)
+            shard = [metric_id for metric_id, metric_name
+                     in zip(table.metric_ids, table.metric_names)
+                     if metric_name is not None]
+            # The shards are balanced
+            self.assertTrue(40 < len(shard) < 100)
+            self.assertEqual(table.shard_size, len(shard))
+            published += shard
+        # Each metric is in one shard
+        self.assertEqual(sorted(published), sorted(get_metadata(50)))
+
+    def test_shard_option(self):
+        self.assertEqual(check_publish_options({'shard': '2/3'})['shard'],
+                         (2, 3))
+        for shard in ['3/3', '-1/3', '1', 'a/b']:
+            self.assertRaises(Error, check_publish_options,
+                              {'shard': shard})
+
+    def test_templates(self):
+        table = MetricTable(get_metadata(5))
+        table.encode_templates(JsonEncoder())
+        self.assertEqual(
+            json.loads(table.encoder.encode_datapoint(
+                table.templates[table.metric_index['id1']], 2.5,
+                table.encoder.encode_timestamp(1000))),
+            {'metric': 'metric.1', 'dimensions': {'host': 'host-1'},
+             'value': 2.5, 'timestamp': 1000})
+        self.assertEqual(table.templates[table.metric_index['id3']], None)
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_json_body(self):
+        body, non_finite = encode_body(JsonEncoder())
+        datapoint = {'dimensions': {'host': 'host-1',
+                                    'region': u'\xe9t\xe9'},
+                     'timestamp': 1500000000250}
+        self.assertEqual(json.loads(body), {
+            'gauge': [dict(datapoint, metric='metric.0', value=1.5)],
+            'counter': [dict(datapoint, metric='metric.1', value=2.0)],
+            'cumulative_counter': [dict(datapoint, metric='metric.2',
+                                        value=-0.1)]})
+        # Json has no number for them, they are not sent
+        self.assertEqual(non_finite, [None, None, None])
+
+    @unittest.skipIf(protocol_buffers is None,
+                     'the signalfx library is not installed')
+    def test_protobuf_body(self):
+        body, non_finite = encode_body(ProtobufEncoder())
+        message = protocol_buffers.DataPointUploadMessage()
+        message.ParseFromString(body)
+        self.assertEqual(
+            [(datapoint.metric, datapoint.metricType, datapoint.timestamp,
+              datapoint.value.doubleValue,
+              [(dimension.key, dimension.value)
+               for dimension in datapoint.dimensions])
+             for datapoint in message.datapoints],
+            [('metric.0', protocol_buffers.GAUGE, 1500000000250, 1.5,
+              [('host', 'host-1'), ('region', u'\xe9t\xe9')]),
+             ('metric.1', protocol_buffers.COUNTER, 1500000000250, 2.0,
+              [('host', 'host-1'), ('region', u'\xe9t\xe9')]),
+             ('metric.2', protocol_buffers.CUMULATIVE_COUNTER,
+              1500000000250, -0.1,
+              [('host', 'host-1'), ('region', u'\xe9t\xe9')])])
+        # Protocol buffers doubles take them
+        decoded = protocol_buffers.DataPointUploadMessage()
+        decoded.ParseFromString(''.join(non_finite))
+        self.assertEqual([repr(datapoint.value.doubleValue)
+                          for datapoint in decoded.datapoints],
+                         ['nan', 'inf', '-inf'])
+
+
+@unittest.skipIf(signalfx is None, 'the signalfx library is not installed')
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bench_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.bench_directory)
+
+    def test_every_generated_datapoint_is_published(self):
+        config = benchmark.get_bench_config(
+            self.bench_directory + '/generated', 'hour', 0.25, 'json')
+        # Start on an hour, so a datapoint is due on the first second of
+        #  the first slot
+        start = int(time.time()) - 2 * 3600
+        start -= start % 3600
+        config['start_time'] = time.strftime(TIME_PATTERN,
+                                             time.localtime(start))
+        benchmark.generate_recording(config, 3, 10)
+        benchmark.convert_recording(config)
+        result = benchmark.publish_recording(config, 3, 10, {})
+        self.assertEqual(result['generated'], 3 * 360)
+        self.assertEqual(result['datapoints'], result['generated'])
+        self.assertEqual(result['ingested']['datapoints'],
+                         result['generated'])
+
+
+class ReplayClockTest(unittest.TestCase):
+
+    def test_speed(self):
+        clock = ReplayClock(speed=100.0, start_time=1000.0)
+        start = time.time()
+        clock.sleep(10)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertTrue(1010.0 <= clock.time() < 1020.0)
+
+    def test_max_rate(self):
+        clock = ReplayClock(max_rate=True, start_time=1000.0)
+        clock.sleep_until(4600.0)
+        self.assertTrue(4600.0 <= clock.time() < 4601.0)
+        # Nothing is due in the past
+        clock.sleep_until(1000.0)
+        self.assertTrue(clock.time() < 4601.0)
+        clock.restart(2000.0)
+        self.assertTrue(2000.0 <= clock.time() < 2001.0)
+
+    def test_timestamps(self):
+        clock = ReplayClock(speed=60.0)
+        now = time.time() * 1000
+        # A tick due in a replay minute is stamped a real second later
+        self.assertTrue(now + 900 < clock.timestamp_ms(60) < now + 2000)
+        timestamps = [clock.timestamp_ms() for _ in xrange(1000)]
+        self.assertEqual(sorted(set(timestamps)), timestamps)
+
+
+class StubSlot(object):
+    """
+    Slot of one datapoint by second shift, its value is the second shift
+    """
+
+    def __init__(self, time_series):
+        self.time_series = time_series
+
+    def get_data(self, position):
+        return [(0, self.time_series[position])]
+
+
+class TickSchedulerTest(unittest.TestCase):
+
+    def get_batches(self, late_policy, batch_window=0, max_batch_size=0):
+        """
+        Batch the ticks of a slot opened 5 seconds ago: the ticks of the
+        second shifts 0 to 3 are late
+
+        :return: list of the second shifts of each batch
+        """
+        clock = ReplayClock(max_rate=True, start_time=1000.0)
+        scheduler = TickScheduler(clock, late_policy, 1.0)
+        scheduler.start_slot(clock.time() - 5, 0)
+        publish_dict = {'clock': clock, 'scheduler': scheduler,
+                        'batch_window': batch_window,
+                        'max_batch_size': max_batch_size}
+        slot = StubSlot([0, 1, 2, 8, 9, 10, 11])
+        batches = []
+        next_index = 0
+        while next_index < len(slot.time_series):
+            lateness = scheduler.wait(slot.time_series[next_index])
+            if late_policy == 'skip' and scheduler.is_late(lateness):
+                scheduler.report_tick(lateness, skipped=True)
+                next_index += 1
+                continue
+            ticks, next_index = get_batch_ticks(slot, next_index,
+                                                publish_dict)
+            batches.append([data[0][1] for data, _ in ticks])
+        self.stats = scheduler.get_stats()
+        return batches
+
+    def test_send(self):
+        self.assertEqual(self.get_batches('send'),
+                         [[0], [1], [2], [8], [9], [10], [11]])
+        self.assertEqual(self.stats['late_ticks'], 3)
+        self.assertEqual(self.get_batches('send', batch_window=10),
+                         [[0, 1, 2, 8, 9], [10, 11]])
+
+    def test_skip(self):
+        self.assertEqual(self.get_batches('skip'), [[8], [9], [10], [11]])
+        self.assertEqual(self.stats['skipped_ticks'], 3)
+        self.assertEqual(self.stats['ticks'], 7)
+
+    def test_skip_in_a_batch_window(self):
+        # The late ticks merged into the batch of an early one are skipped
+        #  too
+        clock = ReplayClock(max_rate=True, start_time=1000.0)
+        scheduler = TickScheduler(clock, 'skip', 1.0)
+        scheduler.start_slot(clock.time() - 5, 0)
+        publish_dict = {'clock': clock, 'scheduler': scheduler,
+                        'batch_window': 10, 'max_batch_size': 0}
+        slot = StubSlot([0, 1, 2, 8, 9, 10, 11])
+        ticks, next_index = get_batch_ticks(slot, 0, publish_dict)
+        self.assertEqual([data[0][1] for data, _ in ticks], [0, 8, 9])
+        self.assertEqual(next_index, 5)
+        self.assertEqual(scheduler.get_stats()['skipped_ticks'], 2)
+
+    def test_merge(self):
+        self.assertEqual(self.get_batches('merge'),
+                         [[0, 1, 2], [8], [9], [10], [11]])
+        self.assertEqual(self.stats['merged_ticks'], 2)
+        self.assertEqual(self.get_batches('merge', max_batch_size=2),
+                         [[0, 1], [2], [8], [9], [10], [11]])
+
+    def test_deadlines(self):
+        clock = ReplayClock(max_rate=True, start_time=1000.0)
+        scheduler = TickScheduler(clock)
+        scheduler.start_slot(1000.0, 100)
+        self.assertEqual(scheduler.get_deadline(130), 1030.0)
+        # The clock skips to the deadline, the tick is on time
+        self.assertTrue(0 <= scheduler.wait(130) < 1.0)
+        self.assertTrue(29 < scheduler.wait(100) < 31)
+
+
+class CountingSource(object):
+    """
+    Source of slot files counting the opened files
+    """
+
+    def __init__(self):
+        self.opened = []
+
+    def exists(self, path):
+        return True
+
+    def open_slot(self, path, metric_index):
+        self.opened.append(path)
+        return StubSlot([len(self.opened)])
+
+
+class SlotPrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Slots of an hour of 15 minutes: a missing slot and a broken one
+        write_json_groups(os.path.join(self.directory, '00000.json'),
+                          iter([(5, '1005', [(0, 1.0)])]))
+        write_json_groups(os.path.join(self.directory, '00002.json'),
+                          iter([(1805, '2805', [(0, 2.0)])]))
+        with open(os.path.join(self.directory, '00003.json'), 'w') as outfile:
+            outfile.write('{"2705": ')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_slots_in_replay_order(self, depth):
+        histogram = Histogram()
+        slots = SlotPrefetcher(os.path.join(self.directory, '00000.json'),
+                               {}, 900, 'hour', depth, histogram)
+        path, slot = slots.next_slot()
+        self.assertEqual((os.path.basename(path), slot.time_series),
+                         ('00000.json', [5]))
+        path, slot = slots.next_slot()
+        self.assertEqual((os.path.basename(path), slot), ('00001.json', None))
+        path, slot = slots.next_slot()
+        self.assertEqual((os.path.basename(path), slot.get_data(0)),
+                         ('00002.json', [[0, 2.0]]))
+        # The error of a broken slot is raised in replay order
+        self.assertRaises(ValueError, slots.next_slot)
+        path, slot = slots.next_slot()
+        self.assertEqual(os.path.basename(path), '00000.json')
+        self.assertTrue(histogram.get_stats()['count'] >= 3)
+
+    def test_prefetched_slots(self):
+        self.assert_slots_in_replay_order(2)
+
+    def test_slots_without_prefetch(self):
+        self.assert_slots_in_replay_order(0)
+
+    def test_prefetch_depth(self):
+        source = CountingSource()
+        slots = SlotPrefetcher(os.path.join(self.directory, '00000.json'),
+                               {}, 900, 'hour', 2, source=source)
+        time.sleep(0.2)
+        # The queue holds 2 slots and the loader waits with a third one
+        self.assertEqual(len(source.opened), 3)
+        self.assertEqual(slots.next_slot()[1].time_series, [1])
+        time.sleep(0.2)
+        self.assertEqual(len(source.opened), 4)
@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+"""
+Tests of the record tool against the local stand-in services. The tests of
+record_data need the dtools library on the python path, they are skipped
+without it.
+
+    python -m unittest discover -s tests -t .
+"""
+import glob
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from src.api_stub import StubApiServer
+from src.api_stub import generate_metric_time_series
+from src.chunk_planner import ChunkPlanner
+from src.downsample import TimeValue
+from src.downsample import align_chunk_end
+from src.downsample import downsample_time_series
+from src.metadata import MetadataFetcher
+from src.record_journal import RecordJournal
+from src.record_journal import truncate_partial_lines
+from src.tsdb_pool import TsdbConnectionPool
+from src.tsdb_stub import StubTsdbServer
+from src.tsdb_stub import StubTsdbException
+from src.util import Error
+from src.util import TIME_PATTERN
+from src.util import check_record_config
+
+try:
+    from src import record_data
+except ImportError:
+    record_data = None
+
+
+def get_stub_server(**kwargs):
+    """
+    Get a stand-in time series data server without latency
+
+    :param kwargs: other arguments of StubTsdbServer
+    :return: StubTsdbServer
+    """
+    return StubTsdbServer(connect_latency=0, request_latency=0, **kwargs)
+
+
+class TsdbConnectionPoolTest(unittest.TestCase):
+
+    def request(self, pool, max_points_error=False):
+        with pool.connection('ts', (StubTsdbException,)) as client:
+            if max_points_error:
+                raise StubTsdbException()
+            return client.getTimeSeriesByIds(['mts'], None, 1000, 0, 60000)
+
+    def test_sequential_requests_reuse_one_client(self):
+        server = get_stub_server()
+        pool = TsdbConnectionPool(server.client)
+        for _ in xrange(5):
+            self.request(pool)
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(pool.reused, 4)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(server.requests, 5)
+
+    def test_server_error_keeps_the_client(self):
+        server = get_stub_server()
+        pool = TsdbConnectionPool(server.client)
+        self.assertRaises(StubTsdbException, self.request, pool, True)
+        self.request(pool)
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(pool.reused, 1)
+
+    def test_connection_error_drops_the_client(self):
+        server = get_stub_server()
+        pool = TsdbConnectionPool(server.client)
+        clients = []
+        try:
+            with pool.connection('ts', (StubTsdbException,)) as client:
+                clients.append(client)
+                raise IOError('broken connection')
+        except IOError:
+            pass
+        self.request(pool)
+        self.assertTrue(clients[0].closed)
+        self.assertEqual(pool.created, 2)
+        self.assertEqual(pool.reused, 0)
+
+    def test_idle_clients_are_bounded(self):
+        server = get_stub_server()
+        pool = TsdbConnectionPool(server.client, max_idle=2)
+        clients = [pool.acquire('ts') for _ in xrange(3)]
+        for client in clients:
+            pool.release('ts', client)
+        self.assertEqual([client.closed for client in clients],
+                         [False, False, True])
+        pool.close_all()
+        self.assertTrue(all(client.closed for client in clients))
+
+
+class ChunkPlannerTest(unittest.TestCase):
+    # A dense week: one point a minute, at most one hour of points by
+    #  request
+    time_range = 7 * 24 * 3600
+
+    def setUp(self):
+        self.server = get_stub_server(resolution_ms=60000, max_points=60)
+        self.client = self.server.client('ts')
+
+    def request(self, start, end, metric_count=1):
+        self.client.getTimeSeriesByIds(['mts'] * metric_count, None, 1000,
+                                       start * 1000, end * 1000)
+
+    def download(self, planner, key, metric_count=1):
+        """
+        Download the time range of a batch chunk by chunk, like
+        download_single_ts_data
+        """
+        start = 0
+        while start < self.time_range:
+            chunk_end = min(self.time_range,
+                            start + planner.get_window(key, metric_count))
+            try:
+                self.request(start, chunk_end, metric_count)
+            except StubTsdbException:
+                planner.failure(key, chunk_end - start, metric_count)
+                continue
+            planner.success(key, chunk_end - start, metric_count)
+            start = chunk_end
+
+    def download_by_halving(self, start, end):
+        """
+        Download the time range by recursive halving, like the record tool
+        did before the planner
+        """
+        try:
+            self.request(start, end)
+        except StubTsdbException:
+            middle = (start + end) / 2
+            self.download_by_halving(start, middle)
+            self.download_by_halving(middle, end)
+
+    def test_fewer_failed_requests_than_halving(self):
+        self.download_by_halving(0, self.time_range)
+        halving_failures = self.server.failed_requests
+
+        planner = ChunkPlanner(self.time_range)
+        self.download(planner, 'GAUGE')
+        first_failures = planner.get_stats()['failed_requests']
+        for _ in xrange(9):
+            self.download(planner, 'GAUGE')
+        stats = planner.get_stats()
+        self.assertTrue(first_failures * 10 < halving_failures)
+        # The next metrics start from the learned window and seldom probe
+        self.assertTrue(stats['failed_requests'] < 2 * first_failures)
+        self.assertTrue(stats['failed_requests'] * 50 <
+                        stats['succeeded_requests'])
+        self.assertTrue(stats['largest_success']['GAUGE'] <= 3600)
+        self.assertTrue(planner.get_window('GAUGE') > 3600 / 2)
+
+    def test_smaller_batch_starts_from_the_learned_window(self):
+        planner = ChunkPlanner(self.time_range)
+        self.download(planner, 'GAUGE', 4)
+        learned_failures = planner.get_stats()['failed_requests']
+        self.assertTrue(planner.get_window('GAUGE', 4) <= 3600 / 4)
+        self.assertEqual(planner.get_window('GAUGE', 2),
+                         2 * planner.get_window('GAUGE', 4))
+        self.download(planner, 'GAUGE', 2)
+        self.download(planner, 'GAUGE', 1)
+        self.assertTrue(planner.get_stats()['failed_requests'] <
+                        learned_failures + 4)
+
+    def test_failed_probe_falls_back_to_the_working_window(self):
+        planner = ChunkPlanner(self.time_range)
+        planner.success('GAUGE', self.time_range)
+        planner.failure('GAUGE', 1000)
+        self.assertEqual(planner.get_window('GAUGE'), 500)
+        for _ in xrange(4):
+            planner.success('GAUGE', 500)
+        self.assertEqual(planner.get_window('GAUGE'), 625)
+        planner.failure('GAUGE', 625)
+        self.assertEqual(planner.get_window('GAUGE'), 500)
+        # The next probe needs twice more successes in a row
+        for _ in xrange(7):
+            planner.success('GAUGE', 500)
+        self.assertEqual(planner.get_window('GAUGE'), 500)
+        planner.success('GAUGE', 500)
+        self.assertEqual(planner.get_window('GAUGE'), 625)
+
+
+class DownsampleTest(unittest.TestCase):
+
+    def test_rollups(self):
+        # Windows of 60 seconds from 1030, not from the epoch
+        time_values = [TimeValue(time_stamp * 1000, value) for time_stamp,
+                       value in [(1030, 1.0), (1040, 5.0), (1089, 3.0),
+                                 (1090, 4.0), (1200, 2.0)]]
+        points = dict(
+            (metric_type, [(time_value.timestampMs,
+                            time_value.value.doubleValue)
+                           for time_value in downsample_time_series(
+                               {'m': time_values}, 60, metric_type,
+                               1030)['m']])
+            for metric_type in ['GAUGE', 'COUNTER', 'CUMULATIVE_COUNTER'])
+        self.assertEqual(points, {
+            'GAUGE': [(1030000, 3.0), (1090000, 4.0), (1150000, 2.0)],
+            'COUNTER': [(1030000, 9.0), (1090000, 4.0), (1150000, 2.0)],
+            'CUMULATIVE_COUNTER': [(1030000, 5.0), (1090000, 4.0),
+                                   (1150000, 2.0)]})
+
+    def test_chunk_ends_on_the_windows(self):
+        # Windows of 60 seconds from 1030, the recording ends at 2000
+        self.assertEqual(align_chunk_end(1030, 1100, 2000, 60, 1030), 1090)
+        self.assertEqual(align_chunk_end(1090, 1150, 2000, 60, 1030), 1150)
+        # A chunk shorter than a window grows to the end of its window
+        self.assertEqual(align_chunk_end(1090, 1100, 2000, 60, 1030), 1150)
+        self.assertEqual(align_chunk_end(1950, 2010, 2000, 60, 1030), 2000)
+        # Without a resolution, only the end of the recording cuts a chunk
+        self.assertEqual(align_chunk_end(1030, 1100, 2000, 0, 1030), 1100)
+
+
+class RecordJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.directory, 'record.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume_after_a_partial_line(self):
+        journal = RecordJournal(self.journal_path, 'config')
+        journal.record_chunk(['1', '2'], 0, 100)
+        journal.record_chunk(['1'], 100, 200)
+        # Metric 3 misses its first chunk
+        journal.record_chunk(['3'], 150, 250)
+        journal.close()
+        with open(self.journal_path, 'a') as journal_file:
+            journal_file.write('[200, 300, ["1"')
+
+        journal = RecordJournal(self.journal_path, 'config')
+        self.assertEqual(len(journal.chunks), 3)
+        self.assertEqual(journal.get_resume_starts(0),
+                         {'1': 200, '2': 100, '3': 0})
+        journal.record_chunk(['2'], 100, 300)
+        journal.close()
+        journal = RecordJournal(self.journal_path, 'config')
+        self.assertEqual(journal.get_resume_starts(0),
+                         {'1': 200, '2': 300, '3': 0})
+        journal.close()
+
+    def test_journal_of_another_configuration(self):
+        journal = RecordJournal(self.journal_path, 'config')
+        journal.record_chunk(['1'], 0, 100)
+        journal.close()
+        journal = RecordJournal(self.journal_path, 'other config')
+        self.assertEqual(journal.get_resume_starts(0), {})
+        journal.record_chunk(['1'], 0, 50)
+        journal.close()
+        # An incremental recording keeps the chunks
+        journal = RecordJournal(self.journal_path, 'config',
+                                keep_chunks=True)
+        self.assertEqual(journal.get_resume_starts(0), {'1': 50})
+        journal.close()
+        with open(self.journal_path) as journal_file:
+            self.assertEqual(journal_file.readline(), 'config\n')
+
+    def test_partial_lines_of_the_raw_files(self):
+        contents = {'00000.data': ('1,a,1.0\n2,a,2.0\n', '3,a,'),
+                    '00001.data': ('1,b,1.0\n', ''),
+                    '00002.data': ('', '4,c'),
+                    '00003.data': ('', '')}
+        for name, (lines, partial_line) in contents.items():
+            with open(os.path.join(self.directory, name), 'w') as outfile:
+                outfile.write(lines + partial_line)
+        truncate_partial_lines(self.directory)
+        for name, (lines, _) in contents.items():
+            with open(os.path.join(self.directory, name)) as infile:
+                self.assertEqual(infile.read(), lines)
+
+
+class MetadataFetcherTest(unittest.TestCase):
+
+    def fetch(self, results, query_list, workers=1, page_size=1000,
+              **kwargs):
+        server = StubApiServer(results, **kwargs)
+        try:
+            fetcher = MetadataFetcher(server.url, 'token', workers,
+                                      page_size, retry_delay=0)
+            return fetcher.fetch(query_list), fetcher, server
+        finally:
+            server.shutdown()
+
+    def test_pages_of_a_query(self):
+        results = {'q': generate_metric_time_series('q', 2500)}
+        metadata, _, server = self.fetch(results, ['q'], page_size=1000)
+        self.assertEqual(sorted(metadata, key=int),
+                         [str(number) for number in xrange(2500)])
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(metadata['7'], {
+            'sf_metricType': 'COUNTER',
+            'sf_metric': 'stub.q',
+            'dimensions': {'host': 'host-7'}})
+
+    def test_smaller_pages_of_the_server(self):
+        results = {'q': generate_metric_time_series('q', 1000)}
+        metadata, _, server = self.fetch(results, ['q'], page_size=1000,
+                                         max_limit=300)
+        self.assertEqual(len(metadata), 1000)
+        self.assertEqual(server.requests, 4)
+
+    def test_pages_without_count(self):
+        results = {'a': generate_metric_time_series('a', 2500),
+                   'b': generate_metric_time_series('b', 600, first_id=5000),
+                   'c': []}
+        metadata, _, server = self.fetch(results, ['a', 'b', 'c'],
+                                         workers=4, page_size=1000,
+                                         max_limit=300, send_count=False)
+        self.assertEqual(len(metadata), 3100)
+        self.assertEqual(metadata['5599']['sf_metric'], 'stub.b')
+        # The pages run out on a short or empty page
+        self.assertEqual(server.requests, 9 + 3 + 1)
+
+    def test_metrics_of_several_queries_are_kept_once(self):
+        results = {'a': generate_metric_time_series('a', 300),
+                   'b': generate_metric_time_series('b', 300, first_id=200)}
+        metadata, _, _ = self.fetch(results, ['a', 'b'], workers=4,
+                                    page_size=100)
+        self.assertEqual(len(metadata), 500)
+        # The first query matching a metric gives its metadata
+        self.assertEqual(metadata['250']['sf_metric'], 'stub.a')
+        self.assertEqual(metadata['450']['sf_metric'], 'stub.b')
+
+    def test_failed_pages_are_retried(self):
+        results = {'q': generate_metric_time_series('q', 1000)}
+        metadata, fetcher, server = self.fetch(results, ['q'], workers=4,
+                                               page_size=100, fail_every=3)
+        self.assertEqual(len(metadata), 1000)
+        self.assertTrue(server.failed_requests > 0)
+        self.assertEqual(fetcher.retried_requests, server.failed_requests)
+        # Each worker keeps its connection alive
+        self.assertTrue(server.connections <= 4)
+
+
+@unittest.skipIf(record_data is None, 'the dtools library is not installed')
+class RecordDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_directory = tempfile.mkdtemp()
+        self.factory = record_data.TSDB_POOL.factory
+        self.failing_ids = []
+        self.failing_error = record_data.TsdbException
+
+    def tearDown(self):
+        record_data.TSDB_POOL.factory = self.factory
+        shutil.rmtree(self.data_directory)
+
+    def get_config(self, **config):
+        # One second after an hour, not on the windows of the epoch
+        start = int(time.time()) - 2 * 3600
+        start -= start % 3600 - 1
+        return dict({
+            'api_server': 'http://127.0.0.1',
+            'record_token': 'token',
+            'ts_server': 'ts',
+            'query': ['q'],
+            'data_directory': self.data_directory + '/data',
+            'start_time': time.strftime(TIME_PATTERN, time.localtime(start)),
+            'time_range': 'hour',
+            'data_file_interval': 0.25}, **config)
+
+    def get_record_dict(self, **config):
+        record_dict = check_record_config(self.get_config(**config))
+        if not os.path.isdir(record_dict['ts_directory']):
+            os.makedirs(record_dict['ts_directory'])
+        return record_dict
+
+    def get_client(self, server):
+        """
+        Get a client of the stand-in server failing for 'failing_ids', and
+        keeping the keys of the requested metrics in 'requested_keys'
+        """
+        client = self.server.client(server)
+        get_time_series = client.getTimeSeriesByIds
+        failing_keys = [record_data.get_id_key(record_data.to_id(metric_id))
+                        for metric_id in self.failing_ids]
+
+        def get_time_series_by_ids(mtslds, *args):
+            self.requested_keys.update(record_data.get_id_key(mts)
+                                       for mts in mtslds)
+            for mts in mtslds:
+                if record_data.get_id_key(mts) in failing_keys:
+                    raise self.failing_error()
+            return get_time_series(mtslds, *args)
+
+        client.getTimeSeriesByIds = get_time_series_by_ids
+        return client
+
+    def record(self, metric_types, server_options=None, resume=False,
+               **config):
+        """
+        Download the time series data of metrics 1, 2, ... with the stand-in
+        server, with a journal
+
+        :param metric_types: metric type of each metric
+        :param server_options: other arguments of StubTsdbServer
+        :param resume: resume the previous recording from its journal
+        :param config: other items of the record configuration
+        :return: (record dictionary, map of metric id to list of (second
+         time, value) of the raw data files)
+        """
+        self.server = get_stub_server(exception_type=record_data.TsdbException,
+                                      **(server_options or {}))
+        record_data.TSDB_POOL.factory = self.get_client
+        self.requested_keys = set()
+        if not resume:
+            shutil.rmtree(self.data_directory)
+        record_dict = self.get_record_dict(**config)
+        truncate_partial_lines(record_dict['ts_directory'])
+        metadata = dict((str(number + 1), {'sf_metricType': metric_type})
+                        for number, metric_type in enumerate(metric_types))
+        record_dict['journal'] = RecordJournal(record_dict['journal_path'],
+                                               'config')
+        try:
+            record_data.download_all_ts_data(record_dict, metadata)
+        finally:
+            record_dict['journal'].close()
+        points = {}
+        for file_path in glob.glob(record_dict['ts_directory'] + '/*.data'):
+            with open(file_path) as raw_file:
+                for line in raw_file:
+                    time_stamp, metric_id, value = line.split(',')
+                    points.setdefault(metric_id, []).append(
+                        (int(time_stamp), float(value)))
+        for values in points.values():
+            values.sort()
+        return record_dict, points
+
+    def test_failing_metric_of_a_batch(self):
+        self.failing_ids = ['1']
+        for batch_size in [1, 4]:
+            _, points = self.record(['GAUGE'] * 4, batch_size=batch_size)
+            self.assertEqual(sorted(points), ['2', '3', '4'])
+            self.assertEqual(len(points['2']), 360)
+
+    def test_resume_from_the_journal(self):
+        # The first recording misses metric 2 and is interrupted in the
+        #  middle of a journal line and of a data line
+        self.failing_ids = ['2']
+        record_dict, points = self.record(['GAUGE'] * 3, batch_size=1)
+        self.assertEqual(sorted(points), ['1', '3'])
+        with open(record_dict['journal_path'], 'a') as journal_file:
+            journal_file.write('[0, 60, ["2"')
+        data_path = glob.glob(record_dict['ts_directory'] + '/*.data')[0]
+        with open(data_path, 'a') as data_file:
+            data_file.write('{0},2,'.format(record_dict['start']))
+
+        self.failing_ids = []
+        _, points = self.record(['GAUGE'] * 3, resume=True, batch_size=1)
+        # Only metric 2 is downloaded, each point is written once
+        self.assertEqual(self.requested_keys, set([
+            record_data.get_id_key(record_data.to_id('2'))]))
+        self.assertEqual(sorted(points), ['1', '2', '3'])
+        for values in points.values():
+            self.assertEqual(len(values), 360)
+            self.assertEqual(len(set(values)), 360)
+
+    def test_other_error_of_a_batch(self):
+        self.failing_ids = ['3']
+        self.failing_error = ValueError
+        _, points = self.record(['GAUGE'] * 4, batch_size=4)
+        self.assertEqual(sorted(points), ['1', '2', '4'])
+
+    def extend(self, server, **config):
+        """
+        Prepare the incremental recording of a configuration into the
+        recording of the data directory
+
+        :param server: StubApiServer of the metadata
+        :param config: other items of the record configuration
+        :return: (record dictionary, metadata of the recording)
+        """
+        config_file = self.data_directory + '/config.json'
+        with open(config_file, 'w') as outfile:
+            json.dump(self.get_config(api_server=server.url, **config),
+                      outfile)
+        record_dict = self.get_record_dict(api_server=server.url, **config)
+        try:
+            return record_dict, record_data.extend_recording(
+                record_dict, config_file, 'extended config')
+        finally:
+            if record_dict.get('journal') is not None:
+                record_dict['journal'].close()
+
+    def test_extend_a_recording(self):
+        # A complete recording of metrics 0, 1 and 9 without journal
+        record_dict = self.get_record_dict()
+        with open(record_dict['record_config'], 'w') as outfile:
+            json.dump(self.get_config(), outfile)
+        with open(record_dict['metadata_path'], 'w') as outfile:
+            json.dump({'0': {'index': 0}, '1': {'index': 1},
+                       '9': {'index': 2}}, outfile)
+        # The queries now match metrics 0 to 3
+        server = StubApiServer({'q': generate_metric_time_series('q', 4)})
+        try:
+            with self.assertRaises(Error):
+                self.extend(server, data_file_interval=0.5)
+            record_dict, metadata = self.extend(server)
+        finally:
+            server.shutdown()
+
+        # The new metrics get the next indexes, metric 9 is kept
+        self.assertEqual(dict((metric_id, value['index'])
+                              for metric_id, value in metadata.items()),
+                         {'0': 0, '1': 1, '9': 2, '2': 3, '3': 4})
+        with open(record_dict['metadata_path']) as infile:
+            self.assertEqual(json.load(infile), metadata)
+        # The recorded metrics are journaled, only the new ones are
+        #  downloaded
+        journal = RecordJournal(record_dict['journal_path'],
+                                'extended config')
+        try:
+            self.assertEqual(
+                journal.get_resume_starts(record_dict['start']),
+                dict((metric_id, record_dict['end'])
+                     for metric_id in ['0', '1', '9']))
+        finally:
+            journal.close()
+
+    def test_extend_an_incomplete_recording(self):
+        # The recording was interrupted before its metadata were written
+        server = StubApiServer({})
+        try:
+            with self.assertRaises(Error):
+                self.extend(server)
+        finally:
+            server.shutdown()
+
+    def assert_rolled_up(self, native_points, points, rollup):
+        """
+        Check that each point is the rollup of the native points of its
+        window, from its time stamp to the next point
+        """
+        windows = {}
+        for time_stamp, value in native_points:
+            window = max(window_start for window_start, _ in points
+                         if window_start <= time_stamp)
+            windows.setdefault(window, []).append(value)
+        self.assertEqual([time_stamp for time_stamp, _ in points],
+                         sorted(windows))
+        for time_stamp, value in points:
+            self.assertAlmostEqual(value, rollup(windows[time_stamp]))
+
+    def test_window_larger_than_a_request(self):
+        server_options = {'resolution_ms': 1000}
+        _, native = self.record(['COUNTER'], server_options)
+        server_options['max_points'] = 100
+        _, points = self.record(['COUNTER'], server_options, resolution=3600)
+        self.assertTrue(self.server.failed_requests > 0)
+        self.assertEqual(len(points['1']), 1)
+        self.assert_rolled_up(native['1'], points['1'], sum)
+
+    def test_windows_from_the_recording_start(self):
+        metric_types = ['GAUGE', 'COUNTER', 'CUMULATIVE_COUNTER']
+        _, native = self.record(metric_types)
+        record_dict, points = self.record(metric_types, resolution=70)
+        start = record_dict['start']
+        for metric_id, rollup in [('1', lambda values: sum(values) /
+                                   len(values)), ('2', sum), ('3', max)]:
+            self.assert_rolled_up(native[metric_id], points[metric_id],
+                                  rollup)
+            time_stamps = [point[0] for point in points[metric_id]]
+            self.assertEqual(time_stamps, range(start, record_dict['end'],
+                                                70))
+
+
+if __name__ == '__main__':
+    unittest.main()